@@ -67,12 +67,14 @@ setup(
     ],
     install_requires=[
         # eg: 'aspectlib==1.1.1', 'six>=1.7',
-        'aenum>=2.0.7'
+        'aenum>=2.0.7; python_version < "3.4"',
+        'futures>=3.0; python_version < "3"',
     ],
     extras_require={
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        'numpy': ['numpy'],
     },
     entry_points={
         'console_scripts': [
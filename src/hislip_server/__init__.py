@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-from hislip_server import HislipServer, HislipClient
+from __future__ import absolute_import
+
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import HislipClientPool
+from hislip_server.hislip_server import HislipClient
+from hislip_server.hislip_server import HislipServer
 
 __version__ = "0.1.0"
-__all__ = ["HislipServer", "HislipClient"]
+__all__ = ["HislipServer", "HislipClient", "HislipClientConnection", "HislipClientPool"]
@@ -8,7 +8,11 @@ Why does this file exist, and why __main__? For more info, read:
 - https://docs.python.org/2/using/cmdline.html#cmdoption-m
 - https://docs.python.org/3/using/cmdline.html#cmdoption-m
 """
+from __future__ import absolute_import
+
+import sys
+
 from hislip_server.cli import main
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
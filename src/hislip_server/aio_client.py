@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio HiSLIP client, mirroring :class:`hislip_server.client.HislipClientConnection`.
+
+Requires Python 3.5 or later.
+"""
+import asyncio
+import collections
+import time
+
+from hislip_server.client import FIRST_MESSAGE_ID
+from hislip_server.client import HISLIP_PORT
+from hislip_server.client import PROTOCOL_VERSION
+from hislip_server.client import TLS_PROTOCOL_VERSION
+from hislip_server.client import _make
+from hislip_server.client import next_message_id
+from hislip_server.hislip_server import HislipConnectionClosed
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipProtocolError
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageAsyncInitialize
+from hislip_server.hislip_server import MessageAsyncLock
+from hislip_server.hislip_server import MessageAsyncMaximumMessageSize
+from hislip_server.hislip_server import MessageAsyncStartTLS
+from hislip_server.hislip_server import MessageAsyncStatusQuery
+from hislip_server.hislip_server import MessageData
+from hislip_server.hislip_server import MessageDataEnd
+from hislip_server.hislip_server import MessageInitialize
+from hislip_server.hislip_server import MessageStartTLS
+from hislip_server.hislip_server import MessageTrigger
+from hislip_server.hislip_server import byte_view
+from hislip_server.tls import START_TLS_SUCCESS
+from hislip_server.tls import TLSEngine
+from hislip_server.tls import default_session_cache
+
+
+# Where available the transport receives into the buffer returned by get_buffer(), like recv_into()
+_Protocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+
+
+class _StreamProtocol(_Protocol):
+    """
+    The byte stream of one channel. Data read with :meth:`read_into` is received directly into the
+    supplied buffer with Python 3.7 and later, and copied once from the received chunks before.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self):
+        self.transport = None
+        self._data = bytearray()  # Received, not yet read
+        self._chunk = None  # Receive buffer when no read_into() is waiting
+        self._target = None  # memoryview filled by a waiting read_into()
+        self._filled = 0
+        self._eof = False
+        self._waiter = None
+        self._paused = False
+        self._drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._wake()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def eof_received(self):
+        self._eof = True
+        self._wake()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def get_buffer(self, sizehint):
+        if self._target is not None:
+            return self._target[self._filled:]
+        if self._chunk is None:
+            self._chunk = bytearray(self.chunk_size)
+        return self._chunk
+
+    def buffer_updated(self, nbytes):
+        if self._target is not None:
+            self._filled += nbytes
+        else:
+            self._data += memoryview(self._chunk)[:nbytes]
+        self._wake()
+
+    def data_received(self, data):  # Python < 3.7
+        if self._target is not None:
+            n = min(len(data), len(self._target) - self._filled)
+            self._target[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+        self._data += data
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self):
+        if self._eof:
+            raise HislipConnectionClosed("Short read. Connection closed.")
+        self._waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    async def read_into(self, view):
+        """
+        Fill the memoryview `view`.
+        """
+        n = min(len(self._data), len(view))
+        if n:
+            view[:n] = memoryview(self._data)[:n]
+            del self._data[:n]
+        self._target, self._filled = view, n
+        try:
+            while self._filled < len(view):
+                await self._wait()
+        finally:
+            self._target = None
+
+    async def read(self, size):
+        """
+        :return: up to `size` bytes, b"" at the end of the stream
+        """
+        while not self._data:
+            if self._eof:
+                return b""
+            await self._wait()
+        data = bytes(self._data[:size])
+        del self._data[:size]
+        return data
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise HislipConnectionClosed("Connection closed")
+        if self._paused:
+            self._drain_waiter = asyncio.get_event_loop().create_future()
+            await self._drain_waiter
+
+    def close(self):
+        self.transport.close()
+
+
+class _AsyncChannel(object):
+    copy_limit = 64 * 1024
+    tls_read_size = 256 * 1024
+
+    def __init__(self, stream):
+        """
+        :param _StreamProtocol stream:
+        """
+        self.stream = stream
+        self.service_requests = collections.deque()  # Status bytes of AsyncServiceRequest messages not yet collected
+        self.tls = None  # TLSEngine of an encrypted channel
+        self._plain = bytearray()  # Decrypted bytes not yet read
+
+    async def start_tls(self, context, server_hostname, session=None):
+        engine = TLSEngine(context, False, server_hostname, session)
+        while not engine.handshake():
+            self.stream.write(engine.data_to_send())
+            await self.stream.drain()
+            data = await self.stream.read(self.tls_read_size)
+            if not data:
+                raise HislipConnectionClosed("Connection closed during the TLS handshake")
+            engine.feed(data)
+        self.stream.write(engine.data_to_send())
+        self.tls = engine
+
+    def _write(self, data):
+        if self.tls is None:
+            self.stream.write(data)
+        else:
+            self.tls.write(data)
+            self.stream.write(self.tls.data_to_send())
+
+    async def send(self, message):
+        if message.payload_len <= self.copy_limit:
+            self._write(message.pack())
+        else:
+            self._write(message.pack_header())
+            self._write(message.payload)
+        await self.stream.drain()
+
+    async def read_into(self, view):
+        """
+        Fill the memoryview `view`, received or decrypted into it without another copy.
+        """
+        if self.tls is None:
+            await self.stream.read_into(view)
+            return
+        pos = min(len(self._plain), len(view))
+        if pos:
+            view[:pos] = memoryview(self._plain)[:pos]
+            del self._plain[:pos]
+        while pos < len(view):
+            n = self.tls.read(len(view) - pos, view[pos:])
+            if self.tls.wants_write:
+                self.stream.write(self.tls.data_to_send())
+            if n is None:
+                data = await self.stream.read(self.tls_read_size)
+                if not data:
+                    raise HislipConnectionClosed("Short read. Connection closed.")
+                self.tls.feed(data)
+            elif n:
+                pos += n
+            else:
+                raise HislipConnectionClosed("Short read. Connection closed.")
+
+    async def read_exactly(self, size):
+        buf = bytearray(size)
+        await self.read_into(memoryview(buf))
+        return bytes(buf)
+
+    async def read_header(self):
+        data = await self.read_exactly(Message._struct_hdr.size)
+        hdr = Message._msg_tuple._make(Message._struct_hdr.unpack(data))
+        if hdr.prologue != Message.prologue:
+            raise HislipProtocolError("Invalid message prologue")
+        return hdr
+
+    async def receive(self, expected=None):
+        while True:
+            hdr = await self.read_header()
+            msg = _make(Message.Type(hdr.type), hdr.ctrl_code, hdr.param, await self.read_exactly(hdr.payload_len))
+            if msg.type != Message.Type.AsyncServiceRequest or expected == msg.type:
+                break
+            self.service_requests.append(msg.ctrl_code)  # Sent by the server at any time
+        if msg.type == Message.Type.FatalError or msg.type == Message.Type.Error:
+            raise HislipError("Server error %i: %r" % (msg.ctrl_code, msg.payload))
+        if expected is not None and msg.type != expected:
+            raise HislipProtocolError("Expected %s, got %s" % (expected, msg.type))
+        return msg
+
+    def close(self):
+        self.stream.close()
+
+
+async def tcp_connect(address, timeout):
+    """
+    :return: a connected :class:`_StreamProtocol`
+    """
+    loop = asyncio.get_event_loop()
+    transport, stream = await asyncio.wait_for(loop.create_connection(_StreamProtocol, *address), timeout)
+    return stream
+
+
+class AsyncHislipClientConnection(object):
+    """
+    asyncio version of :class:`HislipClientConnection`.
+
+    The sync and async channel can be used concurrently, e.g. status queries while a
+    long running query is outstanding. Operations on the same channel must not overlap.
+    """
+    def __init__(self, host, sub_address=b"hislip0", port=HISLIP_PORT, timeout=None,
+                 max_message_size=1 << 20, max_write_size=None, vendor_id=b"PY", connect=tcp_connect,
+                 ssl_context=None, server_hostname=None, tls_sessions=None):
+        self.address = (host, port)
+        self.sub_address = sub_address
+        self.timeout = timeout
+        self.max_message_size = max_message_size
+        self.max_write_size = max_write_size
+        self.vendor_id = vendor_id
+        self._connect = connect
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or host
+        self.tls_sessions = tls_sessions
+
+        self.session_id = None
+        self.overlap_mode = None
+        self.server_protocol_version = None
+        self.server_vendor_id = None
+        self.server_max_message_size = None
+
+        self.message_id = FIRST_MESSAGE_ID
+        self.last_message_id = None
+        self.pending_response = False
+        self._rmt = False
+        self._buf = bytearray(4096)
+        self.sync_channel = None
+        self.async_channel = None
+
+    @property
+    def is_open(self):
+        return self.sync_channel is not None
+
+    async def open(self):
+        self.sync_channel = _AsyncChannel(await self._connect(self.address, self.timeout))
+        try:
+            init = MessageInitialize()
+            init.client_protocol_version = PROTOCOL_VERSION if self.ssl_context is None else TLS_PROTOCOL_VERSION
+            init.client_vendor_id = self.vendor_id
+            init.sub_address = self.sub_address
+            await self.sync_channel.send(init)
+            response = await self.sync_channel.receive(Message.Type.InitializeResponse)
+            self.session_id = response.session_id
+            self.overlap_mode = response.overlap_mode
+            self.server_protocol_version = response.server_protocol_version
+
+            self.async_channel = _AsyncChannel(await self._connect(self.address, self.timeout))
+            async_init = MessageAsyncInitialize()
+            async_init.session_id = self.session_id
+            await self.async_channel.send(async_init)
+            response = await self.async_channel.receive(Message.Type.AsyncInitializeResponse)
+            self.server_vendor_id = response.server_vendor_id
+
+            size = MessageAsyncMaximumMessageSize()
+            size.max_size = self.max_message_size
+            await self.async_channel.send(size)
+            response = await self.async_channel.receive(Message.Type.AsyncMaximumMessageSizeResponse)
+            self.server_max_message_size = response.max_size
+
+            if self.ssl_context is not None:
+                await self.start_tls()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    async def start_tls(self):
+        """
+        Encrypt both channels, see :meth:`HislipClientConnection.start_tls`.
+        """
+        if self.server_protocol_version < b"\x02\x00":
+            raise HislipError("The server doesn't support encryption, HiSLIP %i.%i" %
+                              tuple(self.server_protocol_version))
+        if self.tls_sessions is None:
+            self.tls_sessions = default_session_cache
+        session = self.tls_sessions.get(self.address, self.ssl_context)
+        last_message_id = (self.message_id - 2) & 0xffffffff
+
+        msg = MessageAsyncStartTLS()
+        msg.message_id = last_message_id
+        await self.async_channel.send(msg)
+        response = await self.async_channel.receive(Message.Type.AsyncStartTLSResponse)
+        if response.ctrl_code != START_TLS_SUCCESS:
+            raise HislipError("The server refused AsyncStartTLS")
+        await self.async_channel.start_tls(self.ssl_context, self.server_hostname, session)
+
+        msg = MessageStartTLS()
+        msg.message_id = last_message_id
+        await self.sync_channel.send(msg)
+        await self.sync_channel.start_tls(self.ssl_context, self.server_hostname, session)
+
+    @property
+    def tls_session_reused(self):
+        tls = self.sync_channel.tls
+        return tls is not None and tls.session_reused
+
+    def close(self):
+        if self.tls_sessions is not None and self.sync_channel is not None and self.sync_channel.tls is not None:
+            self.tls_sessions.put(self.address, self.ssl_context, self.sync_channel.tls.session)
+        for ch in (self.sync_channel, self.async_channel):
+            if ch is not None:
+                ch.close()
+        self.sync_channel = self.async_channel = None
+
+    async def __aenter__(self):
+        if not self.is_open:
+            await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _next_data_message(self, cls):
+        msg = cls()
+        msg.message_id = self.message_id
+        if self._rmt:
+            msg.RMT = True
+            self._rmt = False
+        self.last_message_id = self.message_id
+        self.message_id = next_message_id(self.message_id)
+        return msg
+
+    def write_fragment_size(self, size):
+        limit = min(x for x in (self.server_max_message_size, self.max_write_size, size + Message._struct_hdr.size)
+                    if x is not None)
+        return max(int(limit) - Message._struct_hdr.size, 1)
+
+    async def write(self, data, end=True):
+        data = byte_view(data)
+        fragment = self.write_fragment_size(len(data))
+        offset = 0
+        while len(data) - offset > (fragment if end else 0):
+            msg = self._next_data_message(MessageData)
+            msg.payload = data[offset:offset + fragment]
+            await self.sync_channel.send(msg)
+            offset += fragment
+        if end:
+            msg = self._next_data_message(MessageDataEnd)
+            msg.payload = data[offset:]
+            await self.sync_channel.send(msg)
+            self.pending_response = True
+
+    async def read(self, into=None):
+        """
+        Read a complete response, see :meth:`HislipClientConnection.read`.
+        """
+        buf = self._buf if into is None else into
+        size = 0
+        while True:
+            hdr = await self.sync_channel.read_header()
+            if hdr.type not in (Message.Type.Data, Message.Type.DataEnd):
+                payload = await self.sync_channel.read_exactly(hdr.payload_len)
+                if hdr.type in (Message.Type.Error, Message.Type.FatalError):
+                    raise HislipError("Server error %i: %r" % (hdr.ctrl_code, payload))
+                continue
+            if size + hdr.payload_len > len(buf):
+                if into is not None:
+                    raise HislipError("Response does not fit in the supplied buffer")
+                # A new buffer, views returned by earlier reads may still be alive
+                grown = bytearray(max(size + hdr.payload_len, 2 * len(buf)))
+                grown[:size] = buf[:size]
+                buf = self._buf = grown
+            await self.sync_channel.read_into(memoryview(buf)[size:size + hdr.payload_len])
+            size += hdr.payload_len
+            if hdr.type == Message.Type.DataEnd:
+                break
+        self.pending_response = False
+        self._rmt = True
+        return memoryview(buf)[:size]
+
+    async def query(self, data, into=None):
+        await self.write(data)
+        return await self.read(into)
+
+    async def trigger(self):
+        await self.sync_channel.send(self._next_data_message(MessageTrigger))
+
+    async def status_query(self):
+        msg = MessageAsyncStatusQuery()
+        msg.message_id = self.last_message_id if self.last_message_id is not None else FIRST_MESSAGE_ID
+        if self._rmt:
+            msg.RMT = True
+        await self.async_channel.send(msg)
+        return (await self.async_channel.receive(Message.Type.AsyncStatusResponse)).ctrl_code
+
+    async def wait_service_request(self):
+        """
+        Wait for an AsyncServiceRequest from the server.
+
+        :return: the status byte sent with the request
+        """
+        if self.async_channel.service_requests:
+            return self.async_channel.service_requests.popleft()
+        return (await self.async_channel.receive(Message.Type.AsyncServiceRequest)).ctrl_code
+
+    async def device_clear(self):
+        await self.async_channel.send(_make(Message.Type.AsyncDeviceClear))
+        ack = await self.async_channel.receive(Message.Type.AsyncDeviceClearAcknowledge)
+        await self.sync_channel.send(_make(Message.Type.DeviceClearComplete, ctrl_code=ack.ctrl_code & 1))
+        await self.sync_channel.receive(Message.Type.DeviceClearAcknowledge)
+        self.message_id = FIRST_MESSAGE_ID
+        self.pending_response = False
+        self._rmt = False
+
+    async def lock(self, timeout=0, shared_name=b""):
+        msg = MessageAsyncLock()
+        msg.ctrl_code = 1
+        msg.param = int(timeout)
+        msg.payload = shared_name
+        await self.async_channel.send(msg)
+        return bool((await self.async_channel.receive(Message.Type.AsyncLockResponse)).ctrl_code)
+
+    async def unlock(self):
+        msg = MessageAsyncLock()
+        msg.ctrl_code = 0
+        msg.param = self.last_message_id or 0
+        await self.async_channel.send(msg)
+        return bool((await self.async_channel.receive(Message.Type.AsyncLockResponse)).ctrl_code)
+
+
+class AsyncHislipClientPool(object):
+    """
+    asyncio version of :class:`hislip_server.client.HislipClientPool`.
+    """
+    def __init__(self, max_idle=4, idle_timeout=60.0, **connection_kwargs):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connection_kwargs = connection_kwargs
+        self._idle = collections.defaultdict(list)
+        self.created = 0
+        self.reused = 0
+
+    async def acquire(self, host, sub_address=b"hislip0", port=HISLIP_PORT):
+        idle = self._idle[(host, port, sub_address)]
+        now = time.time()
+        while idle:
+            released, conn = idle.pop()
+            if now - released <= self.idle_timeout:
+                self.reused += 1
+                return conn
+            conn.close()
+        self.created += 1
+        return await AsyncHislipClientConnection(host, sub_address, port, **self.connection_kwargs).open()
+
+    def release(self, conn):
+        if not conn.is_open or conn.pending_response:
+            conn.close()
+            return
+        idle = self._idle[(conn.address[0], conn.address[1], conn.sub_address)]
+        if len(idle) < self.max_idle:
+            idle.append((time.time(), conn))
+        else:
+            conn.close()
+
+    def close(self):
+        idle, self._idle = self._idle, collections.defaultdict(list)
+        for conns in idle.values():
+            for _, conn in conns:
+                conn.close()
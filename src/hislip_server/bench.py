@@ -0,0 +1,759 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the protocol hot paths, running entirely on localhost.
+
+The suite covers
+
+* ``codec``: :meth:`Message.pack` and :meth:`Message.parse` of small and large messages
+* ``query``: ``*IDN?`` round trip latency (DataEnd => DataEnd)
+* ``status``: AsyncStatusQuery round trip latency
+* ``upload`` / ``download``: bulk throughput for a range of transfer and fragment sizes
+* ``scaling``: query rate and latency with many concurrent sessions
+* ``coalesce``: many sessions polling the same slow measurement, with and without coalescing of
+  identical queries, reporting the number of backend executions
+* ``tls``: bulk throughput and connection setup with HiSLIP 2.0 encryption compared with plain text,
+  using a self-signed certificate made with ``openssl``; setup is measured with full and resumed
+  TLS handshakes
+* ``scpi``: SCPI header resolution with and without the resolution cache, for growing command trees
+* ``ascii``: NumPy formatting and parsing of ASCII number lists, compared with per-number Python code
+* ``startup``: import time of :mod:`hislip_server.hislip_server` in a new interpreter, and the time from
+  starting ``hislip-server serve`` to the first initialized session, checked against
+  :data:`IMPORT_BUDGET` and :data:`FIRST_CONNECTION_BUDGET`
+
+Results are collected as a list of dicts and written as JSON, so the output of two
+releases can be compared with ``--compare``::
+
+    python -m hislip_server.bench --quick -o new.json --compare old.json
+
+By default the benchmarks run against an embedded :class:`BenchmarkServer`. With
+``--connect host:port`` they run against an already running server, which must
+answer the ``DOWN? <n>`` and ``UPL?`` benchmark commands like :class:`BenchmarkServer`.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import hislip_server
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import tcp_connect
+from hislip_server.client import unix_connect
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import HislipServer
+from hislip_server.hislip_server import HislipUnixServer
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageDataEnd
+from hislip_server.replay import clock
+from hislip_server.replay import percentile
+
+logger = logging.getLogger(__name__)
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+GROUPS = ("codec", "scpi", "ascii", "query", "status", "bulk", "scaling", "coalesce", "tls", "startup")
+LOCAL_GROUPS = ("codec", "scpi", "ascii", "coalesce", "tls", "startup")  # Not using the target server
+
+BULK_SIZES = (KiB, 16 * KiB, 256 * KiB, 4 * MiB, 64 * MiB, GiB)
+FRAGMENT_SIZES = (64 * KiB, MiB, 16 * MiB)
+SESSION_COUNTS = (1, 10, 100, 1000)
+FAN_IN_COUNTS = (10, 50, 200)
+
+QUICK_BULK_SIZES = (KiB, 256 * KiB, 4 * MiB)
+QUICK_FRAGMENT_SIZES = (64 * KiB, MiB)
+QUICK_SESSION_COUNTS = (1, 10, 50)
+QUICK_FAN_IN_COUNTS = (10, 50)
+TLS_SIZES = (16 * KiB, MiB, 64 * MiB)
+QUICK_TLS_SIZES = (16 * KiB, 4 * MiB)
+
+# Seconds, median with cached bytecode. Servers are started by test fixtures and on instruments with
+# slow storage, keep these when adding features: import optional dependencies where they are used.
+IMPORT_BUDGET = 0.1
+FIRST_CONNECTION_BUDGET = 0.5
+
+_IMPORT_SCRIPT = """
+import time
+t0 = time.time()
+import hislip_server.hislip_server
+print(time.time() - t0)
+"""
+
+
+class BenchmarkServer(HislipServer):
+    """
+    HislipServer answering the commands used by the benchmarks.
+
+    * ``*IDN?`` returns a short identification string
+    * ``DOWN? <n>`` returns n bytes
+    * a program message ending with ``UPL?`` returns the length of the program message
+    * ``MEAS?`` takes :attr:`measurement_time` on an instrument which can run one measurement at a time
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    idn = b"hislip-server,benchmark,0,%s\n" % hislip_server.__version__.encode("ascii")
+    measurement_time = 0.001
+
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkServer, self).__init__(*args, **kwargs)
+        self._download = bytearray()
+        self._download_lock = threading.Lock()
+        self._measurement_lock = threading.Lock()
+        self.measurements = 0
+
+    def measure(self):
+        with self._measurement_lock:
+            self.measurements += 1
+            time.sleep(self.measurement_time)
+            return b"%i\n" % self.measurements
+
+    def download_data(self, size):
+        with self._download_lock:
+            if len(self._download) < size:
+                self._download = bytearray(b"\x55") * size
+            return memoryview(self._download)[:size]
+
+    def data_received(self, client, data):
+        if data.startswith(b"*IDN?"):
+            return self.idn
+        if data.startswith(b"MEAS?"):
+            return self.measure()
+        if data.startswith(b"DOWN? "):
+            return self.download_data(int(data[6:]))
+        if data.endswith(b"UPL?\n"):
+            return str(len(data)).encode("ascii")
+        return None
+
+
+class EmbeddedServer(object):
+    """
+    Runs a server in a background thread, for use as a context manager.
+    """
+    def __init__(self, server_cls=BenchmarkServer, handler_cls=HislipHandler, address=("127.0.0.1", 0), server=None):
+        self.server = server if server is not None else server_cls(address, handler_cls)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Target(object):
+    """
+    Where the benchmark sessions connect: a TCP address, a Unix socket or a server reached through the
+    loopback transport.
+    """
+    def __init__(self, address, connect=tcp_connect, shared_memory=None, **connection_kwargs):
+        """
+        :param shared_memory: ring size for shared memory bulk transfers, None disables them
+        :param connection_kwargs: passed to HislipClientConnection, e.g. ssl_context
+        """
+        self.address = address
+        self.connect = connect
+        self.shared_memory = shared_memory
+        self.connection_kwargs = connection_kwargs
+
+    def open_session(self, fragment=None):
+        kwargs = dict(self.connection_kwargs)
+        if fragment is not None:
+            kwargs.update(max_message_size=fragment + 16, max_write_size=fragment + 16)
+        conn = HislipClientConnection(self.address[0], port=self.address[1], connect=self.connect, **kwargs).open()
+        if self.shared_memory and not conn.enable_shared_memory(self.shared_memory if fragment else 1 << 20):
+            raise HislipError("Shared memory was refused by the server")
+        return conn
+
+
+TRANSPORTS = ("tcp", "unix", "shm", "loopback")
+
+
+def embedded_target(transport="tcp", shared_memory=64 * MiB):
+    """
+    Start an embedded BenchmarkServer reachable through `transport`.
+
+    * tcp: TCP on 127.0.0.1
+    * unix: a HislipUnixServer
+    * shm: a HislipUnixServer, with shared memory bulk transfers
+    * loopback: in-process, without sockets
+
+    :return: (Target, callable stopping the server)
+    """
+    if transport == "loopback":
+        from hislip_server.loopback import LoopbackTransport
+
+        server = BenchmarkServer(("loopback", 0), HislipHandler, bind_and_activate=False)
+        return Target(("loopback", 0), LoopbackTransport(server).connect), server.server_close
+    tcp = EmbeddedServer().__enter__()
+    if transport == "tcp":
+        return Target(tcp.address), tcp.__exit__
+    if transport not in ("unix", "shm"):
+        raise ValueError("Unknown transport %r" % transport)
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp(prefix="hislip-bench-")
+    local = EmbeddedServer(server=HislipUnixServer(os.path.join(tmpdir, "hislip.sock"), HislipHandler, tcp.server))
+    local.server.daemon_threads = True
+    local.__enter__()
+
+    def stop():
+        local.__exit__()
+        tcp.__exit__()
+        os.rmdir(tmpdir)
+    return Target((local.address, 0), unix_connect, shared_memory if transport == "shm" else None), stop
+
+
+def summarize(name, params, times, size=None):
+    """
+    Build a result entry from a list of durations in seconds.
+
+    :param size: bytes moved per sample, used to calculate the throughput
+    """
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    result = {
+        "name": name,
+        "params": params,
+        "samples": len(times),
+        "mean": mean,
+        "min": times[0],
+        "p50": percentile(times, 50),
+        "p99": percentile(times, 99),
+        "ops_per_s": 1 / mean if mean else float("inf"),
+    }
+    if size is not None:
+        result["bytes_per_s"] = size / result["p50"] if result["p50"] else float("inf")
+    return result
+
+
+def _time_loop(fn, count):
+    t0 = clock()
+    for _ in range(count):
+        fn()
+    return (clock() - t0) / count
+
+
+def bench_codec(quick=False):
+    results = []
+    loops = 2000 if quick else 20000
+    for size in (0, KiB, MiB):
+        msg = MessageDataEnd()
+        msg.message_id = 0xffffff00
+        msg.payload = b"\x55" * size
+        n = max(loops // (1 + size // KiB), 10)
+        times = [_time_loop(msg.pack, n) for _ in range(5)]
+        results.append(summarize("codec.pack", {"payload": size}, times, size + 16))
+
+        data = msg.pack()
+        fd = io.BytesIO(data)
+
+        def parse():
+            fd.seek(0)
+            Message.parse(fd)
+        times = [_time_loop(parse, n) for _ in range(5)]
+        results.append(summarize("codec.parse", {"payload": size}, times, size + 16))
+    return results
+
+
+def _letters(i):
+    return "".join("ABCDEFGHIJ"[int(d)] for d in str(i))
+
+
+def bench_scpi(quick=False):
+    from hislip_server.scpi import SCPICommand
+    from hislip_server.scpi import SCPICommandTree
+
+    results = []
+    loops = 2000 if quick else 20000
+    for count in (10, 1000) if quick else (10, 1000, 10000):
+        for cache_size in (0, 1024):
+            tree = SCPICommandTree(cache_size)
+            for i in range(count):
+                tree.register(SCPICommand("[SENSe1]:GRP%s:CMD%s<n>:VALue" % (_letters(i // 100), _letters(i % 100))))
+            header = ("SENS2:GRP%s:CMD%s3:VAL" % (_letters((count - 1) // 100), _letters((count - 1) % 100))).encode("ascii")
+            tree.resolve(header)  # Compile the tree
+            times = [_time_loop(lambda: tree.resolve(header), loops) for _ in range(5)]
+            results.append(summarize("scpi.resolve", {"commands": count, "cache": cache_size}, times))
+    return results
+
+
+def bench_ascii(quick=False):
+    try:
+        import numpy
+    except ImportError:
+        logger.warning("NumPy is not installed, skipping the ascii benchmarks")
+        return []
+    from hislip_server.scpi import decode_ascii
+    from hislip_server.scpi import encode_ascii
+    from hislip_server.scpi import encode_ascii_naive
+
+    def decode_naive(text):
+        return numpy.array([float(x) for x in text.split(b",")])
+
+    results = []
+    points = 100000 if quick else 1000000
+    values = numpy.random.RandomState(0).standard_normal(points) * 1e3
+    for number_format, precision in (("NR1", 0), ("NR2", 3), ("NR3", 6)):
+        params = {"format": number_format, "points": points}
+        for impl, encode in (("numpy", encode_ascii), ("naive", encode_ascii_naive)):
+            times = [_time_loop(lambda: encode(values, number_format, precision), 1) for _ in range(3)]
+            results.append(summarize("ascii.encode", dict(params, impl=impl), times))
+        text = encode_ascii(values, number_format, precision)
+        for impl, decode in (("numpy", decode_ascii), ("naive", decode_naive)):
+            times = [_time_loop(lambda: decode(text), 1) for _ in range(3)]
+            results.append(summarize("ascii.decode", dict(params, impl=impl), times, len(text)))
+    return results
+
+
+def bench_query(target, quick=False):
+    count = 500 if quick else 5000
+    session = target.open_session()
+    try:
+        times = []
+        for _ in range(count):
+            t0 = clock()
+            session.query(b"*IDN?\n")
+            times.append(clock() - t0)
+    finally:
+        session.close()
+    return [summarize("query.idn", {}, times)]
+
+
+def bench_status(target, quick=False):
+    count = 500 if quick else 5000
+    session = target.open_session()
+    try:
+        times = []
+        for _ in range(count):
+            t0 = clock()
+            session.status_query()
+            times.append(clock() - t0)
+    finally:
+        session.close()
+    return [summarize("query.status", {}, times)]
+
+
+def _repeats(size):
+    return max(3, min(50, (64 * MiB) // size))
+
+
+def bench_bulk(target, sizes, fragments):
+    results = []
+    data = bytearray(b"\xaa") * max(sizes)
+    for fragment in fragments:
+        session = target.open_session(fragment)
+        try:
+            for size in sizes:
+                if fragment > size and fragment != min(fragments):
+                    continue  # Only one entry for transfers smaller than the fragment size
+                params = {"size": size, "fragment": fragment}
+                payload = memoryview(data)[:size - 5]
+                times = []
+                for _ in range(_repeats(size)):
+                    t0 = clock()
+                    session.write(payload, end=False)
+                    session.query(b"UPL?\n")
+                    times.append(clock() - t0)
+                results.append(summarize("bulk.upload", params, times, size))
+
+                times = []
+                command = b"DOWN? %i\n" % size
+                for _ in range(_repeats(size)):
+                    t0 = clock()
+                    received = len(session.query(command))
+                    times.append(clock() - t0)
+                    assert received == size
+                results.append(summarize("bulk.download", params, times, size))
+        finally:
+            session.close()
+    return results
+
+
+def _raise_fd_limit(sessions):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = sessions * 4 + 64  # Client and server side of both channels
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def bench_scaling(target, session_counts, quick=False):
+    results = []
+    queries = 20 if quick else 100
+    for count in session_counts:
+        _raise_fd_limit(count)
+        sessions = [target.open_session() for _ in range(count)]
+        start = threading.Event()
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(session):
+            times = []
+            start.wait()
+            for _ in range(queries):
+                t0 = clock()
+                session.query(b"*IDN?\n")
+                times.append(clock() - t0)
+            with lock:
+                latencies.extend(times)
+
+        threads = [threading.Thread(target=worker, args=(s,)) for s in sessions]
+        for t in threads:
+            t.start()
+        t0 = clock()
+        start.set()
+        for t in threads:
+            t.join()
+        elapsed = clock() - t0
+        for s in sessions:
+            s.close()
+        result = summarize("scaling.query", {"sessions": count}, latencies)
+        result["ops_per_s"] = len(latencies) / elapsed
+        results.append(result)
+    return results
+
+
+def bench_coalesce(fan_in_counts, quick=False):
+    """
+    Sessions querying ``MEAS?`` of an embedded BenchmarkServer all at the same time.
+    """
+    results = []
+    queries = 5 if quick else 20
+    for count in fan_in_counts:
+        _raise_fd_limit(count)
+        for coalesce in (False, True):
+            with EmbeddedServer() as embedded:
+                embedded.server.coalesce_queries = coalesce
+                target = Target(embedded.address)
+                sessions = [target.open_session() for _ in range(count)]
+                barrier = [threading.Event() for _ in range(queries)]
+                latencies = []
+                lock = threading.Lock()
+                arrived = [0] * queries
+
+                def worker(session):
+                    times = []
+                    for i in range(queries):
+                        with lock:  # Start each round when all sessions are ready
+                            arrived[i] += 1
+                            if arrived[i] == count:
+                                barrier[i].set()
+                        barrier[i].wait()
+                        t0 = clock()
+                        session.query(b"MEAS?\n")
+                        times.append(clock() - t0)
+                    with lock:
+                        latencies.extend(times)
+
+                threads = [threading.Thread(target=worker, args=(s,)) for s in sessions]
+                t0 = clock()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = clock() - t0
+                for s in sessions:
+                    s.close()
+                result = summarize("coalesce.query", {"sessions": count, "coalesce": coalesce}, latencies)
+                result["ops_per_s"] = len(latencies) / elapsed
+                result["backend_calls"] = embedded.server.measurements
+                results.append(result)
+    return results
+
+
+def bench_tls(sizes, quick=False):
+    """
+    Bulk transfers and connection setup of an embedded BenchmarkServer with and without TLS.
+    """
+    import shutil
+    import ssl
+    import tempfile
+    from hislip_server.tls import TLSSessionCache
+    from hislip_server.tls import self_signed_certificate
+    from hislip_server.tls import server_context
+
+    tmpdir = tempfile.mkdtemp(prefix="hislip-bench-")
+    try:
+        try:
+            if not hasattr(ssl, "MemoryBIO"):
+                raise HislipError("TLS requires Python 3.6 or later")
+            certfile, keyfile = self_signed_certificate(tmpdir)
+        except HislipError as e:
+            logger.warning("Skipping the tls benchmarks: %s", e)
+            return []
+        results = []
+        connects = 20 if quick else 200
+        with EmbeddedServer() as embedded:
+            embedded.server.ssl_context = server_context(certfile, keyfile)
+            client_context = ssl.create_default_context(cafile=certfile)
+            for encrypted in (False, True):
+                kwargs = {"ssl_context": client_context, "server_hostname": "localhost"} if encrypted else {}
+                target = Target(embedded.address, tls_sessions=TLSSessionCache(), **kwargs)
+                session = target.open_session(MiB)
+                try:
+                    for size in sizes:
+                        params = {"size": size, "tls": encrypted}
+                        payload = memoryview(bytearray(b"\xaa") * (size - 5))
+                        times = []
+                        for _ in range(_repeats(size)):
+                            t0 = clock()
+                            session.write(payload, end=False)
+                            session.query(b"UPL?\n")
+                            times.append(clock() - t0)
+                        results.append(summarize("tls.upload", params, times, size))
+
+                        times = []
+                        command = b"DOWN? %i\n" % size
+                        for _ in range(_repeats(size)):
+                            t0 = clock()
+                            session.query(command)
+                            times.append(clock() - t0)
+                        results.append(summarize("tls.download", params, times, size))
+                finally:
+                    session.close()
+
+                for resume in ((False, True) if encrypted else (False,)):
+                    times = []
+                    for _ in range(connects):
+                        if not resume:
+                            target.connection_kwargs["tls_sessions"] = TLSSessionCache()
+                        t0 = clock()
+                        session = target.open_session()
+                        session.query(b"*IDN?\n")
+                        times.append(clock() - t0)
+                        session.close()
+                    handshake = ("resumed" if resume else "full") if encrypted else "none"
+                    results.append(summarize("tls.connect", {"handshake": handshake}, times))
+        return results
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _first_connection(port, timeout=10.0):
+    """
+    :return: seconds from starting ``hislip-server serve`` to the first initialized session
+    """
+    import subprocess
+
+    with open(os.devnull, "wb") as devnull:
+        t0 = clock()
+        process = subprocess.Popen([sys.executable, "-m", "hislip_server", "serve", "--log-level", "WARNING",
+                                    "--listen", "127.0.0.1:%i" % port], stdout=devnull, stderr=devnull)
+        try:
+            while True:
+                try:
+                    HislipClientConnection("127.0.0.1", port=port, timeout=timeout).open().close()
+                    return clock() - t0
+                except socket.error:
+                    if process.poll() is not None or clock() - t0 > timeout:
+                        raise HislipError("hislip-server serve didn't accept a session")
+                    time.sleep(0.001)
+        finally:
+            if process.poll() is None:
+                process.kill()  # Only the startup is measured
+            process.wait()
+
+
+def bench_startup(quick=False):
+    """
+    Import time and time to the first session of new server processes, see :data:`IMPORT_BUDGET`.
+    """
+    import subprocess
+
+    samples = 5 if quick else 20
+    subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT])  # Compile the bytecode first
+    times = [float(subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT])) for _ in range(samples)]
+    result = summarize("startup.import", {}, times)
+    result["budget"] = IMPORT_BUDGET
+    results = [result]
+
+    times = [_first_connection(_free_port()) for _ in range(samples)]
+    result = summarize("startup.connect", {"command": "serve"}, times)
+    result["budget"] = FIRST_CONNECTION_BUDGET
+    return results + [result]
+
+
+def metadata():
+    import platform
+
+    return {
+        "version": hislip_server.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run_suite(address=None, quick=False, only=None, max_size=None, session_counts=None, transport="tcp"):
+    """
+    Run the benchmark suite.
+
+    :param address: (host, port) of a running server, or None to use an embedded BenchmarkServer
+    :param transport: "tcp", or for the embedded server "unix", "shm" or "loopback", see :func:`embedded_target`
+    :param bool quick: use smaller sizes and fewer iterations
+    :param only: list of benchmark groups to run, default all
+    :param max_size: largest bulk transfer size in bytes
+    :param session_counts: concurrent session counts for the scaling benchmark
+    :return: dict with "meta" and "results"
+    """
+    groups = only or GROUPS
+    sizes = QUICK_BULK_SIZES if quick else BULK_SIZES
+    if max_size is not None:
+        sizes = tuple(s for s in sizes if s <= max_size) or (max_size,)
+    fragments = QUICK_FRAGMENT_SIZES if quick else FRAGMENT_SIZES
+    session_counts = session_counts or (QUICK_SESSION_COUNTS if quick else SESSION_COUNTS)
+
+    stop = None
+    target = Target(address)
+    if address is None and set(groups) - set(LOCAL_GROUPS):
+        target, stop = embedded_target(transport, min(2 * max(sizes), GiB))
+    elif address is not None and transport != "tcp":
+        raise ValueError("The %s transport can only be used with the embedded server" % transport)
+    results = []
+    try:
+        for group in groups:
+            logger.info("Running %s benchmarks", group)
+            if group == "codec":
+                results += bench_codec(quick)
+            elif group == "scpi":
+                results += bench_scpi(quick)
+            elif group == "ascii":
+                results += bench_ascii(quick)
+            elif group == "query":
+                results += bench_query(target, quick)
+            elif group == "status":
+                results += bench_status(target, quick)
+            elif group == "bulk":
+                results += bench_bulk(target, sizes, fragments)
+            elif group == "scaling":
+                results += bench_scaling(target, session_counts, quick)
+            elif group == "coalesce":
+                results += bench_coalesce(QUICK_FAN_IN_COUNTS if quick else FAN_IN_COUNTS, quick)
+            elif group == "startup":
+                results += bench_startup(quick)
+            elif group == "tls":
+                tls_sizes = QUICK_TLS_SIZES if quick else TLS_SIZES
+                if max_size is not None:
+                    tls_sizes = tuple(s for s in tls_sizes if s <= max_size) or (max_size,)
+                results += bench_tls(tls_sizes, quick)
+            else:
+                raise ValueError("Unknown benchmark group %r" % group)
+    finally:
+        if stop is not None:
+            stop()
+    meta = metadata()
+    meta["transport"] = transport
+    return {"meta": meta, "results": results}
+
+
+def _key(result):
+    return result["name"], tuple(sorted(result["params"].items()))
+
+
+def compare(baseline, current):
+    """
+    Compare two result sets, returns lines with the relative change of the median time.
+    """
+    base = dict((_key(r), r) for r in baseline["results"])
+    lines = ["%-16s %-36s %12s %12s %8s" % ("benchmark", "params", "base p50", "new p50", "change")]
+    for r in current["results"]:
+        b = base.get(_key(r))
+        params = ",".join("%s=%s" % kv for kv in sorted(r["params"].items()))
+        if b is None:
+            lines.append("%-16s %-36s %12s %12.6f %8s" % (r["name"], params, "-", r["p50"], "new"))
+            continue
+        change = (r["p50"] - b["p50"]) / b["p50"] * 100 if b["p50"] else float("nan")
+        line = "%-16s %-36s %12.6f %12.6f %+7.1f%%" % (r["name"], params, b["p50"], r["p50"], change)
+        if "budget" in r and r["p50"] > r["budget"]:
+            line += "  over budget of %.6f" % r["budget"]
+        lines.append(line)
+    return lines
+
+
+def format_results(results):
+    lines = ["%-16s %-36s %8s %12s %12s %12s" % ("benchmark", "params", "samples", "p50 us", "p99 us", "MB/s")]
+    for r in results["results"]:
+        params = ",".join("%s=%s" % kv for kv in sorted(r["params"].items()))
+        rate = "%12.1f" % (r["bytes_per_s"] / 1e6) if "bytes_per_s" in r else "%12s" % "-"
+        line = "%-16s %-36s %8i %12.2f %12.2f %s" % (r["name"], params, r["samples"], r["p50"] * 1e6, r["p99"] * 1e6, rate)
+        if "backend_calls" in r:
+            line += "  backend calls: %i" % r["backend_calls"]
+        if "budget" in r:
+            line += "  budget: %i us%s" % (r["budget"] * 1e6, ", exceeded" if r["p50"] > r["budget"] else "")
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def add_arguments(parser):
+    parser.add_argument("--connect", metavar="HOST:PORT", type=parse_address,
+                        help="Benchmark a running server instead of an embedded one")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp",
+                        help="How to reach the embedded server: tcp, unix socket, unix socket with shared memory "
+                             "bulk transfers, or in-process loopback without sockets")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes and fewer iterations")
+    parser.add_argument("--only", action="append", choices=GROUPS,
+                        help="Run only this benchmark group, can be repeated")
+    parser.add_argument("--max-size", type=int, help="Largest bulk transfer in bytes")
+    parser.add_argument("--sessions", type=int, action="append", help="Concurrent session count, can be repeated")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare with the results in this JSON file")
+
+
+def run(args):
+    results = run_suite(args.connect, args.quick, args.only, args.max_size, args.sessions, args.transport)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        print()
+        print("\n".join(compare(baseline, results)))
+
+
+def main(args=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the HiSLIP server benchmark suite on localhost.")
+    add_arguments(parser)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    run(parser.parse_args(args=args))
+
+
+if __name__ == "__main__":
+    main()
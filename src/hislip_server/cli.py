@@ -13,15 +13,290 @@ Why does this file exist, and why not put this in __main__?
     there's no ``hislip_server.__main__`` in ``sys.modules``.
 
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
+
+Commands:
+
+* ``hislip-server serve``: serve an application, by default the simulated instrument
+* ``hislip-server proxy HOST``: multiplex many sessions onto a few sessions with an instrument
+* ``hislip-server bench``: run the localhost benchmark suite against an embedded or running server
+* ``hislip-server capture FILE``: serve like ``serve`` and record all sessions into FILE on exit;
+  ``hislip-server capture --decode FILE`` prints a recording
 """
+from __future__ import absolute_import, division, print_function, unicode_literals
+
 import argparse
+import importlib
+import logging
+import signal
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_APP = "hislip_server.simulator:SimulatorServer"
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+def load_class(spec):
+    """
+    :param str spec: "module:Class"
+    """
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError("%r is not module:Class" % spec)
+    return getattr(importlib.import_module(module), name)
+
+
+def add_server_arguments(parser, app=True, handoff=True):
+    from hislip_server.frontend import FRONT_ENDS
+    from hislip_server.frontend import parse_listen_address
+
+    parser.add_argument("-l", "--listen", metavar="ADDRESS", action="append", type=parse_listen_address,
+                        help="host:port, :port for all interfaces, or a Unix socket path; can be repeated, "
+                             "default :4880")
+    parser.add_argument("--front-end", choices=FRONT_ENDS, default="threaded",
+                        help="threaded: a thread per connection; selector, asyncio: an event loop reading all "
+                             "connections and a pool of workers handling the messages")
+    parser.add_argument("-w", "--workers", type=int, default=16, help="Worker threads of the event loop front-ends")
+    parser.add_argument("--max-message-size", type=int, metavar="BYTES",
+                        help="Largest message accepted from clients, default 500 MB")
+    if app:
+        parser.add_argument("--app", default=DEFAULT_APP, metavar="MODULE:CLASS",
+                            help="HislipServer subclass providing the application, default the simulated instrument")
+    parser.add_argument("--coalesce", action="store_true", help="Coalesce identical concurrent queries")
+    parser.add_argument("--certfile", help="Server certificate (PEM), enables HiSLIP 2.0 secure connections")
+    parser.add_argument("--keyfile", help="Private key of the certificate, if not in the certificate file")
+    parser.add_argument("--require-tls", action="store_true", help="Refuse clients which don't encrypt the session")
+    parser.add_argument("--trace", metavar="FILE", help="Record timing spans and write them as Chrome trace on exit")
+    parser.add_argument("--slow-budget", type=float, metavar="SECONDS",
+                        help="Report handlers running longer than this, with their stack")
+    if not handoff:
+        return
+    parser.add_argument("--handoff-socket", metavar="PATH",
+                        help="Hand the listeners and idle sessions over to a new process connecting to this Unix "
+                             "socket, then exit")
+    parser.add_argument("--take-over", metavar="PATH",
+                        help="Take over the listeners and idle sessions of the server waiting on this handoff socket, "
+                             "instead of listening")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, metavar="SECONDS",
+                        help="Time to hand over or finish the sessions after a handover")
+
+
+def create_front_end(args, handler_cls=None, server_cls=None, takeover=None, **server_kwargs):
+    """
+    Create the server and front-end configured by the arguments of :func:`add_server_arguments`.
+
+    :param server_cls: server class, default the one of the ``--app`` argument
+    :param Takeover takeover: listen on the sockets taken over from another process
+    :param server_kwargs: passed to the server class
+    """
+    from hislip_server.frontend import create_front_end
+    from hislip_server.hislip_server import HislipHandler
+
+    addresses = takeover.addresses if takeover is not None else args.listen or [("", 4880)]
+    tcp = [a for a in addresses if isinstance(a, tuple)]
+    if args.trace or args.slow_budget is not None:
+        from hislip_server.tracing import Tracer
+        from hislip_server.tracing import TracingHislipHandler
+
+        handler_cls = _combine(handler_cls, TracingHislipHandler)
+    server_cls = server_cls or load_class(args.app)
+    server = server_cls(tcp[0][:2] if tcp else ("", 0), handler_cls or HislipHandler, bind_and_activate=False,
+                        **server_kwargs)
+    if args.trace or args.slow_budget is not None:
+        server.tracer = Tracer(budget=args.slow_budget)
+    if args.max_message_size:
+        server.max_message_size = args.max_message_size
+    server.coalesce_queries = args.coalesce
+    if args.certfile:
+        from hislip_server.tls import server_context
+
+        server.ssl_context = server_context(args.certfile, args.keyfile)
+    server.require_tls = args.require_tls
+    if takeover is not None:
+        addresses = takeover.listeners(server)
+    return create_front_end(args.front_end, server, addresses, args.workers)
+
+
+def _combine(handler_cls, mixin):
+    if handler_cls is None:
+        return mixin
+    return type(str(handler_cls.__name__ + mixin.__name__), (handler_cls, mixin), {})
+
+
+def serve(front_end, takeover=None, handoff_socket=None, drain_timeout=30.0):
+    """
+    Serve until SIGINT or SIGTERM, or until another process took over.
+
+    :param Takeover takeover: receive the sessions of the process the listeners were taken over from
+    :param str handoff_socket: path of the Unix socket waiting for a new process to take over
+    """
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        stop.set()
+
+    previous = dict((signum, signal.signal(signum, on_signal)) for signum in (signal.SIGINT, signal.SIGTERM))
+    thread = threading.Thread(target=front_end.serve_forever, name="hislip-front-end")
+    thread.daemon = True
+    thread.start()
+    logger.info("%s serving %s on %s", type(front_end).__name__, type(front_end.server).__name__,
+                ", ".join(str(a) for a in front_end.addresses))
+    handoff = None
+    try:
+        if takeover is not None:
+            takeover.start(front_end)
+        if handoff_socket:
+            from hislip_server.handoff import HandoffServer
+
+            handoff = HandoffServer(front_end, handoff_socket, drain_timeout, on_done=stop.set)
+            handoff.start()
+        while not stop.wait(0.5) and thread.is_alive():
+            pass
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        if handoff is not None:
+            handoff.close()
+        front_end.shutdown()
+        front_end.server_close()
+        tracer = front_end.server.tracer
+        if tracer is not None:
+            tracer.close()
+
+
+def _write_trace(args, front_end):
+    tracer = front_end.server.tracer
+    if tracer is None:
+        return
+    print(tracer.format_summary())
+    if args.trace:
+        with open(args.trace, "w") as fd:
+            tracer.write_chrome_trace(fd)
+
+
+def _run_server(args, handler_cls=None, server_cls=None, prepare=None, **server_kwargs):
+    """
+    Create the front-end, taking over the listeners of another process with ``--take-over``, and serve.
+
+    :param prepare: called with the server before serving
+    :return: the front-end
+    """
+    takeover = None
+    if getattr(args, "take_over", None):
+        from hislip_server.handoff import Takeover
+
+        takeover = Takeover(args.take_over, sessions=args.front_end != "threaded")
+    front_end = create_front_end(args, handler_cls, server_cls, takeover, **server_kwargs)
+    if prepare is not None:
+        prepare(front_end.server)
+    serve(front_end, takeover, getattr(args, "handoff_socket", None), getattr(args, "drain_timeout", 30.0))
+    _write_trace(args, front_end)
+    return front_end
+
+
+def run_serve(args):
+    _run_server(args)
+
+
+def run_proxy(args):
+    from hislip_server.proxy import BackendPool
+    from hislip_server.proxy import ProxyHandler
+    from hislip_server.proxy import ProxyServer
+
+    backends = BackendPool(args.host, args.sub_address.encode("ascii"), args.port, args.backends, args.stb_max_age,
+                           timeout=args.timeout)
+    _run_server(args, ProxyHandler, ProxyServer, backends=backends)
+
+
+def run_bench(args):
+    from hislip_server import bench
+
+    bench.run(args)
+
+
+def format_recording(recordings):
+    """
+    :return: lines describing the messages of SessionRecording objects
+    """
+    from hislip_server.replay import CH_SYNC
+    from hislip_server.replay import TO_SERVER
+
+    lines = []
+    for index, rec in enumerate(recordings):
+        lines.append("Session %i, %i messages, %.3f s" % (index, len(rec.events), rec.duration))
+        start = rec.events[0].timestamp if rec.events else 0
+        for ev in rec.events:
+            msg = ev.message
+            lines.append("%10.6f %-5s %s %-28s ctrl=%i param=%#010x len=%i %r" % (
+                ev.timestamp - start, "sync" if ev.channel == CH_SYNC else "async",
+                "->" if ev.direction == TO_SERVER else "<-", msg.type.name, msg.ctrl_code, msg.param, msg.payload_len,
+                bytes(bytearray(msg.payload[:40]))))
+    return lines
+
+
+def run_capture(args):
+    from hislip_server.replay import RecordingHislipHandler
+    from hislip_server.replay import SessionRecorder
+    from hislip_server.replay import SessionRecording
+
+    if args.decode:
+        with open(args.file, "rb") as fd:
+            recordings = SessionRecording.load_all(fd)
+        print("\n".join(format_recording(recordings)))
+        return
+    recorder = SessionRecorder()
+    _run_server(args, RecordingHislipHandler, prepare=lambda server: setattr(server, "recorder", recorder))
+    with open(args.file, "wb") as fd:
+        recorder.save(fd)
+    logger.info("Recorded %i sessions into %s", len(recorder.sessions), args.file)
+
+
+def create_parser():
+    from hislip_server import bench
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--log-level", choices=LOG_LEVELS, default="INFO")
+
+    parser = argparse.ArgumentParser(prog="hislip-server", description="HiSLIP server.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    serve_parser = commands.add_parser("serve", parents=[common], help="Serve an application")
+    add_server_arguments(serve_parser)
+    serve_parser.set_defaults(run=run_serve)
+
+    proxy_parser = commands.add_parser("proxy", parents=[common],
+                                       help="Multiplex many sessions onto a few sessions with an instrument")
+    proxy_parser.add_argument("host", help="Instrument host name")
+    proxy_parser.add_argument("--port", type=int, default=4880, help="Instrument port")
+    proxy_parser.add_argument("--sub-address", default="hislip0", help="Instrument sub address")
+    proxy_parser.add_argument("--backends", type=int, default=2, help="Sessions opened with the instrument")
+    proxy_parser.add_argument("--stb-max-age", type=float, default=0.05, metavar="SECONDS",
+                              help="Answer status queries from a status byte up to this old")
+    proxy_parser.add_argument("--timeout", type=float, default=30.0, help="Instrument socket timeout in seconds")
+    add_server_arguments(proxy_parser, app=False, handoff=False)  # The locks stay with the backend sessions
+    proxy_parser.set_defaults(run=run_proxy)
 
+    bench_parser = commands.add_parser("bench", parents=[common], help="Run the benchmark suite")
+    bench.add_arguments(bench_parser)
+    bench_parser.set_defaults(run=run_bench)
 
-parser = argparse.ArgumentParser(description='Command description.')
-parser.add_argument('names', metavar='NAME', nargs=argparse.ZERO_OR_MORE,
-                    help="A name of something.")
+    capture_parser = commands.add_parser("capture", parents=[common], help="Serve and record all sessions")
+    capture_parser.add_argument("file", help="Recording written on exit, or read with --decode")
+    capture_parser.add_argument("--decode", action="store_true", help="Print the messages of a recording")
+    add_server_arguments(capture_parser)
+    capture_parser.set_defaults(run=run_capture)
+    return parser
 
 
 def main(args=None):
+    parser = create_parser()
+    if not (sys.argv[1:] if args is None else args):  # Python 2 argparse errors without a command
+        parser.print_help()
+        return 2
     args = parser.parse_args(args=args)
-    print(args.names)
+    logging.basicConfig(level=getattr(logging, args.log_level), stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    args.run(args)
+    return 0
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""
+A blocking HiSLIP client, and a pool keeping warm sessions for repeated use.
+
+The asyncio counterpart lives in :mod:`hislip_server.aio_client`.
+
+@author: Lukas Sandström
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+
+from hislip_server.hislip_server import HislipConnectionClosed
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipProtocolError
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageAsyncInitialize
+from hislip_server.hislip_server import MessageAsyncLock
+from hislip_server.hislip_server import MessageAsyncMaximumMessageSize
+from hislip_server.hislip_server import MessageAsyncStartTLS
+from hislip_server.hislip_server import MessageAsyncStatusQuery
+from hislip_server.hislip_server import MessageData
+from hislip_server.hislip_server import MessageDataEnd
+from hislip_server.hislip_server import MessageInitialize
+from hislip_server.hislip_server import MessageSharedMemoryData
+from hislip_server.hislip_server import MessageSharedMemoryDataEnd
+from hislip_server.hislip_server import MessageSharedMemoryRequest
+from hislip_server.hislip_server import MessageStartTLS
+from hislip_server.hislip_server import MessageTrigger
+from hislip_server.hislip_server import byte_view
+
+logger = logging.getLogger(__name__)
+
+HISLIP_PORT = 4880
+PROTOCOL_VERSION = 0x0100
+TLS_PROTOCOL_VERSION = 0x0200  # HiSLIP 2.0, secure connections
+FIRST_MESSAGE_ID = 0xffffff00
+
+
+def next_message_id(message_id):
+    return (message_id + 2) & 0xffffffff
+
+
+class _Channel(object):
+    """
+    One socket of a client connection. Implements read() so it can be passed to Message.parse().
+    """
+    copy_limit = 64 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._hdr = bytearray(Message._struct_hdr.size)
+        self.service_requests = deque()  # Status bytes of AsyncServiceRequest messages not yet collected
+
+    def send(self, message):
+        if message.payload_len <= self.copy_limit:
+            self.sock.sendall(message.pack())
+        else:
+            self.sock.sendall(message.pack_header())
+            self.sock.sendall(message.payload)
+
+    def read_into(self, view):
+        """
+        Fill the memoryview `view` from the socket.
+        """
+        pos, size = 0, len(view)
+        while pos < size:
+            n = self.sock.recv_into(view[pos:], size - pos)
+            if not n:
+                raise HislipConnectionClosed("Short read. Connection closed.")
+            pos += n
+
+    def read(self, size):
+        buf = bytearray(size)
+        self.read_into(memoryview(buf))
+        return bytes(buf)
+
+    def read_header(self):
+        """
+        :return: HiSLIP_message namedtuple (prologue, type, ctrl_code, param, payload_len)
+        """
+        self.read_into(memoryview(self._hdr))
+        hdr = Message._msg_tuple._make(Message._struct_hdr.unpack_from(self._hdr))
+        if hdr.prologue != Message.prologue:
+            raise HislipProtocolError("Invalid message prologue")
+        return hdr
+
+    def receive(self, expected=None):
+        msg = Message.parse(self)
+        while msg.type == Message.Type.AsyncServiceRequest and expected != msg.type:
+            self.service_requests.append(msg.ctrl_code)  # Sent by the server at any time
+            msg = Message.parse(self)
+        if msg.type == Message.Type.FatalError or msg.type == Message.Type.Error:
+            raise HislipError("Server error %i: %r" % (msg.ctrl_code, msg.payload))
+        if expected is not None and msg.type != expected:
+            raise HislipProtocolError("Expected %s, got %s" % (expected, msg.type))
+        return msg
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def tcp_connect(address, timeout):
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def unix_connect(address, timeout):
+    """
+    Connect to a HislipUnixServer, the host part of `address` is the socket path::
+
+        HislipClientConnection("/run/hislip.sock", connect=unix_connect)
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address[0])
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+class HislipClientConnection(object):
+    """
+    A HiSLIP client session, i.e. a connected pair of sync and async channels.
+
+    Responses are read into a buffer owned by the connection and returned as a memoryview,
+    which is only valid until the next call to :meth:`read`. Copy the data (``view.tobytes()``)
+    if it has to be kept, or pass a buffer of your own with ``read(into=...)``.
+    """
+    def __init__(self, host, sub_address=b"hislip0", port=HISLIP_PORT, timeout=None,
+                 max_message_size=1 << 20, max_write_size=None, vendor_id=b"PY", connect=tcp_connect,
+                 ssl_context=None, server_hostname=None, tls_sessions=None):
+        """
+        :param host: server host name
+        :param bytes sub_address: instrument sub address, e.g. b"hislip0"
+        :param port: server port
+        :param timeout: socket timeout in seconds, None blocks forever
+        :param int max_message_size: largest message this client accepts
+        :param int max_write_size: largest message this client sends, if smaller than the server maximum
+        :param bytes vendor_id: two character vendor id sent in Initialize
+        :param connect: callable (address, timeout) => socket, used to open both channels
+        :param ssl.SSLContext ssl_context: encrypt the session with HiSLIP 2.0 StartTLS, see :mod:`hislip_server.tls`
+        :param str server_hostname: name to verify the server certificate against, default `host`
+        :param TLSSessionCache tls_sessions: sessions to resume, default :data:`hislip_server.tls.default_session_cache`
+        """
+        self.address = (host, port)
+        self.sub_address = sub_address
+        self.timeout = timeout
+        self.max_message_size = max_message_size
+        self.max_write_size = max_write_size
+        self.vendor_id = vendor_id
+        self._connect = connect
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or host
+        self.tls_sessions = tls_sessions
+
+        self.session_id = None
+        self.overlap_mode = None
+        self.server_protocol_version = None
+        self.server_vendor_id = None
+        self.server_max_message_size = None
+
+        self.message_id = FIRST_MESSAGE_ID
+        self.last_message_id = None
+        self.pending_response = False  # A program message has been sent, the response is not yet read
+        # Skip responses to earlier program messages, e.g. of a command which unexpectedly answered
+        self.discard_stale_responses = False
+        self._rmt = False
+        self._buf = bytearray(4096)
+        self.shared_memory = None
+        self.shared_memory_threshold = 64 * 1024
+        self._shm_held = 0  # Bytes of the download ring held by the last response
+        self.sync_channel = None
+        self.async_channel = None
+
+    @property
+    def is_open(self):
+        return self.sync_channel is not None
+
+    def open(self):
+        """
+        Perform the Initialize/AsyncInitialize handshake and negotiate the maximum message size.
+        """
+        self.sync_channel = _Channel(self._connect(self.address, self.timeout))
+        try:
+            init = MessageInitialize()
+            init.client_protocol_version = PROTOCOL_VERSION if self.ssl_context is None else TLS_PROTOCOL_VERSION
+            init.client_vendor_id = self.vendor_id
+            init.sub_address = self.sub_address
+            self.sync_channel.send(init)
+            response = self.sync_channel.receive(Message.Type.InitializeResponse)
+            self.session_id = response.session_id
+            self.overlap_mode = response.overlap_mode
+            self.server_protocol_version = response.server_protocol_version
+
+            self.async_channel = _Channel(self._connect(self.address, self.timeout))
+            async_init = MessageAsyncInitialize()
+            async_init.session_id = self.session_id
+            self.async_channel.send(async_init)
+            self.server_vendor_id = self.async_channel.receive(Message.Type.AsyncInitializeResponse).server_vendor_id
+
+            size = MessageAsyncMaximumMessageSize()
+            size.max_size = self.max_message_size
+            self.async_channel.send(size)
+            self.server_max_message_size = self.async_channel.receive(Message.Type.AsyncMaximumMessageSizeResponse).max_size
+
+            if self.ssl_context is not None:
+                self.start_tls()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def start_tls(self):
+        """
+        Encrypt both channels, AsyncStartTLS followed by StartTLS. Resumes the last TLS session with the
+        server if there is one in :attr:`tls_sessions`.
+        """
+        from hislip_server.tls import START_TLS_SUCCESS
+        from hislip_server.tls import TLSSocket
+        from hislip_server.tls import default_session_cache
+
+        if self.server_protocol_version < b"\x02\x00":
+            raise HislipError("The server doesn't support encryption, HiSLIP %i.%i" %
+                              tuple(bytearray(self.server_protocol_version)))
+        if self.tls_sessions is None:
+            self.tls_sessions = default_session_cache
+        session = self.tls_sessions.get(self.address, self.ssl_context)
+        last_message_id = (self.message_id - 2) & 0xffffffff
+
+        msg = MessageAsyncStartTLS()
+        msg.message_id = last_message_id
+        self.async_channel.send(msg)
+        if self.async_channel.receive(Message.Type.AsyncStartTLSResponse).ctrl_code != START_TLS_SUCCESS:
+            raise HislipError("The server refused AsyncStartTLS")
+        self.async_channel.sock = TLSSocket.client(self.async_channel.sock, self.ssl_context, self.server_hostname,
+                                                   session)
+
+        msg = MessageStartTLS()
+        msg.message_id = last_message_id
+        self.sync_channel.send(msg)
+        self.sync_channel.sock = TLSSocket.client(self.sync_channel.sock, self.ssl_context, self.server_hostname,
+                                                  session)
+
+    @property
+    def tls_session_reused(self):
+        """
+        True if the channels resumed a cached TLS session instead of a full handshake.
+        """
+        return bool(getattr(self.sync_channel.sock, "session_reused", False))
+
+    def close(self):
+        if self.tls_sessions is not None and self.sync_channel is not None:
+            # TLS 1.3 session tickets arrive after the handshake, the session is complete after some traffic
+            self.tls_sessions.put(self.address, self.ssl_context, getattr(self.sync_channel.sock, "session", None))
+        for ch in (self.sync_channel, self.async_channel):
+            if ch is not None:
+                ch.close()
+        self.sync_channel = self.async_channel = None
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+            self.shared_memory = None
+
+    def __enter__(self):
+        if not self.is_open:
+            self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_data_message(self, cls):
+        msg = cls()
+        msg.message_id = self.message_id
+        if self._rmt:
+            msg.RMT = True
+            self._rmt = False
+        self.last_message_id = self.message_id
+        self.message_id = next_message_id(self.message_id)
+        return msg
+
+    def write_fragment_size(self, size):
+        """
+        :return: the largest payload to send in one message, for a program message of `size` bytes
+        """
+        limit = min(x for x in (self.server_max_message_size, self.max_write_size, size + Message._struct_hdr.size)
+                    if x is not None)
+        return max(int(limit) - Message._struct_hdr.size, 1)
+
+    def enable_shared_memory(self, size=64 << 20):
+        """
+        Offer a shared memory region for bulk data to the server, see :mod:`hislip_server.shm`.
+        Only useful when the server runs on the same host, e.g. behind a HislipUnixServer.
+
+        :param int size: capacity of each direction in bytes
+        :return: True if the server accepted the region
+        """
+        from hislip_server import shm
+        region = shm.SharedMemoryRegion.create(size)
+        msg = MessageSharedMemoryRequest()
+        msg.set_region(region.path, size)
+        self.sync_channel.send(msg)
+        if not self.sync_channel.receive(Message.Type.VendorSharedMemoryResponse).accepted:
+            region.close()
+            return False
+        self.shared_memory = region
+        return True
+
+    def _write_shared_memory(self, data, end):
+        """
+        Put the program message in the upload ring, returns False if it doesn't fit.
+        """
+        segments = self.shared_memory.upload.write(data)
+        if segments is None:
+            return False
+        for n, segment in enumerate(segments):
+            last = n == len(segments) - 1
+            msg = self._next_data_message(MessageSharedMemoryDataEnd if end and last else MessageSharedMemoryData)
+            msg.segment = segment
+            self.sync_channel.send(msg)
+        return True
+
+    def write(self, data, end=True):
+        """
+        Send a program message, fragmented according to the maximum message size of the server.
+
+        :param data: bytes or any object supporting the buffer protocol
+        :param bool end: terminate the program message with DataEnd, otherwise more data follows
+        """
+        data = byte_view(data)
+        if self.shared_memory is not None and len(data) >= self.shared_memory_threshold:
+            if self._write_shared_memory(data, end):
+                self.pending_response = self.pending_response or end
+                return
+        fragment = self.write_fragment_size(len(data))
+        offset = 0
+        while len(data) - offset > (fragment if end else 0):
+            msg = self._next_data_message(MessageData)
+            msg.payload = data[offset:offset + fragment]
+            self.sync_channel.send(msg)
+            offset += fragment
+        if end:
+            msg = self._next_data_message(MessageDataEnd)
+            msg.payload = data[offset:]
+            self.sync_channel.send(msg)
+            self.pending_response = True
+
+    def _release_shared_memory(self):
+        if self._shm_held:
+            self.shared_memory.download.release(self._shm_held)
+            self._shm_held = 0
+
+    def read(self, into=None):
+        """
+        Read a complete response (Data ... DataEnd) from the sync channel.
+
+        A response transferred as a single shared memory segment is returned as a view into the
+        shared memory region, without any copy.
+
+        :param bytearray into: optional buffer to read into, must be large enough for the response
+        :return: memoryview of the response payload
+        """
+        self._release_shared_memory()
+        buf = self._buf if into is None else into
+        size = 0
+        while True:
+            hdr = self.sync_channel.read_header()
+            shm_segment = hdr.type in (Message.Type.VendorSharedMemoryData, Message.Type.VendorSharedMemoryDataEnd)
+            if self.discard_stale_responses and hdr.param != self.last_message_id and \
+                    (shm_segment or hdr.type in (Message.Type.Data, Message.Type.DataEnd)):
+                self._discard(hdr, shm_segment)
+                continue
+            if shm_segment:
+                offset, length = MessageSharedMemoryData._struct_segment.unpack(self.sync_channel.read(hdr.payload_len))
+                segment = self.shared_memory.download.read(offset, length)
+                end = hdr.type == Message.Type.VendorSharedMemoryDataEnd
+                if end and size == 0 and into is None:
+                    self._shm_held = length  # Released on the next read
+                    self.pending_response = False
+                    self._rmt = True
+                    return segment
+                payload_len = length
+            elif hdr.type in (Message.Type.Data, Message.Type.DataEnd):
+                payload_len = hdr.payload_len
+                end = hdr.type == Message.Type.DataEnd
+            else:
+                payload = self.sync_channel.read(hdr.payload_len)
+                if hdr.type in (Message.Type.Error, Message.Type.FatalError):
+                    raise HislipError("Server error %i: %r" % (hdr.ctrl_code, payload))
+                logger.warning("Unexpected message on sync channel, %i", hdr.type)
+                continue
+            if size + payload_len > len(buf):
+                if into is not None:
+                    raise HislipError("Response does not fit in the supplied buffer")
+                # A new buffer, views returned by earlier reads may still be alive
+                grown = bytearray(max(size + payload_len, 2 * len(buf)))
+                grown[:size] = buf[:size]
+                buf = self._buf = grown
+            if shm_segment:
+                buf[size:size + payload_len] = segment
+                self.shared_memory.download.release(payload_len)
+            else:
+                self.sync_channel.read_into(memoryview(buf)[size:size + payload_len])
+            size += payload_len
+            if end:
+                break
+        self.pending_response = False
+        self._rmt = True
+        return memoryview(buf)[:size]
+
+    def _discard(self, hdr, shm_segment):
+        payload = self.sync_channel.read(hdr.payload_len)
+        if shm_segment:
+            self.shared_memory.download.release(MessageSharedMemoryData._struct_segment.unpack(payload)[1])
+        logger.info("Discarded response to message %#x, expected %#x", hdr.param, self.last_message_id or 0)
+
+    def query(self, data, into=None):
+        self.write(data)
+        return self.read(into)
+
+    def trigger(self):
+        self.sync_channel.send(self._next_data_message(MessageTrigger))
+
+    def status_query(self):
+        """
+        :return: the status byte
+        """
+        msg = MessageAsyncStatusQuery()
+        msg.message_id = self.last_message_id if self.last_message_id is not None else FIRST_MESSAGE_ID
+        if self._rmt:
+            msg.RMT = True
+        self.async_channel.send(msg)
+        return self.async_channel.receive(Message.Type.AsyncStatusResponse).status
+
+    def wait_service_request(self):
+        """
+        Wait for an AsyncServiceRequest from the server, e.g. after ``*OPC`` with ``*ESE 1;*SRE 32``.
+
+        :return: the status byte sent with the request
+        """
+        if self.async_channel.service_requests:
+            return self.async_channel.service_requests.popleft()
+        return self.async_channel.receive(Message.Type.AsyncServiceRequest).ctrl_code
+
+    def device_clear(self):
+        self.async_channel.send(_make(Message.Type.AsyncDeviceClear))
+        ack = self.async_channel.receive(Message.Type.AsyncDeviceClearAcknowledge)
+        complete = _make(Message.Type.DeviceClearComplete, ctrl_code=ack.ctrl_code & 1)
+        self.sync_channel.send(complete)
+        self.sync_channel.receive(Message.Type.DeviceClearAcknowledge)
+        self.message_id = FIRST_MESSAGE_ID
+        self.pending_response = False
+        self._rmt = False
+
+    def lock(self, timeout=0, shared_name=b""):
+        """
+        Request the exclusive lock, or a shared lock if `shared_name` is given.
+
+        :param int timeout: lock timeout in milliseconds
+        :return: True if the lock was granted
+        """
+        msg = MessageAsyncLock()
+        msg.ctrl_code = 1
+        msg.param = int(timeout)
+        msg.payload = shared_name
+        self.async_channel.send(msg)
+        return bool(self.async_channel.receive(Message.Type.AsyncLockResponse).ctrl_code)
+
+    def unlock(self):
+        msg = MessageAsyncLock()
+        msg.ctrl_code = 0
+        msg.param = self.last_message_id or 0
+        self.async_channel.send(msg)
+        return bool(self.async_channel.receive(Message.Type.AsyncLockResponse).ctrl_code)
+
+
+def _make(msg_type, ctrl_code=0, param=0, payload=b""):
+    msg = Message._subclasses.get(msg_type, Message)()
+    msg.type = msg_type
+    msg.ctrl_code = ctrl_code
+    msg.param = param
+    msg.payload = payload
+    return msg
+
+
+class HislipClientPool(object):
+    """
+    Keeps idle, initialized sessions per (host, port, sub address), so short scripts can skip the
+    two socket handshake.
+
+    >>> pool = HislipClientPool()
+    >>> with pool.session("localhost", b"hislip0") as conn:  # doctest: +SKIP
+    ...     idn = conn.query(b"*IDN?\\n").tobytes()
+    """
+    def __init__(self, max_idle=4, idle_timeout=60.0, **connection_kwargs):
+        """
+        :param int max_idle: idle sessions kept per key
+        :param float idle_timeout: idle sessions older than this (seconds) are closed instead of reused
+        :param connection_kwargs: passed to :class:`HislipClientConnection`
+        """
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connection_kwargs = connection_kwargs
+        self.lock = threading.Lock()
+        self._idle = defaultdict(list)  # key => [(release time, connection)]
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, host, sub_address=b"hislip0", port=HISLIP_PORT):
+        """
+        :rtype: HislipClientConnection
+        """
+        key = (host, port, sub_address)
+        now = time.time()
+        expired = []
+        conn = None
+        with self.lock:
+            idle = self._idle[key]
+            while idle:
+                released, candidate = idle.pop()
+                if now - released > self.idle_timeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                self.reused += 1
+                break
+            else:
+                self.created += 1
+        for old in expired:
+            old.close()
+        if conn is None:
+            conn = HislipClientConnection(host, sub_address, port, **self.connection_kwargs).open()
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection to the pool. Connections with unread responses are closed.
+        """
+        if not conn.is_open or conn.pending_response:
+            conn.close()
+            return
+        key = (conn.address[0], conn.address[1], conn.sub_address)
+        with self.lock:
+            idle = self._idle[key]
+            if len(idle) < self.max_idle:
+                idle.append((time.time(), conn))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def session(self, host, sub_address=b"hislip0", port=HISLIP_PORT):
+        """
+        Context manager acquiring a connection and releasing it afterwards. If the block raises,
+        the connection is closed instead of being returned to the pool.
+        """
+        return _PooledSession(self, host, sub_address, port)
+
+    def close(self):
+        with self.lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for conns in idle.values():
+            for _, conn in conns:
+                conn.close()
+
+
+class _PooledSession(object):
+    def __init__(self, pool, host, sub_address, port):
+        self.pool = pool
+        self.args = (host, sub_address, port)
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire(*self.args)
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.pool.release(self.conn)
+        else:
+            self.pool.discard(self.conn)
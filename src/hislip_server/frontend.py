@@ -0,0 +1,831 @@
+# -*- coding: utf-8 -*-
+"""
+Front-ends accepting and reading the connections of a :class:`~hislip_server.hislip_server.HislipServer`.
+
+The server, or a subclass like :class:`~hislip_server.scpi.SCPIServer`, provides the sessions and
+the application; the front-end decides how connections are read and how the handlers are run:
+
+* :class:`ThreadedFrontEnd`: a thread per connection reading with blocking calls, like
+  ``HislipServer.serve_forever()``
+* :class:`SelectorFrontEnd`: one thread waits for all connections with :mod:`selectors`, reads and
+  parses the messages without blocking, and a pool of worker threads handles them. The messages of
+  a connection are handled in order, one at a time.
+* :class:`AsyncioFrontEnd`: the same on an asyncio event loop, which can be the loop of an asyncio
+  application
+
+The server is created without binding a socket of its own, the front-end listens on one or more
+addresses. Paths are served as Unix domain sockets through a
+:class:`~hislip_server.hislip_server.HislipUnixServer`, with shared memory transfers::
+
+    server = SimulatorServer(("", 4880), HislipHandler, bind_and_activate=False)
+    front_end = SelectorFrontEnd(server, [("", 4880), "/run/hislip.sock"], workers=16)
+    try:
+        front_end.serve_forever()
+    finally:
+        front_end.server_close()
+
+Handlers which block (e.g. on a slow instrument) occupy a worker of the event loop front-ends;
+the pool needs at least as many workers as sessions waiting for the instrument at the same time.
+The event loop front-ends need Python 3.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    import selectors
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2
+    selectors = ThreadPoolExecutor = None
+
+from hislip_server.hislip_server import HislipConnectionClosed
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipUnixServer
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import wait_writable
+
+logger = logging.getLogger(__name__)
+
+FRONT_ENDS = ("threaded", "selector", "asyncio")
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Messages after which the client starts the TLS handshake, the following bytes are not HiSLIP messages
+_TLS_UPGRADE = (Message.Type.AsyncStartTLS, Message.Type.StartTLS)
+
+_PAYLOAD_LEN = struct.Struct("!Q")  # At offset 8 of the message header
+
+
+def parse_listen_address(text):
+    """
+    Parse a listen address of the command line: ``host:port``, ``[ipv6]:port``, ``:port`` for all
+    interfaces, or a Unix socket path, optionally as ``unix:path``.
+
+    :return: (host, port) or the path
+    """
+    if text.startswith("unix:"):
+        return text[5:]
+    if "/" in text:
+        return text
+    host, sep, port = text.rpartition(":")
+    if not sep:
+        raise ValueError("Listen address %r is neither host:port nor a path" % text)
+    return host.strip("[]"), int(port)
+
+
+class Listener(object):
+    """
+    A listening socket and the server its connections belong to.
+
+    :param address: (host, port), or the path of a Unix domain socket
+    :param HislipServer server:
+    :param sock: a socket already listening on `address`, e.g. handed over by another process
+    """
+    def __init__(self, address, server, backlog=128, sock=None):
+        self.unix_server = None
+        self.detached = False
+        if isinstance(address, tuple):
+            if sock is None:
+                host, port = address
+                sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    sock.bind((host, port))
+                    sock.listen(backlog)
+                except socket.error:
+                    sock.close()
+                    raise
+            self.socket = sock
+            self.server = server
+        else:
+            self.unix_server = HislipUnixServer(address, server.RequestHandlerClass, server,
+                                                bind_and_activate=sock is None)
+            if sock is not None:
+                self.unix_server.socket.close()
+                self.unix_server.socket = sock
+            self.socket = self.unix_server.socket
+            self.server = self.unix_server
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def detach(self):
+        """
+        Close the socket after handing it to another process, which keeps listening on the address.
+        """
+        self.detached = True
+        self.socket.close()
+
+    def close(self):
+        if self.detached:
+            return
+        if self.unix_server is not None:
+            self.unix_server.server_close()
+        else:
+            self.socket.close()
+
+
+class _FrontEnd(object):
+    """
+    :param HislipServer server: the sessions and the application, created with ``bind_and_activate=False``
+    :param addresses: list of (host, port), Unix socket paths to listen on and :class:`Listener` objects
+    """
+    def __init__(self, server, addresses):
+        self.server = server
+        self.listeners = []
+        self._calls = deque()
+        # Wakes up the loop for calls of run_in_loop()
+        self._wakeup, self._wakeup_sender = socket.socketpair()
+        for sock in (self._wakeup, self._wakeup_sender):
+            sock.setblocking(False)
+        try:
+            for address in addresses:
+                self.listeners.append(address if isinstance(address, Listener) else Listener(address, server))
+        except Exception:
+            self.server_close()
+            raise
+        self._stop = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self.running = threading.Event()
+
+    @property
+    def addresses(self):
+        return [listener.address for listener in self.listeners if not listener.detached]
+
+    def shutdown(self):
+        """
+        Stop serve_forever() and wait until it has returned, called from another thread.
+        """
+        self._stop.set()
+        self._stopped.wait()
+
+    def run_in_loop(self, fn, *args):
+        """
+        Call `fn` in the thread running serve_forever(), between two events, or directly if the front-end
+        isn't serving.
+
+        :return: the result of `fn`
+        """
+        if not self.running.is_set():
+            return fn(*args)
+        future = Future()
+
+        def call():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+        self._call_soon(call)
+        return future.result()
+
+    def _call_soon(self, call):
+        self._calls.append(call)
+        try:
+            self._wakeup_sender.send(b"\0")
+        except socket.error:
+            pass  # Full, the loop wakes up anyway
+
+    def _run_calls(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self._calls:
+            self._calls.popleft()()
+
+    def _serving(self):
+        self._stop.clear()
+        self._stopped.clear()
+        self.running.set()
+
+    def _served(self):
+        self.running.clear()
+        self._run_calls()  # Called meanwhile
+        self._stopped.set()
+
+    def detach_listeners(self):
+        """
+        Stop accepting connections, called in the loop thread before handing the listeners to another process.
+
+        :return: the listeners
+        """
+        return list(self.listeners)
+
+    def drain(self, timeout):
+        """
+        Wait until all sessions are closed.
+
+        :return: True if they are
+        """
+        deadline = time.time() + timeout
+        while self.server.clients:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def server_close(self):
+        for listener in self.listeners:
+            listener.close()
+        self._wakeup.close()
+        self._wakeup_sender.close()
+        self.server.server_close()
+
+
+class ThreadedFrontEnd(_FrontEnd):
+    """
+    Accepts connections and passes them to ``server.process_request()``, which handles each one in a thread.
+    Hands over only its listeners, the sessions of the threads are drained.
+    """
+    def serve_forever(self, poll_interval=0.5):
+        self._serving()
+        self._accepting = dict((listener.socket, listener) for listener in self.listeners)
+        try:
+            while not self._stop.is_set():
+                readable = select.select(list(self._accepting) + [self._wakeup], [], [], poll_interval)[0]
+                for sock in readable:
+                    if sock is self._wakeup:
+                        self._run_calls()
+                        continue
+                    if sock not in self._accepting:
+                        continue  # Detached meanwhile
+                    try:
+                        conn, address = sock.accept()
+                    except socket.error as e:
+                        if e.errno not in _WOULD_BLOCK:
+                            logger.warning("accept() failed: %s", e)
+                        continue
+                    self._accepting[sock].server.process_request(conn, address)
+        finally:
+            self._served()
+
+    def detach_listeners(self):
+        self._accepting = {}
+        return list(self.listeners)
+
+
+class _EventSocket(object):
+    """
+    The non-blocking socket of a connection read by an event loop, as seen by the handler: sends
+    block until all data is written, reads are done by the event loop.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    @property
+    def family(self):
+        return self.sock.family
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        pass  # The socket stays non-blocking for the event loop
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def sendall(self, data):
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast("B")
+        while len(view):
+            try:
+                sent = self.sock.send(view)
+            except socket.error as e:
+                if e.errno not in _WOULD_BLOCK:
+                    raise
+                wait_writable(self.sock)
+                continue
+            view = view[sent:]
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def makefile(self, mode="rb", bufsize=-1):
+        return _EventFile(self)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+class _EventFile(object):
+    closed = False
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def read(self, size=-1):
+        raise HislipError("The connection is read by the event loop")
+
+    def write(self, data):
+        self._sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class _EventHandlerMixin(object):
+    """
+    Runs a HislipHandler without a thread of its own: handle() returns at once and the connection
+    passes the messages read by the event loop to initialize() and _dispatch().
+    """
+    event_connection = None
+
+    def handle(self):
+        pass
+
+    def finish(self):
+        pass  # Called by the constructor, the connection is finished by close()
+
+    def close(self):
+        super(_EventHandlerMixin, self).finish()
+
+    def start_tls(self, context):
+        from hislip_server.tls import TLSEngine
+        from hislip_server.tls import TLSSocket
+
+        tls = TLSSocket(self.connection, TLSEngine(context, True))
+        if not self.event_connection.start_tls(tls):
+            raise HislipConnectionClosed("TLS handshake with %r failed" % (self.client_address,))
+        self.tls = self.connection = tls
+        self.wfile = tls.makefile("wb", 0)
+        logger.info("%s channel of session %i encrypted with %s%s", "Sync" if self.sync_conn else "Async",
+                    self.session_id, tls.version(), ", session resumed" if tls.session_reused else "")
+
+
+_event_handler_classes = {}
+
+
+def _event_handler_class(handler_cls):
+    cls = _event_handler_classes.get(handler_cls)
+    if cls is None:
+        cls = type(str("Event" + handler_cls.__name__), (_EventHandlerMixin, handler_cls), {})
+        _event_handler_classes[handler_cls] = cls
+    return cls
+
+
+class _BufferReader(object):
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+
+    def read(self, size):
+        data = bytes(self.buf[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+
+_CLOSED = object()
+
+
+class _Connection(object):
+    """
+    A connection read by an event loop: the loop passes the received bytes to data_received(), the
+    complete messages are handled in order by one worker at a time.
+    """
+    recv_size = 256 * 1024
+    handshake_timeout = 30.0
+
+    def __init__(self, sock, address, server, executor):
+        self.sock = sock
+        self.address = address
+        self.server = server
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.tls = None
+        self._buf = bytearray()  # Plain text not parsed yet
+        self._raw = bytearray()  # Received after a message starting TLS, before the handshake was started
+        self._paused = False
+        self._queue = deque()
+        self._scheduled = False
+        self._initialized = False
+        self._failed = False
+        self._handshake = threading.Event()
+        self.handler = _event_handler_class(server.RequestHandlerClass)(_EventSocket(sock), address, server)
+        self.handler.event_connection = self
+
+    def adopt(self, client, sync):
+        """
+        Continue an initialized session handed over by another process, instead of waiting for Initialize.
+        """
+        handler = self.handler
+        handler.client = client
+        handler.session_id = client.session_id
+        handler.sync_conn = sync
+        with client.lock:
+            if sync:
+                client.sync_handler = handler
+            else:
+                client.async_handler = handler
+        self._initialized = True
+
+    @property
+    def idle(self):
+        """
+        True between message exchanges: nothing is received, queued or handled, and the connection can be
+        handed over to another process, i.e. it isn't encrypted.
+        """
+        with self.lock:
+            return self._initialized and self.handler.client is not None and self.tls is None and not (
+                self._scheduled or self._queue or self._buf or self._raw or self._paused or self._failed)
+
+    def data_received(self, data):
+        """
+        Called by the event loop with the bytes read from the socket.
+        """
+        with self.lock:
+            if self._paused:
+                self._raw += data
+                return
+            self._received(data)
+
+    def connection_lost(self):
+        """
+        Called by the event loop at the end of the stream, after the socket was removed from the loop.
+        """
+        with self.lock:
+            self._queue.append(_CLOSED)
+            self._schedule()
+        self._handshake.set()
+
+    def _received(self, data):
+        if self.tls is not None:
+            data = self.tls.receive(data)
+            if self.tls.handshake_done:
+                self._handshake.set()
+        self._buf += data
+        self._parse()
+
+    def _parse(self):
+        buf = self._buf
+        pos = 0
+        header_size = Message._struct_hdr.size
+        while len(buf) - pos >= header_size:
+            end = pos + header_size + _PAYLOAD_LEN.unpack_from(buf, pos + 8)[0]
+            if len(buf) < end:
+                break
+            msg = Message.parse(_BufferReader(buf, pos))
+            pos = end
+            self._queue.append(msg)
+            if msg.type in _TLS_UPGRADE and self.server.ssl_context is not None:
+                self._paused = True  # Until the handler has started TLS
+                self._raw += buf[pos:]
+                pos = len(buf)
+        del buf[:pos]
+        if self._queue:
+            self._schedule()
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self.executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self._queue:
+                    self._scheduled = False
+                    return
+                msg = self._queue.popleft()
+            if msg is _CLOSED:
+                self._close()
+                continue
+            if self._failed:
+                continue
+            try:
+                self._handle(msg)
+            except Exception as e:
+                if not isinstance(e, HislipConnectionClosed):
+                    logger.exception("Error handling %s from %r", msg.type, self.address)
+                self._failed = True
+                self.abort()
+            finally:
+                if msg.type in _TLS_UPGRADE:
+                    self._resume()
+
+    def _handle(self, msg):
+        if not self._initialized:
+            self._initialized = True
+            self.handler.initialize(msg)
+            return
+        logger.debug("%s: %s", "async" if self.handler.sync_conn is False else " sync", msg)
+        self.handler._dispatch(msg)
+
+    def start_tls(self, tls):
+        """
+        Called by the handler: decrypt the connection with the TLSSocket `tls`, and wait for the handshake.
+
+        :return: True if the handshake completed
+        """
+        with self.lock:
+            self.tls = tls
+            self._paused = False
+            raw, self._raw = bytes(self._raw), bytearray()
+            if raw:
+                self._received(raw)
+        self._handshake.wait(self.handshake_timeout)
+        return tls.handshake_done
+
+    def _resume(self):
+        with self.lock:
+            if self._paused:  # TLS was refused, the data is plain text after all
+                self._paused = False
+                raw, self._raw = bytes(self._raw), bytearray()
+                self._received(raw)
+
+    def abort(self):
+        """
+        Close the connection, the event loop sees the end of the stream.
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _close(self):
+        logger.info("Connection closed, %r", self.address)
+        if self.handler.client is not None:
+            self.server.client_disconnect(self.handler.client)
+        try:
+            self.handler.close()
+        except Exception:
+            logger.exception("Closing the handler of %r failed", self.address)
+        self.abort()
+        self.sock.close()
+
+
+class _EventFrontEnd(_FrontEnd):
+    """
+    The subclasses watch the sockets with ``_register(conn)``, ``_unregister(conn)`` and ``_unregister_listener(listener)``.
+
+    :param int workers: threads handling the messages
+    """
+    def __init__(self, server, addresses, workers=16):
+        if ThreadPoolExecutor is None:
+            raise HislipError("The %s front-end requires Python 3" % type(self).__name__)
+        super(_EventFrontEnd, self).__init__(server, addresses)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+        self.connections = set()
+        for listener in self.listeners:
+            listener.socket.setblocking(False)
+
+    def _accept(self, listener):
+        """
+        :return: the new _Connection, or None
+        """
+        try:
+            sock, address = listener.socket.accept()
+        except socket.error as e:
+            if e.errno not in _WOULD_BLOCK:
+                logger.warning("accept() failed: %s", e)
+            return None
+        sock.setblocking(False)
+        try:
+            conn = _Connection(sock, address, listener.server, self.executor)
+        except Exception:
+            logger.exception("Connection from %r failed", address)
+            sock.close()
+            return None
+        self.connections.add(conn)
+        return conn
+
+    def _read(self, conn):
+        """
+        :return: False if the connection is closed and was removed
+        """
+        try:
+            data = conn.sock.recv(conn.recv_size)
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK:
+                return True
+            data = b""
+        if data:
+            try:
+                conn.data_received(data)
+                return True
+            except Exception:
+                logger.exception("Invalid data from %r", conn.address)
+        return False
+
+    def _lost(self, conn):
+        self.connections.discard(conn)
+        conn.connection_lost()
+
+    def detach_listeners(self):
+        for listener in self.listeners:
+            if not listener.detached:
+                self._unregister_listener(listener)
+        return list(self.listeners)
+
+    def detach_idle_sessions(self, limit):
+        """
+        Stop serving up to `limit` sessions whose channels are both idle, for handing them to another process.
+        Called in the loop thread.
+
+        :return: list of (HislipClient, sync _Connection, async _Connection)
+        """
+        channels = {}
+        for conn in self.connections:
+            if conn.handler.client is not None:
+                channels.setdefault(conn.handler.client.session_id, []).append(conn)
+        detached = []
+        for session_id, conns in channels.items():
+            if len(detached) >= limit:
+                break
+            if len(conns) != 2 or not all(conn.idle for conn in conns):
+                continue
+            client = conns[0].handler.client
+            with client.lock:
+                if client.response_pending or client.backlog or client.sync_buffer.tell() or client.shared_memory:
+                    continue
+            for conn in conns:
+                self._unregister(conn)
+                self.connections.discard(conn)
+            with self.server.client_lock:
+                self.server.clients.pop(session_id, None)
+            sync, async_ = sorted(conns, key=lambda conn: not conn.handler.sync_conn)
+            detached.append((client, sync, async_))
+        return detached
+
+    def adopt_session(self, client, sync_sock, async_sock):
+        """
+        Serve a session handed over by another process. Called in the loop thread.
+
+        :param HislipClient client: the state of the session
+        """
+        for sock, sync in ((sync_sock, True), (async_sock, False)):
+            sock.setblocking(False)
+            server = self.server
+            if sock.family == getattr(socket, "AF_UNIX", None):
+                server = next((listener.server for listener in self.listeners if listener.unix_server is not None), server)
+            try:
+                address = sock.getpeername()
+            except socket.error:
+                address = None
+            conn = _Connection(sock, address, server, self.executor)
+            conn.adopt(client, sync)
+            self.connections.add(conn)
+            self._register(conn)
+        with self.server.client_lock:
+            self.server.clients[client.session_id] = client
+            self.server._last_session_id = max(self.server._last_session_id, client.session_id)
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        while self.connections:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def server_close(self):
+        for conn in list(self.connections):
+            self._lost(conn)
+        if getattr(self, "executor", None) is not None:
+            self.executor.shutdown(wait=True)
+        super(_EventFrontEnd, self).server_close()
+
+
+class SelectorFrontEnd(_EventFrontEnd):
+    selector = None
+
+    def serve_forever(self, poll_interval=0.5):
+        self.selector = selectors.DefaultSelector()
+        try:
+            self.selector.register(self._wakeup, selectors.EVENT_READ, None)
+            for listener in self.listeners:
+                if not listener.detached:
+                    self.selector.register(listener.socket, selectors.EVENT_READ, listener)
+            self._serving()
+            while not self._stop.is_set():
+                for key, _ in self.selector.select(poll_interval):
+                    if key.data is None:
+                        self._run_calls()
+                    elif isinstance(key.data, Listener):
+                        conn = self._accept(key.data)
+                        if conn is not None:
+                            self._register(conn)
+                    elif key.data in self.connections and not self._read(key.data):
+                        self._unregister(key.data)
+                        self._lost(key.data)
+        finally:
+            self._served()
+            self.selector.close()
+
+    def _register(self, conn):
+        self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def _unregister(self, conn):
+        self.selector.unregister(conn.sock)
+
+    def _unregister_listener(self, listener):
+        self.selector.unregister(listener.socket)
+
+
+class AsyncioFrontEnd(_EventFrontEnd):
+    """
+    Serves on an asyncio event loop. serve_forever() runs a loop of its own; to serve on the loop of an
+    asyncio application call :meth:`start` in it instead.
+    """
+    loop = None
+
+    def start(self, loop):
+        """
+        Start serving on `loop`, called in the thread running the loop.
+        """
+        self.loop = loop
+        for listener in self.listeners:
+            if not listener.detached:
+                loop.add_reader(listener.socket.fileno(), self._on_accept, listener)
+        self.running.set()
+
+    def stop(self):
+        """
+        Stop accepting and reading connections, called in the thread running the loop.
+        """
+        self.running.clear()
+        self.detach_listeners()
+        for conn in list(self.connections):
+            self._unregister(conn)
+            self._lost(conn)
+
+    def _call_soon(self, call):
+        self.loop.call_soon_threadsafe(call)
+
+    def _register(self, conn):
+        self.loop.add_reader(conn.sock.fileno(), self._on_readable, conn)
+
+    def _unregister(self, conn):
+        self.loop.remove_reader(conn.sock.fileno())
+
+    def _unregister_listener(self, listener):
+        self.loop.remove_reader(listener.socket.fileno())
+
+    def _on_accept(self, listener):
+        conn = self._accept(listener)
+        if conn is not None:
+            self._register(conn)
+
+    def _on_readable(self, conn):
+        if not self._read(conn):
+            self._unregister(conn)
+            self._lost(conn)
+
+    def serve_forever(self):
+        import asyncio  # Imported when used, it takes longer than the rest of the package
+
+        self._serving()
+        loop = asyncio.SelectorEventLoop()  # add_reader() is not available in the proactor loop
+        try:
+            self.start(loop)
+            loop.call_soon(self._check_stop)
+            loop.run_forever()
+            self.stop()
+        finally:
+            loop.close()
+            self._served()
+
+    def _check_stop(self):
+        if self._stop.is_set():
+            self.loop.stop()
+        else:
+            self.loop.call_later(0.1, self._check_stop)
+
+
+def create_front_end(name, server, addresses, workers=16):
+    """
+    :param str name: one of :data:`FRONT_ENDS`
+    """
+    if name == "threaded":
+        return ThreadedFrontEnd(server, addresses)
+    if name == "selector":
+        return SelectorFrontEnd(server, addresses, workers)
+    if name == "asyncio":
+        return AsyncioFrontEnd(server, addresses, workers)
+    raise ValueError("Unknown front-end %r" % name)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Zero-downtime restart: a new server process takes over the listening sockets and the idle sessions
+of the running one, passed as file descriptors over a Unix domain socket (``SCM_RIGHTS``).
+
+The running process waits for the new one on a control socket::
+
+    handoff = HandoffServer(front_end, "/run/hislip.handoff", on_done=stop_event.set)
+    handoff.start()
+
+and the new process takes over before it serves::
+
+    takeover = Takeover("/run/hislip.handoff")
+    front_end = SelectorFrontEnd(server, takeover.listeners(server))
+    ...  # serve_forever() in a thread
+    takeover.start(front_end)
+
+or ``hislip-server serve --handoff-socket PATH`` for the running and
+``hislip-server serve --take-over PATH --handoff-socket PATH`` for the new process.
+
+The old process hands over its listeners first and stops accepting. Then it hands over each session
+as soon as both channels are idle, between two message exchanges, together with the session state
+of its :class:`~hislip_server.hislip_server.HislipClient`. Clients keep their session and message ids
+and don't notice the restart. Encrypted sessions, sessions with shared memory and all sessions of
+the threaded front-end, whose threads block in reads, can't be handed over; the old process serves
+them until they close or `drain_timeout` expires. Requires Python 3 on Linux or another system with
+``SCM_RIGHTS``.
+
+Locks aren't part of the handed over state. Servers keeping state which can't be passed to another
+process set ``supports_handoff = False`` and refuse the handover, e.g. the
+:class:`~hislip_server.proxy.ProxyServer`, whose locks are held by its sessions with the instrument.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import array
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+from hislip_server.hislip_server import HislipError
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct("!I")
+
+MAX_FDS = 128  # File descriptors per control message
+SESSIONS_PER_MESSAGE = MAX_FDS // 2
+
+
+def _check_support():
+    if not hasattr(socket, "SCM_RIGHTS") or not hasattr(socket.socket, "sendmsg"):
+        raise HislipError("Handing over sockets requires Python 3 and SCM_RIGHTS")
+
+
+def send_message(sock, obj, fds=()):
+    """
+    Send a JSON object and file descriptors over the Unix socket `sock`.
+    """
+    data = json.dumps(obj).encode("utf-8")
+    payload = _LENGTH.pack(len(data)) + data
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if fds else []
+    sent = sock.sendmsg([payload], ancillary)  # The descriptors travel with the first byte
+    if sent < len(payload):
+        sock.sendall(payload[sent:])
+
+
+def receive_message(sock):
+    """
+    :return: (object, list of file descriptors), or (None, []) at the end of the stream
+    """
+    fds = array.array("i")
+    header, ancillary, flags, _ = sock.recvmsg(_LENGTH.size, socket.CMSG_LEN(MAX_FDS * fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if flags & getattr(socket, "MSG_CTRUNC", 0):
+        for fd in fds:
+            os.close(fd)
+        raise HislipError("File descriptors of a handover message were dropped")
+    if not header:
+        return None, []
+    header += _receive_exactly(sock, _LENGTH.size - len(header))
+    data = _receive_exactly(sock, _LENGTH.unpack(header)[0])
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise HislipError("Handover connection closed in a message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def session_state(client):
+    """
+    :param HislipClient client:
+    :return: the state of an idle session as JSON object
+    """
+    with client.lock:
+        return {
+            "session_id": client.session_id,
+            "sub_address": client.instr_sub_addr.decode("latin-1"),
+            "overlap_mode": client.overlap_mode,
+            "max_message_size": client.max_message_size,
+            "message_id": client.message_id,
+            "mav": client.MAV,
+            "rmt_expected": client.RMT_expected,
+        }
+
+
+def restore_session(server, state):
+    """
+    :return: a HislipClient of `server` with the state of :func:`session_state`
+    """
+    client = server.new_client()
+    client.session_id = state["session_id"]
+    client.instr_sub_addr = state["sub_address"].encode("latin-1")
+    client.overlap_mode = state["overlap_mode"]
+    client.max_message_size = state["max_message_size"]
+    client.message_id = state["message_id"]
+    client.MAV = state["mav"]
+    client.RMT_expected = state["rmt_expected"]
+    return client
+
+
+def _socket(fd):
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(True)
+    return sock
+
+
+class HandoffServer(object):
+    """
+    Waits on the Unix socket `path` for a new process to take over `front_end`.
+
+    :param front_end: a front-end of :mod:`hislip_server.frontend`
+    :param str path: control socket path
+    :param float drain_timeout: seconds to wait for sessions to become idle, or to close
+    :param on_done: called without arguments after the handover, e.g. to stop serving
+    """
+    def __init__(self, front_end, path, drain_timeout=30.0, on_done=None):
+        _check_support()
+        if not front_end.server.supports_handoff:
+            raise HislipError("%s can't hand its sessions over" % type(front_end.server).__name__)
+        self.front_end = front_end
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self.on_done = on_done
+        self.sessions_handed_over = 0
+        self.done = threading.Event()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(1)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="hislip-handoff")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            conn, _ = self.socket.accept()
+        except socket.error:
+            return  # Closed
+        self._close_socket()  # The new process listens on the path for the next restart
+        try:
+            self.hand_over(conn)
+        except Exception:
+            logger.exception("Handover failed")
+        finally:
+            conn.close()
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+    def hand_over(self, conn):
+        """
+        Pass the listeners and the idle sessions to the process connected to `conn`, then drain the rest.
+        """
+        front_end = self.front_end
+        hello, _ = receive_message(conn)
+        if hello is None:
+            raise HislipError("The new process closed the handover connection")
+        listeners = front_end.run_in_loop(front_end.detach_listeners)
+        with front_end.server.client_lock:
+            last_session_id = front_end.server._last_session_id
+        send_message(conn, {"listeners": [listener.address for listener in listeners],
+                            "last_session_id": last_session_id},
+                     [listener.socket.fileno() for listener in listeners])
+        for listener in listeners:
+            listener.detach()
+        logger.info("Listeners handed over")
+
+        deadline = time.time() + self.drain_timeout
+        if hello.get("sessions") and hasattr(front_end, "detach_idle_sessions"):
+            while front_end.connections and time.time() < deadline:
+                sessions = front_end.run_in_loop(front_end.detach_idle_sessions, SESSIONS_PER_MESSAGE)
+                if not sessions:
+                    time.sleep(0.01)
+                    continue
+                fds = []
+                for client, sync, async_ in sessions:
+                    fds += [sync.sock.fileno(), async_.sock.fileno()]
+                send_message(conn, {"sessions": [session_state(client) for client, _, _ in sessions]}, fds)
+                for client, sync, async_ in sessions:
+                    for channel in (sync, async_):
+                        channel.handler.close()
+                        channel.sock.close()  # The other process keeps the connection open
+                self.sessions_handed_over += len(sessions)
+                logger.info("%i sessions handed over", len(sessions))
+        if not front_end.drain(max(deadline - time.time(), 0)):
+            logger.warning("%i sessions still open after the handover", len(front_end.server.clients))
+
+    def _close_socket(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        self._close_socket()
+
+
+class Takeover(object):
+    """
+    Takes over the listeners and sessions of the process serving a :class:`HandoffServer` at `path`.
+
+    :param str path: control socket path
+    :param bool sessions: accept sessions, only front-ends with an event loop can serve them
+    """
+    def __init__(self, path, sessions=True, timeout=30.0):
+        _check_support()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path)
+        self.socket.settimeout(None)
+        send_message(self.socket, {"sessions": sessions})
+        message, fds = receive_message(self.socket)
+        if message is None:
+            raise HislipError("The running server closed the handover connection")
+        self.addresses = [tuple(a) if isinstance(a, list) else a for a in message["listeners"]]
+        self.sockets = [_socket(fd) for fd in fds]
+        self.last_session_id = message["last_session_id"]
+        self.sessions = 0
+        self.done = threading.Event()
+        self._thread = None
+
+    def listeners(self, server):
+        """
+        :return: Listener objects for the front-end serving `server`
+        """
+        from hislip_server.frontend import Listener
+
+        with server.client_lock:
+            server._last_session_id = max(server._last_session_id, self.last_session_id)
+        return [Listener(address[:2] if isinstance(address, tuple) else address, server, sock=sock)
+                for address, sock in zip(self.addresses, self.sockets)]
+
+    def start(self, front_end):
+        """
+        Receive the sessions in a thread, after `front_end` started serving.
+        """
+        self._thread = threading.Thread(target=self.receive_sessions, args=(front_end,), name="hislip-takeover")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def receive_sessions(self, front_end):
+        try:
+            front_end.running.wait()
+            while True:
+                message, fds = receive_message(self.socket)
+                if message is None:
+                    break
+                sockets = [_socket(fd) for fd in fds]
+                for n, state in enumerate(message["sessions"]):
+                    client = restore_session(front_end.server, state)
+                    front_end.run_in_loop(front_end.adopt_session, client, sockets[2 * n], sockets[2 * n + 1])
+                self.sessions += len(message["sessions"])
+                logger.info("Took over %i sessions", len(message["sessions"]))
+        except Exception:
+            logger.exception("Taking over sessions failed")
+        finally:
+            self.socket.close()
+            self.done.set()
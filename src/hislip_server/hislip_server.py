@@ -5,13 +5,17 @@
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
 import logging
+import os
+import select
 
 import struct
 import threading
-from cStringIO import StringIO
-
-from pprint import pprint
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
 
 import socket
 try:
@@ -19,13 +23,20 @@ try:
 except ImportError:
     import socketserver
 
+from collections import deque
 from collections import namedtuple
+from concurrent.futures import Future
 
-from aenum import IntEnum
+try:
+    from enum import IntEnum
+except ImportError:  # Python < 3.4
+    from aenum import IntEnum
 
 
 logger = logging.getLogger(__name__)
 
+PROTOCOL_VERSION_2 = struct.pack("!BB", 2, 0)
+
 
 class HislipError(Exception):
     pass
@@ -53,6 +64,205 @@ def repack(from_, to, *args):
     return struct.unpack(to, struct.pack(from_, *args))
 
 
+def byte_view(data):
+    """
+    Return a flat memoryview over the bytes of `data`, without copying when possible.
+
+    :param data: bytes or any object supporting the buffer protocol
+    :rtype: memoryview
+    """
+    view = memoryview(data)
+    if view.ndim != 1 or view.itemsize != 1:
+        try:
+            view = view.cast("B")
+        except AttributeError:  # Python 2 memoryviews can't be cast
+            view = memoryview(view.tobytes())
+    return view
+
+
+class FileResponse(object):
+    """
+    Response data read from a file by the kernel, sent with :func:`os.sendfile` after the headers of the
+    Data/DataEnd messages without copying it into the process. Where sendfile is not available (Python 2,
+    Windows, in-process transports) the file is sent in chunks of :attr:`chunk_size`.
+
+    Slicing returns a FileResponse for a part of the region. It can be used alone as response, or in
+    a list together with buffers, e.g. ``Block(FileResponse("screenshot.png"))`` in an SCPI query.
+
+    :param file: path, file descriptor or file object. Descriptors and file objects are used at their
+        offset `offset` and are not closed; a path is opened each time the response is sent.
+    :param int offset: start of the data in the file
+    :param int length: bytes to send, default up to the end of the file
+    """
+    chunk_size = 1 << 20
+
+    def __init__(self, file, offset=0, length=None):
+        self.file = file
+        if isinstance(file, int):
+            size = os.fstat(file).st_size
+        elif hasattr(file, "fileno"):
+            size = os.fstat(file.fileno()).st_size
+        else:
+            size = os.stat(file).st_size
+        if length is None:
+            length = size - offset
+        if offset < 0 or length < 0 or offset + length > size:
+            raise ValueError("File region %i + %i outside of the file size %i" % (offset, length, size))
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "FileResponse(%r, %i, %i)" % (self.file, self.offset, self.length)
+
+    def __getitem__(self, item):
+        start, stop, step = item.indices(self.length)
+        if step != 1:
+            raise ValueError("FileResponse slices must be contiguous")
+        region = FileResponse.__new__(FileResponse)
+        region.file, region.offset, region.length = self.file, self.offset + start, max(stop - start, 0)
+        return region
+
+    def _open(self):
+        if isinstance(self.file, int):
+            return self.file, False
+        if hasattr(self.file, "fileno"):
+            return self.file.fileno(), False
+        return os.open(self.file, os.O_RDONLY | getattr(os, "O_BINARY", 0)), True
+
+    def read(self):
+        """
+        :return: the data as bytes
+        """
+        fd, owned = self._open()
+        try:
+            return b"".join(_pread(fd, offset, min(self.chunk_size, self.offset + self.length - offset))
+                            for offset in range(self.offset, self.offset + self.length, self.chunk_size))
+        finally:
+            if owned:
+                os.close(fd)
+
+    def send_to(self, sock):
+        """
+        Send the data to the socket `sock`.
+        """
+        fd, owned = self._open()
+        try:
+            offset, remaining = self.offset, self.length
+            if remaining and hasattr(os, "sendfile") and _has_fileno(sock):
+                while remaining:
+                    try:
+                        sent = os.sendfile(sock.fileno(), fd, offset, remaining)
+                    except EnvironmentError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                        wait_writable(sock)  # Socket with a timeout, i.e. non-blocking at OS level
+                        continue
+                    if not sent:
+                        raise HislipError("%r: the file is shorter than expected" % self)
+                    offset += sent
+                    remaining -= sent
+            while remaining:
+                chunk = _pread(fd, offset, min(self.chunk_size, remaining))
+                if not chunk:
+                    raise HislipError("%r: the file is shorter than expected" % self)
+                sock.sendall(chunk)
+                offset += len(chunk)
+                remaining -= len(chunk)
+        finally:
+            if owned:
+                os.close(fd)
+
+
+def _pread(fd, offset, length):
+    try:
+        return os.pread(fd, length, offset)
+    except AttributeError:  # Python 2, without the file position being shared with other threads
+        with _pread_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+
+_pread_lock = threading.Lock()
+
+
+def wait_writable(sock, timeout=None):
+    """
+    Wait until the non-blocking socket `sock` can be written. Uses poll() where available, select() is
+    limited to descriptors below FD_SETSIZE.
+    """
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLOUT)
+        poller.poll(None if timeout is None else int(timeout * 1000))
+    else:
+        select.select([], [sock], [], timeout)
+
+
+def _has_fileno(sock):
+    try:
+        sock.fileno()
+    except Exception:
+        return False
+    return True
+
+
+class _FilePayload(object):
+    """
+    The payload of a Data/DataEnd message holding (a part of) a FileResponse, see :meth:`HislipHandler.send_msg`.
+    """
+    def __init__(self, pieces):
+        self.pieces = pieces  # Buffers and FileResponses
+
+    def __len__(self):
+        return sum(len(piece) for piece in self.pieces)
+
+    def __repr__(self):
+        return "<%s>" % ", ".join(repr(p) if isinstance(p, FileResponse) else "%i bytes" % len(p) for p in self.pieces)
+
+    def tobytes(self):
+        return b"".join(piece.read() if isinstance(piece, FileResponse) else piece.tobytes() for piece in self.pieces)
+
+    def send_to(self, sock, header):
+        buffered = [header]
+        for piece in self.pieces:
+            if not isinstance(piece, FileResponse) and len(piece) <= HislipHandler.copy_limit:
+                buffered.append(piece.tobytes())  # Block headers and the like, sent together with the message header
+                continue
+            sock.sendall(b"".join(buffered))
+            buffered = []
+            if isinstance(piece, FileResponse):
+                piece.send_to(sock)
+            else:
+                sock.sendall(piece)
+        if buffered:
+            sock.sendall(b"".join(buffered))
+
+
+def is_future(obj):
+    """
+    :return: True for futures (:class:`concurrent.futures.Future` or compatible), used for deferred results
+    """
+    return hasattr(obj, "add_done_callback")
+
+
+def then(future, fn):
+    """
+    :return: a Future of ``fn(future.result())``, with the exception of `future` or `fn` if they fail
+    """
+    result = Future()
+
+    def done(f):
+        try:
+            result.set_result(fn(f.result()))
+        except Exception as e:
+            result.set_exception(e)
+    future.add_done_callback(done)
+    return result
+
+
 class Message(object):
     _type_check = None  # Used to check for the correct type in unpack when subclassing
     _subclasses = dict()  # Holds a reference for all defined subclasses msg_id => class
@@ -95,6 +305,25 @@ class Message(object):
         AsyncDeviceClearAcknowledge = 23
         AsyncLockInfo = 24
         AsyncLockInfoResponse = 25
+        # HiSLIP 2.0
+        GetDescriptors = 26
+        GetDescriptorsResponse = 27
+        StartTLS = 28
+        AsyncStartTLS = 29
+        AsyncStartTLSResponse = 30
+        EndTLS = 31
+        AsyncEndTLS = 32
+        AsyncEndTLSResponse = 33
+        GetSaslMechanismList = 34
+        GetSaslMechanismListResponse = 35
+        AuthenticationStart = 36
+        AuthenticationExchange = 37
+        AuthenticationResult = 38
+        # Vendor specific messages (128 - 255)
+        VendorSharedMemoryRequest = 128
+        VendorSharedMemoryResponse = 129
+        VendorSharedMemoryData = 130
+        VendorSharedMemoryDataEnd = 131
 
     prologue = b"HS"
 
@@ -114,8 +343,9 @@ class Message(object):
         return new
 
     def __str__(self):
+        payload = self.payload if isinstance(self.payload, _FilePayload) else self.payload[:50]
         return "%s <%r> <%r> <%r> <%i> : <%r>" % \
-               (self.prologue, self.type, self.ctrl_code, self.param, self.payload_len, self.payload[:50])
+               (self.prologue, self.type, self.ctrl_code, self.param, self.payload_len, payload)
 
     @classmethod
     def parse(cls, fd):
@@ -139,28 +369,32 @@ class Message(object):
     _struct_hdr = struct.Struct("!2sBBIQ")
     _msg_tuple = namedtuple("HiSLIP_message", ["prologue", "type", "ctrl_code", "param", "payload_len"])
 
-    def pack(self):
+    def pack_header(self):
         assert self.type is not None
         try:
-            hdr = self._struct_hdr.pack(self.prologue, self.type, self.ctrl_code, self.param, self.payload_len)
+            return self._struct_hdr.pack(self.prologue, self.type, self.ctrl_code, self.param, self.payload_len)
         except Exception as e:
             logger.exception("struct.pack() failed.")
             raise
-        return hdr + self.payload
+
+    def pack(self):
+        payload = self.payload
+        if isinstance(payload, (memoryview, _FilePayload)):
+            payload = payload.tobytes()
+        return self.pack_header() + payload
 
     def unpack(self, fd):
         try:
             data = fd.read(self._struct_hdr.size)
         except socket.error as e:
-            raise HislipConnectionClosed(e.message)
+            raise HislipConnectionClosed(str(e))
         if not len(data):
             raise HislipConnectionClosed("Short read. Connection closed.")
         msg = self._msg_tuple._make(self._struct_hdr.unpack_from(data))
         if msg.prologue != self.prologue:
             raise HislipProtocolError("Invalid message prologue")
-        try:
-            self.type = self.Type(msg.type)
-        except ValueError:
+        self.type = _message_types[msg.type]
+        if self.type is None:
             raise HislipProtocolError("Unknown message type (%i)" % msg.type)
         if self._type_check and self._type_check != self.type:
             raise HislipError("Unexpected message type (%i)" % self.type)
@@ -172,18 +406,23 @@ class Message(object):
                                       (msg.payload_len, len(self.payload)))
 
 
+# Message.Type member for each value of the type byte, None for unknown types. A lookup in the
+# enum costs more than the rest of the header decoding.
+_message_types = tuple(Message.Type._value2member_map_.get(n) for n in range(256))
+
+
 @Message.message(Message.Type.Initialize)
 class MessageInitialize(Message):
     client_protocol_version = 0
-    client_vendor_id = "ZZ"
+    client_vendor_id = b"ZZ"
 
     @property
     def sub_address(self):
-        return str(self.payload)
+        return self.payload
 
     @sub_address.setter
     def sub_address(self, x):
-        self.payload = str(x)
+        self.payload = x if isinstance(x, bytes) else x.encode("ascii")
 
     @property
     def param(self):
@@ -199,6 +438,10 @@ class MessageInitializeResponse(Message):
     server_protocol_version = struct.pack("!BB", 1, 0)
     session_id = None
 
+    def __init__(self):
+        super(MessageInitializeResponse, self).__init__()  # Message.__init__() clears the param fields
+        self.server_protocol_version = MessageInitializeResponse.server_protocol_version
+
     @property
     def overlap_mode(self):
         return self.ctrl_code & 1
@@ -206,17 +449,58 @@ class MessageInitializeResponse(Message):
     @overlap_mode.setter
     def overlap_mode(self, x):
         if x:
-            self.ctrl_code = 1
+            self.ctrl_code |= 1
         else:
-            self.ctrl_code = 0
+            self.ctrl_code &= ~1
+
+    @property
+    def encryption_mandatory(self):  # HiSLIP 2.0, the client has to start TLS before sending data
+        return bool(self.ctrl_code & 2)
+
+    @encryption_mandatory.setter
+    def encryption_mandatory(self, x):
+        if x:
+            self.ctrl_code |= 2
+        else:
+            self.ctrl_code &= ~2
+
+    @property
+    def initial_encryption(self):  # HiSLIP 2.0, the client should start TLS right after initialization
+        return bool(self.ctrl_code & 4)
+
+    @initial_encryption.setter
+    def initial_encryption(self, x):
+        if x:
+            self.ctrl_code |= 4
+        else:
+            self.ctrl_code &= ~4
 
     @property
     def param(self):
-        return repack("!HH", "!I", self.server_protocol_version, self.session_id)[0]
+        return repack("!2sH", "!I", self.server_protocol_version, self.session_id)[0]
 
     @param.setter
     def param(self, x):
-        self.server_protocol_version, self.session_id = repack("!I", "!HH", x)
+        self.server_protocol_version, self.session_id = repack("!I", "!2sH", x)
+
+
+@Message.message(Message.Type.FatalError)
+class MessageFatalError(Message):
+    # Error codes, HiSLIP 6.2
+    UNIDENTIFIED = 0
+    POORLY_FORMED_HEADER = 1
+    CHANNELS_NOT_ESTABLISHED = 2
+    INVALID_INITIALIZATION = 3
+    MAXIMUM_CLIENTS_EXCEEDED = 4
+    SECURE_CONNECTION_FAILED = 5  # HiSLIP 2.0
+
+    @property
+    def error_code(self):
+        return self.ctrl_code
+
+    @error_code.setter
+    def error_code(self, x):
+        self.ctrl_code = x
 
 
 @Message.message(Message.Type.AsyncInitialize)
@@ -238,8 +522,8 @@ class MessageAsyncInitializeResponse(Message):
 
     @server_vendor_id.setter
     def server_vendor_id(self, x):
-        assert len(str(x)) == 2
-        self.param = repack("!xx2s", "!I", str(x))[0]
+        assert len(x) == 2
+        self.param = repack("!xx2s", "!I", x)[0]
 
 
 @Message.message(Message.Type.AsyncMaximumMessageSize)
@@ -247,7 +531,7 @@ class MessageAsyncMaximumMessageSize(Message):
     @property
     def max_size(self):
         assert self.payload_len == 8
-        return struct.unpack("!Q", self.payload)
+        return struct.unpack("!Q", self.payload)[0]
 
     @max_size.setter
     def max_size(self, x):
@@ -340,6 +624,32 @@ class MessageAsyncStatusResponse(MessageData):
         self.ctrl_code = x
 
 
+@Message.message(Message.Type.AsyncServiceRequest)
+class MessageAsyncServiceRequest(Message):
+    @property
+    def status(self):
+        return self.ctrl_code
+
+    @status.setter
+    def status(self, x):
+        self.ctrl_code = x
+
+
+@Message.message(Message.Type.AsyncStartTLS)
+class MessageAsyncStartTLS(MessageData):
+    pass  # The message id is the one of the last message sent on the sync channel
+
+
+@Message.message(Message.Type.AsyncStartTLSResponse)
+class MessageAsyncStartTLSResponse(MessageData):
+    pass  # ctrl_code: 0 failure, 1 success
+
+
+@Message.message(Message.Type.StartTLS)
+class MessageStartTLS(MessageData):
+    pass
+
+
 @Message.message(Message.Type.DataEnd)
 class MessageDataEnd(MessageData):
     pass
@@ -374,6 +684,100 @@ class MessageTrigger(MessageData):
     pass
 
 
+@Message.message(Message.Type.VendorSharedMemoryRequest)
+class MessageSharedMemoryRequest(Message):
+    """
+    Offer a shared memory file for bulk data, see hislip_server.shm. Sent by the client on the sync channel.
+    """
+    _struct_size = struct.Struct("!Q")
+
+    @property
+    def size(self):
+        return self._struct_size.unpack_from(self.payload)[0]
+
+    @property
+    def path(self):
+        return self.payload[self._struct_size.size:].decode("utf-8")
+
+    def set_region(self, path, size):
+        self.payload = self._struct_size.pack(size) + path.encode("utf-8")
+
+
+@Message.message(Message.Type.VendorSharedMemoryResponse)
+class MessageSharedMemoryResponse(Message):
+    @property
+    def accepted(self):
+        return self.ctrl_code & 1
+
+    @accepted.setter
+    def accepted(self, x):
+        self.ctrl_code = 1 if x else 0
+
+
+@Message.message(Message.Type.VendorSharedMemoryData)
+class MessageSharedMemoryData(MessageData):
+    """
+    A Data message whose payload is in the shared memory ring, the message payload is (offset, length).
+    """
+    _struct_segment = struct.Struct("!QQ")
+
+    @property
+    def segment(self):
+        return self._struct_segment.unpack(self.payload)
+
+    @segment.setter
+    def segment(self, x):
+        self.payload = self._struct_segment.pack(*x)
+
+
+@Message.message(Message.Type.VendorSharedMemoryDataEnd)
+class MessageSharedMemoryDataEnd(MessageSharedMemoryData):
+    pass
+
+
+class SingleFlight(object):
+    """
+    Executes a function only once for concurrent calls with the same key, the callers arriving while
+    it runs get the same result (or exception).
+    """
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key => _Call in flight
+        self.calls = 0  # Executions of the function
+        self.shared = 0  # Calls answered by the execution of another caller
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
 class HislipClient(object):
     def __init__(self):
         self.instr_sub_addr = None
@@ -391,6 +795,9 @@ class HislipClient(object):
         self.message_id = 0xffffff00
         self.MAV = False  # Message available for client. See HiSLIP 4.14.1
         self.RMT_expected = False
+        self.shared_memory = None  # shm.SharedMemoryRegion, if negotiated
+        self.response_pending = False  # A deferred response has not been sent yet
+        self.backlog = deque()  # (program message, message id) received while a response was pending
 
     def get_stb(self):
         if self.MAV:
@@ -408,27 +815,151 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
 
     msg_handler = _MsgHandler()
 
+    disable_nagle_algorithm = True  # Small responses must not wait for the ACK of the previous segment
+
+    # Responses at least this large are sent through the shared memory ring, if the client has set one up
+    shared_memory_threshold = 64 * 1024
+
     def __init__(self, request, client_address, server):
         """
         :param socket.Socket request:
         :param client_address:
         :param HislipServer server:
         """
-        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
         self.server = server
         self.client = None
         self.sync_conn = None
         self.session_id = None
+        self.send_lock = threading.RLock()  # Deferred responses and service requests are sent from other threads
+        self.tls = None  # TLSSocket once the channel is encrypted
+        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)  # Calls handle()
+
+    # Payloads larger than this are sent directly from the payload buffer instead of being copied into one string
+    # together with the header.
+    copy_limit = 64 * 1024
+
+    def setup(self):
+        if getattr(self.request, "family", None) not in (socket.AF_INET, socket.AF_INET6):
+            self.disable_nagle_algorithm = False  # TCP_NODELAY is only valid for TCP sockets
+        super(HislipHandler, self).setup()
 
     def send_msg(self, message):
         logger.debug(" resp: %s", message)
-        if message.type == Message.Type.Data or message.type == Message.Type.DataEnd:
+        if message.type in (Message.Type.Data, Message.Type.DataEnd,
+                            Message.Type.VendorSharedMemoryData, Message.Type.VendorSharedMemoryDataEnd):
             with self.client.lock:  # HiSLIP 4.14.1
                 self.client.MAV = True
-        self.wfile.write(message.pack())
+        with self.send_lock:
+            if isinstance(message.payload, _FilePayload):
+                message.payload.send_to(self.connection, message.pack_header())
+            elif message.payload_len <= self.copy_limit:
+                self.wfile.write(message.pack())
+            else:
+                self.connection.sendall(message.pack_header())
+                self.connection.sendall(message.payload)
+
+    def send_response(self, payload, message_id=None):
+        """
+        Send a response to the current program message. The payload is split into Data messages
+        according to the maximum message size of the client, the last fragment is sent as DataEnd.
+
+        :param payload: bytes or any object supporting the buffer protocol, or a list of them. The
+            parts of a list are sent one after the other without joining them, e.g. the header of
+            a binary block followed by the array holding the data. An iterator of parts is consumed
+            while sending, so the response can be produced in chunks. Lists can contain :class:`FileResponse`
+            parts, which are sent from the file by the kernel.
+        :param message_id: of the program message, default the last one received
+        """
+        if isinstance(payload, FileResponse):
+            parts = [payload]
+        elif isinstance(payload, (list, tuple)):
+            parts = [part if isinstance(part, FileResponse) else byte_view(part) for part in payload]
+        else:
+            try:
+                parts = [byte_view(payload)]
+            except TypeError:
+                parts = (byte_view(part) for part in payload)
+        with self.client.lock:
+            if message_id is None:
+                message_id = self.client.message_id
+            fragment = self.client.max_message_size or self.server.max_message_size
+            region = self.client.shared_memory
+        fragment = max(int(fragment) - Message._struct_hdr.size, 1)
+        with self.send_lock:
+            self._send_parts(parts, message_id, fragment, region)
+
+    def _send_parts(self, parts, message_id, fragment, region):
+        if isinstance(parts, list) and any(isinstance(part, FileResponse) for part in parts):
+            payloads = [_FilePayload(pieces) for pieces in _file_fragments(parts, fragment)]
+            for n, payload in enumerate(payloads):
+                response = MessageDataEnd() if n == len(payloads) - 1 else MessageData()
+                response.message_id = message_id
+                response.payload = payload
+                self.send_msg(response)
+            return
+
+        if region is not None and isinstance(parts, list) and \
+                sum(len(part) for part in parts) >= self.shared_memory_threshold:
+            segments = region.download.write(parts)
+            if segments is not None:
+                for n, segment in enumerate(segments):
+                    last = n == len(segments) - 1
+                    response = MessageSharedMemoryDataEnd() if last else MessageSharedMemoryData()
+                    response.message_id = message_id
+                    response.segment = segment
+                    self.send_msg(response)
+                return
+
+        chunks = self._fragments(parts, fragment)
+        chunk = next(chunks)
+        for next_chunk in chunks:  # Look one fragment ahead, the last one is sent as DataEnd
+            response = MessageData()
+            response.message_id = message_id
+            response.payload = chunk
+            self.send_msg(response)
+            chunk = next_chunk
+        response = MessageDataEnd()
+        response.message_id = message_id
+        response.payload = chunk
+        self.send_msg(response)
+
+    def _fragments(self, parts, fragment):
+        """
+        Split the response parts into message payloads of at most `fragment` bytes. Consecutive
+        small parts are joined, large parts are only sliced. Yields at least one payload.
+        """
+        small = []
+        small_len = 0
+        empty = True
+        for part in parts:
+            if len(part) <= self.copy_limit and small_len + len(part) <= fragment:
+                small.append(part)
+                small_len += len(part)
+                continue
+            if small:
+                yield b"".join(p.tobytes() for p in small)
+                small, small_len, empty = [], 0, False
+            for offset in range(0, len(part), fragment):
+                yield part[offset:offset + fragment]
+                empty = False
+        if small or empty:
+            yield b"".join(p.tobytes() for p in small)
+
+    def _read_message(self):
+        """
+        Read the next message from the connection. Override this to observe the inbound message stream.
+
+        :rtype: Message
+        """
+        return Message.parse(self.rfile)
 
     def init_connection(self):
-        init = Message.parse(self.rfile)
+        self.initialize(self._read_message())
+
+    def initialize(self, init):
+        """
+        Handle the first message of the connection, which tells the sync and async channel apart.
+        """
         if init.type == Message.Type.Initialize:
             self.sync_init(init)
         elif init.type == Message.Type.AsyncInitialize:
@@ -449,19 +980,28 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
             self.client.session_id = session_id
             self.client.sync_handler = self
             self.client.instr_sub_addr = msg.payload
+        self.session_id = session_id
         self.sync_conn = True
 
         logger.info("Connection from %r to %s", self.client_address, msg.payload)
 
-        error = self.server.connection_request(self.client)
+        if self.server.require_tls and not self.server.supports_tls(msg):
+            error = MessageFatalError()
+            error.error_code = MessageFatalError.SECURE_CONNECTION_FAILED
+            error.payload = b"Encryption is mandatory, HiSLIP 2.0 required"
+        else:
+            error = self.server.connection_request(self.client)
         if error is not None:
             self.send_msg(error)
             self.server.client_disconnect(self.client)
-            raise error
+            raise HislipProtocolError("Connection refused, %r" % error.payload)
 
         response = MessageInitializeResponse()
         response.overlap_mode = self.server.overlap_mode
-        response.session_id = self.session_id
+        response.session_id = session_id
+        if self.server.supports_tls(msg):
+            response.server_protocol_version = PROTOCOL_VERSION_2
+            response.encryption_mandatory = response.initial_encryption = self.server.require_tls
         self.send_msg(response)
         # Setup of sync channel complete, wait for connection of async channel
 
@@ -520,7 +1060,7 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
         with self.client.lock:
             if msg.RMT:
                 self.client.MAV = False
-            response.status = self.client.get_stb()
+            response.status = self.client.get_stb() | self.server.read_stb()
         self.send_msg(response)
 
     @msg_handler(Message.Type.AsyncMaximumMessageSize)
@@ -534,6 +1074,50 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
             response.max_size = int(self.server.max_message_size)
             self.send_msg(response)
 
+    @msg_handler(Message.Type.AsyncStartTLS)
+    def async_start_tls(self, msg):
+        """
+        Answer AsyncStartTLS and encrypt the async channel. The sync channel follows with StartTLS.
+        """
+        response = MessageAsyncStartTLSResponse()
+        with self.client.lock:
+            response.message_id = self.client.message_id or 0
+        with self.send_lock:  # No service request may be sent between the response and the handshake
+            context = self.server.ssl_context
+            response.ctrl_code = 0 if context is None or self.tls is not None else 1
+            self.send_msg(response)
+            if response.ctrl_code:
+                self.start_tls(context)
+
+    @msg_handler(Message.Type.StartTLS)
+    def sync_start_tls(self, msg):
+        if self.server.ssl_context is None or self.tls is not None:
+            raise HislipProtocolError("Unexpected StartTLS")
+        with self.send_lock:
+            self.start_tls(self.server.ssl_context)
+
+    def start_tls(self, context):
+        """
+        Perform the server side TLS handshake on this channel and continue encrypted.
+        """
+        import ssl
+
+        from hislip_server.tls import TLSSocket
+
+        # The first bytes of the handshake may already be read into the buffer of rfile
+        received = self.rfile.peek(1)
+        self.rfile.read(len(received))
+        try:
+            self.tls = TLSSocket.server(self.connection, context, received)
+        except (ssl.SSLError, socket.error) as e:
+            logger.warning("TLS handshake with %r failed: %s", self.client_address, e)
+            raise HislipConnectionClosed(str(e))
+        self.connection = self.tls
+        self.rfile = self.tls.makefile("rb")
+        self.wfile = self.tls.makefile("wb", 0)
+        logger.info("%s channel of session %i encrypted with %s%s", "Sync" if self.sync_conn else "Async",
+                    self.session_id, self.tls.version(), ", session resumed" if self.tls.session_reused else "")
+
     @msg_handler(Message.Type.Data)
     def sync_data(self, msg):
         """
@@ -551,17 +1135,103 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
                 self.client.MAV = False
             self.client.sync_buffer.write(msg.payload)
             self.client.message_id = msg.message_id
-            self.client.sync_buffer.seek(0)
-            data = self.client.sync_buffer.read()
-            logger.debug("DataEnd: %r" % data)
-            if len(data) > 2 and data[-2] == "?":
-                response = MessageDataEnd()
-                response.message_id = self.client.message_id
-                response.payload = b"RS,123,456,798\n"
-                self.send_msg(response)
-
-            # FIXME: pass data to application
+            data = self.client.sync_buffer.getvalue()
             self.client.sync_buffer = StringIO()  # Clear the buffer
+            if self.client.response_pending:
+                # Keep the responses in order, executed when the pending response has been sent
+                self.client.backlog.append((data, msg.message_id))
+                return
+        logger.debug("DataEnd: %r", data[:50])
+        self._execute(data, msg.message_id)
+
+    def _execute(self, data, message_id):
+        """
+        Pass a program message to the server and send the response. A Future response (e.g. of ``*OPC?``)
+        is sent when it is done, without blocking this thread; the program messages arriving meanwhile
+        are queued in the backlog of the client.
+        """
+        while True:
+            response = self._call_application(data, message_id)
+            if is_future(response):
+                with self.client.lock:
+                    self.client.response_pending = True
+                response.add_done_callback(lambda future: self._deferred_response(future, message_id))
+                return
+            if response is not None:
+                self.send_response(response, message_id)
+            with self.client.lock:
+                if not self.client.backlog:
+                    self.client.response_pending = False
+                    return
+                data, message_id = self.client.backlog.popleft()
+
+    def _call_application(self, data, message_id):
+        """
+        Pass a program message to the application, see :meth:`HislipServer.program_message`. Override this
+        to observe the application calls.
+        """
+        return self.server.program_message(self.client, data)
+
+    def _deferred_response(self, future, message_id):
+        try:
+            response = future.result()
+            if response is not None:
+                self.send_response(response, message_id)
+        except Exception:
+            logger.exception("Deferred response to message %#x failed", message_id)
+        with self.client.lock:
+            if not self.client.backlog:
+                self.client.response_pending = False
+                return
+            data, message_id = self.client.backlog.popleft()
+        try:
+            self._execute(data, message_id)
+        except Exception:
+            logger.exception("Program message %#x failed", message_id)
+
+    @msg_handler(Message.Type.VendorSharedMemoryRequest)
+    def shared_memory_request(self, msg):
+        """
+        :param MessageSharedMemoryRequest msg:
+        """
+        response = MessageSharedMemoryResponse()
+        if self.server.allow_shared_memory:
+            from hislip_server import shm
+            try:
+                region = shm.SharedMemoryRegion.attach(msg.path, msg.size)
+            except (EnvironmentError, HislipError, ValueError) as e:
+                logger.warning("Shared memory request for %r rejected: %s", msg.path, e)
+            else:
+                with self.client.lock:
+                    old, self.client.shared_memory = self.client.shared_memory, region
+                if old is not None:
+                    old.close()
+                response.accepted = True
+        self.send_msg(response)
+
+    def _shared_memory_payload(self, msg):
+        """
+        Copy the payload of a VendorSharedMemoryData(End) message out of the upload ring.
+        """
+        region = self.client.shared_memory
+        if region is None:
+            raise HislipProtocolError("Shared memory data without a shared memory region")
+        offset, length = msg.segment
+        data = region.upload.read(offset, length).tobytes()
+        region.upload.release(length)
+        return data
+
+    @msg_handler(Message.Type.VendorSharedMemoryData)
+    def shared_memory_data(self, msg):
+        data = MessageData._copy(msg)
+        data.payload = self._shared_memory_payload(msg)
+        self.sync_data(data)
+
+    @msg_handler(Message.Type.VendorSharedMemoryDataEnd)
+    def shared_memory_data_end(self, msg):
+        data = MessageDataEnd._copy(msg)
+        data.payload = self._shared_memory_payload(msg)
+        self.sync_data_end(data)
 
     @msg_handler(Message.Type.Trigger)
     def trigger(self, msg):
@@ -578,20 +1248,40 @@ class HislipHandler(socketserver.StreamRequestHandler, object):
             prf = "async: %s"
         while True:
             try:
-                msg = Message.parse(self.rfile)
+                msg = self._read_message()
             except HislipConnectionClosed as e:
                 logger.info("Connection closed, %r", self.client_address)
                 self.server.client_disconnect(self.client)
                 break
 
             logger.debug(prf, str(msg))
-            if msg.type in self.msg_handler:
-                self.msg_handler[msg.type](self, msg)
-            else:
-                logger.warning("No handler for this message")
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        """
+        Call the handler method registered for the message type. Override this to observe message handling.
+        """
+        if self.tls is None and msg.type in _ENCRYPTED_MESSAGES and self.server.require_tls:
+            error = MessageFatalError()
+            error.error_code = MessageFatalError.SECURE_CONNECTION_FAILED
+            self.send_msg(error)
+            self.server.client_disconnect(self.client)
+            raise HislipProtocolError("%s before StartTLS, encryption is mandatory" % msg.type)
+        handler = self.msg_handler.get(msg.type)
+        if handler is not None:
+            handler(self, msg)
+        else:
+            logger.warning("No handler for this message")
+
+
+# Messages carrying instrument data, refused on plain text channels when the server requires TLS
+_ENCRYPTED_MESSAGES = frozenset([Message.Type.Data, Message.Type.DataEnd, Message.Type.Trigger,
+                                 Message.Type.VendorSharedMemoryRequest])
 
 
 class HislipServer(socketserver.ThreadingTCPServer, object):
+    supports_handoff = True  # The sessions can be handed over to another process, see hislip_server.handoff
+
     def __init__(self, *args, **kwargs):
         super(HislipServer, self).__init__(*args, **kwargs)
 
@@ -601,14 +1291,51 @@ class HislipServer(socketserver.ThreadingTCPServer, object):
 
         self.allow_reuse_address = True
 
+        self.allow_shared_memory = False  # Accept VendorSharedMemoryRequest, see hislip_server.shm
+
+        # HiSLIP 2.0 secure connections, an ssl.SSLContext with the server certificate, see hislip_server.tls
+        self.ssl_context = None
+        self.require_tls = False  # Refuse clients which don't encrypt the session
+
+        self.tracer = None  # Tracer collecting the timing of TracingHislipHandler, see hislip_server.tracing
+
+        # Execute identical queries arriving concurrently from several sessions only once, see coalesce_key()
+        self.coalesce_queries = False
+        self.single_flight = SingleFlight()
+
         self.client_lock = threading.RLock()
         self.clients = dict()  # session id => Client()
         self._last_session_id = 0
 
     def read_stb(self):
-        # Override this in a subclass
+        """
+        Override this in a subclass to report the status of the device. MAV is added per session.
+
+        :return: the status byte
+        """
         return 0
 
+    def service_request(self, status):
+        """
+        Send AsyncServiceRequest with the status byte `status` to all sessions.
+        """
+        with self.client_lock:
+            handlers = [client.async_handler for client in self.clients.values() if client.async_handler is not None]
+        for handler in handlers:
+            msg = MessageAsyncServiceRequest()
+            msg.status = status | handler.client.get_stb()
+            try:
+                handler.send_msg(msg)
+            except socket.error as e:
+                logger.info("Service request to session %s failed: %s", handler.client.session_id, e)
+
+    def supports_tls(self, init):
+        """
+        :param MessageInitialize init:
+        :return: True if the session can be encrypted, i.e. TLS is configured and the client speaks HiSLIP 2.0
+        """
+        return self.ssl_context is not None and init.client_protocol_version >= 0x0200
+
     def new_session_id(self):
         self._last_session_id += 1
         return self._last_session_id
@@ -635,6 +1362,51 @@ class HislipServer(socketserver.ThreadingTCPServer, object):
         with self.client_lock:
             self.clients[client.session_id] = client
 
+    def coalesce_key(self, client, data):
+        """
+        Identifies the program messages which can share the response of an identical message executed
+        concurrently for another session. The default accepts a single query without parameters, like
+        ``MEAS?``; override this for a smarter comparison or to exclude queries with side effects.
+
+        :param HislipClient client:
+        :param bytes data: The program message
+        :return: a hashable key, equal for messages with the same response, or None to execute the message
+        """
+        data = data.strip()
+        if data.endswith(b"?") and not data.startswith(b"*") and b";" not in data and b" " not in data:
+            return client.instr_sub_addr, data.upper()
+        return None
+
+    def program_message(self, client, data):
+        """
+        Called by the sync channel handler for each program message, passes it to :meth:`data_received`.
+        With :attr:`coalesce_queries` set, concurrent messages with the same :meth:`coalesce_key` are
+        passed only once and every session gets the response, each in its own DataEnd.
+        """
+        key = self.coalesce_key(client, data) if self.coalesce_queries else None
+        if key is None:
+            return self.data_received(client, data)
+        return self.single_flight.do(key, self._shared_response, client, data)
+
+    def _shared_response(self, client, data):
+        response = self.data_received(client, data)
+        if is_future(response):
+            return then(response, _reusable)
+        return _reusable(response)
+
+    def data_received(self, client, data):
+        """
+        Called from the sync channel handler when a complete program message (Data ... DataEnd)
+        has been received. Override this in a subclass to pass the data to the application.
+
+        :param HislipClient client:
+        :param bytes data: The program message
+        :return: None, or the response payload (bytes or a buffer) to send to the client, or a Future of it
+        """
+        logger.warning("Program message %r discarded, no application is attached. See hislip_server.scpi "
+                       "for an SCPI instrument and hislip_server.simulator for a simulated one.", data[:50])
+        return None
+
     def client_disconnect(self, client):
         with self.client_lock:
             try:
@@ -653,21 +1425,72 @@ class HislipServer(socketserver.ThreadingTCPServer, object):
                     client.async_handler.request.shutdown(socket.SHUT_RDWR)
             except socket.error:
                 pass
+            if client.shared_memory is not None:
+                client.shared_memory.close()
+                client.shared_memory = None
 
 
-def _main():
-    import sys
-    logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
+def _file_fragments(parts, fragment):
+    """
+    Split response parts including FileResponses into lists of pieces of at most `fragment` bytes.
+    """
+    pieces, size = [], 0
+    for part in parts:
+        pos = 0
+        while pos < len(part):
+            if size == fragment:
+                yield pieces
+                pieces, size = [], 0
+            n = min(len(part) - pos, fragment - size)
+            pieces.append(part[pos:pos + n])
+            pos += n
+            size += n
+    yield pieces
+
+
+def _reusable(response):
+    """
+    :return: `response`, or a list of its parts if it is an iterator, which can be consumed only once
+    """
+    if response is None or isinstance(response, (bytes, list, tuple, FileResponse)):
+        return response
+    try:
+        byte_view(response)
+        return response
+    except TypeError:
+        return [byte_view(part).tobytes() for part in response]
 
-    hislip_server = HislipServer(("localhost", 4880), HislipHandler)
-    server_thread = threading.Thread(target=hislip_server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-    raw_input("Enter to end")
 
+class HislipUnixServer(socketserver.ThreadingUnixStreamServer, object):
+    """
+    A Unix domain socket listener sharing the sessions and settings of a HislipServer, for clients
+    on the same host::
 
-import stacktracer
+        tcp = HislipServer(("", 4880), HislipHandler)
+        local = HislipUnixServer("/run/hislip.sock", HislipHandler, tcp)
 
-if __name__ == "__main__":
-    stacktracer.trace_start("trace.html")
-    _main()
+    Both servers have to be served. Shared memory bulk transfers are accepted on this listener.
+    """
+    def __init__(self, path, handler, parent, *args, **kwargs):
+        """
+        :param str path: socket path, an existing socket file is replaced
+        :param HislipServer parent: server owning the sessions
+        """
+        self.parent = parent
+        if kwargs.get("bind_and_activate", True) and os.path.exists(path):
+            os.unlink(path)
+        super(HislipUnixServer, self).__init__(path, handler, *args, **kwargs)
+        self.allow_shared_memory = True
+
+    def __getattr__(self, item):
+        # Everything the handlers need beyond the listener itself comes from the parent server
+        if item == "parent":
+            raise AttributeError(item)
+        return getattr(self.parent, item)
+
+    def server_close(self):
+        super(HislipUnixServer, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+In-process loopback transport.
+
+:class:`LoopbackSocket` implements the part of the socket interface used by
+``socketserver`` request handlers and by :class:`hislip_server.client.HislipClientConnection`,
+on top of a pair of in-memory byte pipes. This makes it possible to drive the complete
+server stack, including session setup and both channels, without the kernel TCP stack,
+so codec and dispatch cost can be measured in isolation::
+
+    server = HislipServer(("loopback", 0), HislipHandler, bind_and_activate=False)
+    transport = LoopbackTransport(server)
+    with HislipClientConnection("loopback", connect=transport.connect) as conn:
+        conn.query(b"*IDN?\\n")
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import itertools
+import socket
+import sys
+import threading
+import time
+
+PY2 = sys.version_info[0] == 2
+
+
+class _Pipe(object):
+    """
+    A bounded, blocking, one directional byte stream.
+    """
+    def __init__(self, capacity=4 << 20):
+        self.capacity = capacity
+        self.cond = threading.Condition(threading.Lock())
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False  # The writing end is closed
+        self.broken = False  # The reading end is closed
+
+    def _wait(self, predicate, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("timed out")
+            self.cond.wait(remaining)
+
+    def write(self, data, timeout=None):
+        view = memoryview(data)
+        if view.itemsize != 1:
+            view = memoryview(view.tobytes())
+        offset = 0
+        with self.cond:
+            while offset < len(view):
+                self._wait(lambda: self.broken or self.eof or len(self.buf) - self.pos < self.capacity, timeout)
+                if self.broken or self.eof:
+                    raise socket.error(errno.EPIPE, "Broken pipe")
+                n = min(len(view) - offset, self.capacity - (len(self.buf) - self.pos))
+                chunk = view[offset:offset + n]
+                self.buf += chunk.tobytes() if PY2 else chunk
+                offset += n
+                self.cond.notify_all()
+
+    def read_into(self, view, nbytes, timeout=None):
+        """
+        Read at least one and at most `nbytes` bytes into `view`, returns 0 at end of stream.
+        """
+        with self.cond:
+            self._wait(lambda: self.eof or self.broken or len(self.buf) > self.pos, timeout)
+            n = min(nbytes, len(self.buf) - self.pos)
+            if n <= 0:
+                return 0
+            view[:n] = memoryview(self.buf)[self.pos:self.pos + n]
+            self.pos += n
+            if self.pos == len(self.buf):
+                del self.buf[:]
+                self.pos = 0
+            elif self.pos > self.capacity:
+                del self.buf[:self.pos]
+                self.pos = 0
+            self.cond.notify_all()
+            return n
+
+    def close_write(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def close_read(self):
+        with self.cond:
+            self.broken = True
+            self.cond.notify_all()
+
+
+class _LoopbackFile(object):
+    """
+    File object returned by LoopbackSocket.makefile(), unbuffered.
+    """
+    def __init__(self, sock, mode):
+        self._sock = sock
+        self.mode = mode
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self._sock.recv(1 << 16)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            n = self._sock.recv_into(view[pos:], size - pos)
+            if not n:
+                break
+            pos += n
+        return bytes(buf[:pos])
+
+    def peek(self, size=0):
+        return b""  # Nothing is read ahead
+
+    def readline(self, size=-1):
+        line = bytearray()
+        while size < 0 or len(line) < size:
+            c = self._sock.recv(1)
+            if not c:
+                break
+            line += c
+            if c == b"\n":
+                break
+        return bytes(line)
+
+    def write(self, data):
+        self._sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class LoopbackSocket(object):
+    """
+    One end of an in-memory stream connection, see :func:`socketpair`.
+    """
+    family = socket.AF_INET
+    type = socket.SOCK_STREAM
+
+    def __init__(self, rx, tx, name, peer):
+        self._rx = rx
+        self._tx = tx
+        self._timeout = None
+        self._name = name
+        self._peer = peer
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def setblocking(self, flag):
+        self._timeout = None if flag else 0.0
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockname(self):
+        return self._name
+
+    def getpeername(self):
+        return self._peer
+
+    def sendall(self, data):
+        self._tx.write(data, self._timeout)
+
+    def send(self, data):
+        self._tx.write(data, self._timeout)
+        return len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        return self._rx.read_into(view, nbytes or len(view), self._timeout)
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        n = self.recv_into(buf, bufsize)
+        return bytes(buf[:n])
+
+    def makefile(self, mode="r", bufsize=-1, **kwargs):
+        return _LoopbackFile(self, mode)
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            self._rx.close_read()
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self._tx.close_write()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shutdown(socket.SHUT_RDWR)
+
+
+def socketpair(capacity=4 << 20, names=(("loopback", 1), ("loopback", 2))):
+    """
+    :return: two connected LoopbackSocket instances
+    """
+    a_to_b, b_to_a = _Pipe(capacity), _Pipe(capacity)
+    return (LoopbackSocket(b_to_a, a_to_b, names[0], names[1]),
+            LoopbackSocket(a_to_b, b_to_a, names[1], names[0]))
+
+
+class LoopbackTransport(object):
+    """
+    Connects clients to a socketserver based server (e.g. HislipServer) in-process.
+
+    The server does not have to be bound or serving, each connection is handed to
+    ``server.process_request()``, which starts a handler thread for ThreadingMixIn servers.
+    """
+    def __init__(self, server, capacity=4 << 20):
+        self.server = server
+        self.capacity = capacity
+        self._ports = itertools.count(1)
+
+    def connect(self, address=None, timeout=None):
+        """
+        Open a new connection to the server, signature compatible with
+        :func:`hislip_server.client.tcp_connect`.
+
+        :rtype: LoopbackSocket
+        """
+        port = next(self._ports)
+        client, server = socketpair(self.capacity, (("loopback-client", port), ("loopback-server", 0)))
+        client.settimeout(timeout)
+        self.server.process_request(server, client.getsockname())
+        return client
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+A HiSLIP proxy multiplexing many client sessions onto a few sessions with the instrument, for
+instruments accepting only a handful of sessions::
+
+    backends = BackendPool("instrument.local", b"hislip0", size=2)
+    server = ProxyServer(("", 4880), ProxyHandler, backends=backends)
+    server.serve_forever()
+
+or ``hislip-server proxy instrument.local --backends 2``.
+
+* Program messages of all front sessions are passed to the least busy backend session, one at a
+  time per backend. A front session's messages keep their order, it has one program message in
+  flight at a time.
+* Program messages get new message ids on the backend session; the response is sent to the front
+  session with the id of its own message. Responses to earlier backend messages are discarded,
+  e.g. of a command which unexpectedly answered.
+* Whether a response is expected is decided by :meth:`ProxyServer.expects_response`, by default
+  for program messages containing a query header (``?``), not counting strings and blocks.
+* Status queries are answered from the status byte of the instrument cached for
+  :attr:`BackendPool.stb_max_age` seconds, combined with the MAV bit of the front session.
+* Lock requests are forwarded: the session holding a lock is pinned to the backend session which
+  acquired it, the other sessions wait for the remaining backends, or for the release when all of
+  them are locked.
+
+Device clear is answered by the proxy for the front session alone, it isn't forwarded since the
+backend sessions are shared.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import socket
+import threading
+import time
+
+from hislip_server.client import HISLIP_PORT
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import HislipServer
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageAsyncLockInfoResponse
+from hislip_server.hislip_server import MessageAsyncLockResponse
+from hislip_server.scpi import SCPIError
+from hislip_server.scpi import tokenize
+
+logger = logging.getLogger(__name__)
+
+MAV = 0x10
+
+# AsyncLockResponse control codes
+LOCK_FAILURE = 0
+LOCK_SUCCESS = 1
+LOCK_RELEASED_SHARED = 2
+LOCK_ERROR = 3
+
+
+class Backend(object):
+    """
+    One session with the instrument, opened on first use.
+    """
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.connection = None
+        self.lock = threading.Lock()  # Program messages, one at a time
+        self._open_lock = threading.Lock()
+        self.async_lock = threading.Lock()  # Status queries and locks on the async channel
+        self.owner = None  # Session id of the front session holding a lock through this backend
+        self.shared_name = None
+        self.users = 0  # Front sessions using or waiting for this backend
+        self.messages = 0
+
+    def open(self):
+        """
+        :rtype: HislipClientConnection
+        """
+        with self._open_lock:
+            if self.connection is None:
+                conn = HislipClientConnection(self.pool.host, self.pool.sub_address, self.pool.port,
+                                              **self.pool.connection_kwargs)
+                conn.discard_stale_responses = True
+                self.connection = conn.open()
+                logger.info("Backend session %i opened, session id %i", self.index, conn.session_id)
+            return self.connection
+
+    def reset(self, conn):
+        """
+        Close the session `conn` after an error, the next use opens a new one. Called without holding
+        :attr:`lock` or :attr:`async_lock`, it waits until the other channel isn't used either.
+        """
+        with self.lock, self.async_lock:
+            if conn is not None and conn is self.connection:
+                self.connection = None
+                conn.close()
+
+    def __repr__(self):
+        return "<Backend %i of %s:%i>" % (self.index, self.pool.host, self.pool.port)
+
+
+class BackendPool(object):
+    """
+    The sessions with the instrument shared by the front sessions of a :class:`ProxyServer`.
+
+    :param host: instrument host name
+    :param bytes sub_address: instrument sub address
+    :param port:
+    :param int size: number of backend sessions
+    :param float stb_max_age: seconds a status byte read from the instrument is reused
+    :param connection_kwargs: passed to :class:`~hislip_server.client.HislipClientConnection`
+    """
+    def __init__(self, host, sub_address=b"hislip0", port=HISLIP_PORT, size=2, stb_max_age=0.05,
+                 **connection_kwargs):
+        if size < 1:
+            raise ValueError("A backend pool needs at least one session")
+        self.host = host
+        self.sub_address = sub_address
+        self.port = port
+        self.connection_kwargs = connection_kwargs
+        self.backends = [Backend(self, index) for index in range(size)]
+        self.condition = threading.Condition()
+        self.stb_max_age = stb_max_age
+        self._stb = 0
+        self._stb_time = None
+        self._stb_lock = threading.Lock()
+        self.stb_reads = 0  # Status queries sent to the instrument
+
+    def acquire(self, session_id):
+        """
+        Reserve a backend for a program message of a front session: the one it holds a lock through, or
+        the least busy backend not locked by another session. Waits while all backends are locked.
+
+        :rtype: Backend
+        """
+        with self.condition:
+            while True:
+                backend = self._owned(session_id)
+                if backend is None:
+                    free = [b for b in self.backends if b.owner is None]
+                    if free:
+                        backend = min(free, key=lambda b: b.users)
+                if backend is not None:
+                    backend.users += 1
+                    return backend
+                self.condition.wait()
+
+    def release(self, backend):
+        with self.condition:
+            backend.users -= 1
+
+    def _owned(self, session_id):
+        for backend in self.backends:
+            if backend.owner == session_id:
+                return backend
+        return None
+
+    def execute(self, session_id, data, response_expected):
+        """
+        Send a program message through a backend session.
+
+        :return: (response or None, backend, backend message id)
+        """
+        backend = self.acquire(session_id)
+        conn = None
+        try:
+            with backend.lock:
+                conn = backend.open()
+                conn.write(data)
+                response = conn.read().tobytes() if response_expected else None
+                backend.messages += 1
+                return response, backend, conn.last_message_id
+        except (socket.error, HislipError):
+            backend.reset(conn)
+            raise
+        finally:
+            self.release(backend)
+
+    def read_stb(self):
+        """
+        :return: the status byte of the instrument, read at most every `stb_max_age` seconds
+        """
+        with self._stb_lock:  # One status query in flight, the others wait for its result
+            if self._stb_time is not None and time.time() - self._stb_time < self.stb_max_age:
+                return self._stb
+            with self.condition:  # The async channel of a locked backend may be used, too
+                backend = min(self.backends, key=lambda b: b.users)
+            conn = None
+            try:
+                with backend.async_lock:
+                    conn = backend.open()
+                    self._stb = conn.status_query()
+            except (socket.error, HislipError):
+                backend.reset(conn)
+                raise
+            self._stb_time = time.time()
+            self.stb_reads += 1
+            return self._stb
+
+    def lock(self, session_id, timeout, shared_name=b""):
+        """
+        Request a lock of the instrument for a front session, waiting up to `timeout` seconds for a backend
+        session not locked by another front session.
+
+        :return: True if granted
+        """
+        deadline = time.time() + timeout
+        reserved = False
+        with self.condition:
+            backend = self._owned(session_id)
+            while backend is None:
+                free = [b for b in self.backends if b.owner is None]
+                if free:
+                    backend = min(free, key=lambda b: b.users)
+                    backend.owner = session_id
+                    reserved = True
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        conn = None
+        try:
+            with backend.async_lock:
+                conn = backend.open()
+                # The instrument waits for the rest of the timeout
+                granted = conn.lock(int(max(deadline - time.time(), 0) * 1000), shared_name)
+        except (socket.error, HislipError):
+            backend.reset(conn)
+            granted = False
+        with self.condition:
+            if granted:
+                backend.shared_name = shared_name or None
+            elif reserved:
+                backend.owner = None
+                self.condition.notify_all()
+        return granted
+
+    def unlock(self, session_id):
+        """
+        Release the lock of a front session.
+
+        :return: an AsyncLockResponse control code
+        """
+        with self.condition:
+            backend = self._owned(session_id)
+        if backend is None:
+            return LOCK_ERROR
+        conn = None
+        try:
+            with backend.async_lock:
+                conn = backend.open()
+                conn.unlock()
+        except (socket.error, HislipError):
+            backend.reset(conn)  # Closing the session releases its locks
+        code = LOCK_SUCCESS if backend.shared_name is None else LOCK_RELEASED_SHARED
+        with self.condition:
+            backend.owner = backend.shared_name = None
+            self.condition.notify_all()
+        return code
+
+    def lock_info(self):
+        """
+        :return: (exclusive lock granted, number of locks)
+        """
+        with self.condition:
+            owned = [b for b in self.backends if b.owner is not None]
+        return any(b.shared_name is None for b in owned), len(owned)
+
+    def close(self):
+        for backend in self.backends:
+            backend.reset(backend.connection)
+
+
+class ProxyServer(HislipServer):
+    """
+    Serves the front sessions of a proxy, passing their program messages, status queries and locks to a
+    :class:`BackendPool`. Serve it with a :class:`ProxyHandler`.
+    """
+    supports_handoff = False  # The locks are held by the backend sessions of this process
+
+    def __init__(self, *args, **kwargs):
+        backends = kwargs.pop("backends", None)
+        if backends is None:
+            raise ValueError("ProxyServer needs a BackendPool")
+        super(ProxyServer, self).__init__(*args, **kwargs)
+        self.backends = backends
+
+    def expects_response(self, data):
+        """
+        Override this to tell queries apart for instruments with a different syntax.
+
+        :param bytes data: program message
+        :return: True if the instrument answers `data`
+        """
+        try:
+            for header, params in tokenize(data):
+                if header.endswith(b"?"):
+                    return True
+        except SCPIError:
+            pass  # The instrument reports the error, the units before it are executed
+        return False
+
+    def data_received(self, client, data):
+        response, backend, message_id = self.backends.execute(client.session_id, data, self.expects_response(data))
+        logger.debug("Session %i message %#x sent as message %#x of backend %i", client.session_id, client.message_id,
+                     message_id, backend.index)
+        return response
+
+    def read_stb(self):
+        return self.backends.read_stb() & ~MAV  # The proxy reads every response, MAV is per front session
+
+    def client_disconnect(self, client):
+        super(ProxyServer, self).client_disconnect(client)
+        if self.backends.unlock(client.session_id) != LOCK_ERROR:
+            logger.info("Lock of closed session %i released", client.session_id)
+
+    def server_close(self):
+        super(ProxyServer, self).server_close()
+        self.backends.close()
+
+
+class ProxyHandler(HislipHandler):
+    """
+    HislipHandler forwarding the lock requests of a session to the :class:`ProxyServer`.
+    """
+    msg_handler = HislipHandler._MsgHandler(HislipHandler.msg_handler)
+
+    @msg_handler(Message.Type.AsyncLock)
+    def async_lock(self, msg):
+        """
+        :param MessageAsyncLock msg:
+        """
+        response = MessageAsyncLockResponse()
+        if msg.request:
+            granted = self.server.backends.lock(self.session_id, msg.timeout / 1000.0, bytes(msg.payload))
+            response.ctrl_code = LOCK_SUCCESS if granted else LOCK_FAILURE
+        else:
+            response.ctrl_code = self.server.backends.unlock(self.session_id)
+        self.send_msg(response)
+
+    @msg_handler(Message.Type.AsyncLockInfo)
+    def async_lock_info(self, msg):
+        response = MessageAsyncLockInfoResponse()
+        response.exclusive_lock_granted, response.lock_count = self.server.backends.lock_info()
+        self.send_msg(response)
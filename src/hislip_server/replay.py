@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Record HiSLIP sessions and replay them as load against a server.
+
+A recording holds every message exchanged on the sync and async channel of one or
+more sessions, together with the time it was seen. Recordings are written as a
+sequence of small record headers, each followed by the message exactly as
+:meth:`Message.pack` puts it on the wire, and read back with :meth:`Message.parse`,
+so a replay exercises the same codec as the server.
+
+Record sessions by serving with :class:`RecordingHislipHandler` and a
+:class:`SessionRecorder` attached to the server::
+
+    server = HislipServer(("localhost", 4880), RecordingHislipHandler)
+    server.recorder = SessionRecorder()
+    ...
+    with open("capture.hsr", "wb") as fd:
+        server.recorder.save(fd)
+
+and replay them with :class:`LoadGenerator`, or ``python -m hislip_server.replay``.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import defaultdict
+from collections import namedtuple
+
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageAsyncInitialize
+from hislip_server.hislip_server import MessageInitialize
+from hislip_server.hislip_server import _FilePayload
+
+logger = logging.getLogger(__name__)
+
+clock = getattr(time, "perf_counter", time.time)
+
+CH_SYNC = 0
+CH_ASYNC = 1
+
+TO_SERVER = 0
+TO_CLIENT = 1
+
+# Sent by the server on its own, not in response to a client message
+SERVER_INITIATED = (Message.Type.AsyncServiceRequest, Message.Type.Interrupted, Message.Type.AsyncInterrupted)
+
+RecordedMessage = namedtuple("RecordedMessage", ["timestamp", "channel", "direction", "message"])
+
+
+class SessionRecording(object):
+    """
+    All messages of one HiSLIP session, ordered by time relative to the session start.
+    """
+    _magic = b"HSREC1\n"
+    _struct_rec = struct.Struct("!IdBB")  # session index, timestamp, channel, direction
+
+    def __init__(self, events=None):
+        self.events = list(events or [])
+
+    def add(self, timestamp, channel, direction, message):
+        self.events.append(RecordedMessage(timestamp, channel, direction, message))
+
+    def sort(self):
+        self.events.sort(key=lambda ev: ev.timestamp)
+        if self.events:
+            t0 = self.events[0].timestamp
+            self.events = [ev._replace(timestamp=ev.timestamp - t0) for ev in self.events]
+
+    @property
+    def duration(self):
+        if not self.events:
+            return 0.0
+        return self.events[-1].timestamp - self.events[0].timestamp
+
+    def channel_requests(self, channel):
+        """
+        Pair every client message on `channel` with the number of server messages that answered it.
+
+        The Initialize/AsyncInitialize handshake is not included, it is always performed by the replay.
+        Messages the server sends on its own (:data:`SERVER_INITIATED`) aren't counted as responses.
+
+        :return: list of (RecordedMessage, expected response count)
+        """
+        requests = []
+        for ev in self.events:
+            if ev.channel != channel:
+                continue
+            if ev.direction == TO_SERVER:
+                if ev.message.type in (Message.Type.Initialize, Message.Type.AsyncInitialize):
+                    continue
+                requests.append([ev, 0])
+            elif requests and ev.message.type not in SERVER_INITIATED:
+                requests[-1][1] += 1
+        return [tuple(r) for r in requests]
+
+    @classmethod
+    def save_all(cls, recordings, fd):
+        """
+        Write a list of recordings to the binary file object `fd`.
+        """
+        fd.write(cls._magic)
+        for idx, rec in enumerate(recordings):
+            for ev in rec.events:
+                fd.write(cls._struct_rec.pack(idx, ev.timestamp, ev.channel, ev.direction))
+                fd.write(ev.message.pack())
+
+    @classmethod
+    def load_all(cls, fd):
+        """
+        Read recordings written by :meth:`save_all` from the binary file object `fd`.
+
+        :rtype: list of SessionRecording
+        """
+        if fd.read(len(cls._magic)) != cls._magic:
+            raise HislipError("Not a HiSLIP session recording")
+        sessions = defaultdict(cls)
+        while True:
+            hdr = fd.read(cls._struct_rec.size)
+            if not hdr:
+                break
+            if len(hdr) != cls._struct_rec.size:
+                raise HislipError("Truncated session recording")
+            idx, timestamp, channel, direction = cls._struct_rec.unpack(hdr)
+            sessions[idx].add(timestamp, channel, direction, Message.parse(fd))
+        return [sessions[idx] for idx in sorted(sessions)]
+
+
+class SessionRecorder(object):
+    """
+    Collects the messages seen by :class:`RecordingHislipHandler` instances, grouped by session.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = dict()  # session id => SessionRecording
+
+    def add_events(self, session_id, events):
+        with self.lock:
+            rec = self.sessions.setdefault(session_id, SessionRecording())
+            rec.events.extend(events)
+
+    def recordings(self):
+        """
+        :rtype: list of SessionRecording
+        """
+        with self.lock:
+            recs = [self.sessions[sid] for sid in sorted(self.sessions)]
+        for rec in recs:
+            rec.sort()
+        return recs
+
+    def save(self, fd):
+        SessionRecording.save_all(self.recordings(), fd)
+
+
+class RecordingHislipHandler(HislipHandler):
+    """
+    A HislipHandler which records all messages of the connection into ``server.recorder``.
+    """
+    def setup(self):
+        super(RecordingHislipHandler, self).setup()
+        self._rec_lock = threading.Lock()
+        self._rec_events = []
+
+    def _record(self, direction, message):
+        channel = CH_SYNC if self.sync_conn in (None, True) else CH_ASYNC
+        if message.type in (Message.Type.AsyncInitialize, Message.Type.AsyncInitializeResponse):
+            channel = CH_ASYNC
+        with self._rec_lock:
+            self._rec_events.append(RecordedMessage(clock(), channel, direction, message))
+
+    def _read_message(self):
+        msg = super(RecordingHislipHandler, self)._read_message()
+        self._record(TO_SERVER, msg)
+        return msg
+
+    def send_msg(self, message):
+        if isinstance(message.payload, _FilePayload):
+            recorded = type(message)._copy(message)
+            recorded.payload = message.payload.tobytes()  # The file can change until the recording is saved
+            self._record(TO_CLIENT, recorded)
+        else:
+            self._record(TO_CLIENT, message)
+        super(RecordingHislipHandler, self).send_msg(message)
+
+    def finish(self):
+        recorder = getattr(self.server, "recorder", None)
+        if recorder is not None and self.session_id is not None:
+            with self._rec_lock:
+                events, self._rec_events = self._rec_events, []
+            recorder.add_events(self.session_id, events)
+        super(RecordingHislipHandler, self).finish()
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return float("nan")
+    k = int(round(p / 100.0 * (len(values) - 1)))
+    return values[min(max(k, 0), len(values) - 1)]
+
+
+class ReplayStats(object):
+    """
+    Thread safe collection of per message type latencies and counters.
+    """
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # Message.Type => [seconds]
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.start_time = None
+        self.end_time = None
+
+    def add(self, msg_type, latency, sent=0, received=0):
+        with self.lock:
+            self.latencies[msg_type].append(latency)
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    @property
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    def report(self):
+        """
+        :return: dict with overall throughput and a latency summary per message type
+        """
+        elapsed = self.elapsed or float("nan")
+        types = dict()
+        with self.lock:
+            for msg_type, values in self.latencies.items():
+                values = sorted(values)
+                summary = {
+                    "count": len(values),
+                    "rate": len(values) / elapsed,
+                    "mean": sum(values) / len(values),
+                    "max": values[-1],
+                }
+                for p in self.percentiles:
+                    summary["p%i" % p] = percentile(values, p)
+                types[Message.Type(msg_type).name] = summary
+            return {
+                "elapsed": self.elapsed,
+                "messages": sum(s["count"] for s in types.values()),
+                "errors": self.errors,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "send_rate": self.bytes_sent / elapsed,
+                "receive_rate": self.bytes_received / elapsed,
+                "types": types,
+            }
+
+
+class ReplaySession(object):
+    """
+    A virtual client replaying one SessionRecording over a fresh sync/async socket pair.
+    """
+    def __init__(self, address, recording, stats, speed=1.0, timeout=10.0, sub_address=None):
+        """
+        :param address: (host, port) of the server
+        :param SessionRecording recording:
+        :param ReplayStats stats:
+        :param float speed: time compression factor, 0 replays without any delays
+        :param float timeout: socket timeout while waiting for responses
+        :param sub_address: overrides the recorded instrument sub address
+        """
+        self.address = address
+        self.recording = recording
+        self.stats = stats
+        self.speed = speed
+        self.timeout = timeout
+        self.sub_address = sub_address
+        self.sync_sock = self.sync_fd = None
+        self.async_sock = self.async_fd = None
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile("rb")
+
+    def _handshake(self):
+        init = None
+        for ev in self.recording.events:
+            if ev.direction == TO_SERVER and ev.message.type == Message.Type.Initialize:
+                init = ev.message
+                break
+        if init is None:
+            raise HislipError("Recording does not contain an Initialize message")
+        if self.sub_address is not None:
+            init = MessageInitialize._copy(init)  # The recording is shared by the virtual clients
+            init.payload = self.sub_address
+
+        t0 = clock()
+        self.sync_sock, self.sync_fd = self._connect()
+        self.sync_sock.sendall(init.pack())
+        response = Message.parse(self.sync_fd)
+        if response.type != Message.Type.InitializeResponse:
+            raise HislipError("Initialize rejected: %s" % response)
+
+        async_init = MessageAsyncInitialize()
+        async_init.session_id = response.session_id
+        self.async_sock, self.async_fd = self._connect()
+        self.async_sock.sendall(async_init.pack())
+        Message.parse(self.async_fd)
+        self.stats.add(Message.Type.Initialize, clock() - t0)
+
+    def _replay_channel(self, sock, fd, requests, start):
+        for ev, expected in requests:
+            if self.speed:
+                delay = start + ev.timestamp / self.speed - clock()
+                if delay > 0:
+                    time.sleep(delay)
+            data = ev.message.pack()
+            t0 = clock()
+            received = 0
+            try:
+                sock.sendall(data)
+                while expected:
+                    msg = Message.parse(fd)
+                    if msg.type not in SERVER_INITIATED:
+                        received += msg.payload_len
+                        expected -= 1
+            except (socket.error, HislipError) as e:
+                logger.warning("Replay of %s failed: %r", ev.message.type, e)
+                self.stats.add_error()
+                return
+            self.stats.add(ev.message.type, clock() - t0, len(data), received)
+
+    def close(self):
+        for sock, fd in ((self.sync_sock, self.sync_fd), (self.async_sock, self.async_fd)):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            fd.close()
+            sock.close()
+
+    def run(self):
+        try:
+            self._handshake()
+            start = clock()
+            async_thread = threading.Thread(target=self._replay_channel,
+                                            args=(self.async_sock, self.async_fd,
+                                                  self.recording.channel_requests(CH_ASYNC), start))
+            async_thread.start()
+            self._replay_channel(self.sync_sock, self.sync_fd, self.recording.channel_requests(CH_SYNC), start)
+            async_thread.join()
+        except (socket.error, HislipError) as e:
+            logger.warning("Replay handshake failed: %r", e)
+            self.stats.add_error()
+        finally:
+            self.close()
+
+
+class LoadGenerator(object):
+    """
+    Replays recorded sessions with N concurrent virtual clients.
+
+    Each client replays the recordings round robin, starting at a different offset, until it
+    has completed `iterations` sessions.
+    """
+    def __init__(self, address, recordings, clients=1, iterations=1, speed=1.0, timeout=10.0, sub_address=None):
+        if not recordings:
+            raise ValueError("No recordings to replay")
+        self.address = address
+        self.recordings = recordings
+        self.clients = clients
+        self.iterations = iterations
+        self.speed = speed
+        self.timeout = timeout
+        self.sub_address = sub_address
+
+    def _client(self, index, stats):
+        for i in range(self.iterations):
+            rec = self.recordings[(index + i) % len(self.recordings)]
+            ReplaySession(self.address, rec, stats, self.speed, self.timeout, self.sub_address).run()
+
+    def run(self):
+        """
+        :rtype: ReplayStats
+        """
+        stats = ReplayStats()
+        threads = [threading.Thread(target=self._client, args=(i, stats)) for i in range(self.clients)]
+        stats.start_time = clock()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats.end_time = clock()
+        return stats
+
+
+def format_report(report):
+    lines = ["%i messages in %.3f s, %i errors, %.1f kB/s sent, %.1f kB/s received" %
+             (report["messages"], report["elapsed"], report["errors"],
+              report["send_rate"] / 1e3, report["receive_rate"] / 1e3)]
+    lines.append("%-32s %8s %10s %10s %10s %10s" % ("type", "count", "msg/s", "p50 ms", "p90 ms", "p99 ms"))
+    for name in sorted(report["types"]):
+        s = report["types"][name]
+        lines.append("%-32s %8i %10.1f %10.3f %10.3f %10.3f" %
+                     (name, s["count"], s["rate"], s["p50"] * 1e3, s["p90"] * 1e3, s["p99"] * 1e3))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Replay recorded HiSLIP sessions against a server.")
+    parser.add_argument("recording", help="Session recording file")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4880)
+    parser.add_argument("-n", "--clients", type=int, default=1, help="Number of concurrent virtual clients")
+    parser.add_argument("-i", "--iterations", type=int, default=1, help="Sessions replayed by each client")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Time compression factor, 0 replays as fast as possible")
+    parser.add_argument("--sub-address", help="Override the recorded instrument sub address")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(args=args)
+
+    with open(args.recording, "rb") as fd:
+        recordings = SessionRecording.load_all(fd)
+    sub_address = args.sub_address.encode("ascii") if args.sub_address else None
+    gen = LoadGenerator((args.host, args.port), recordings, args.clients, args.iterations,
+                        args.speed, sub_address=sub_address)
+    report = gen.run().report()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1376 @@
+# -*- coding: utf-8 -*-
+"""
+SCPI command engine for instruments served over HiSLIP.
+
+Instrument methods are registered for one or more SCPI header patterns with :func:`scpi_command`::
+
+    class Generator(SCPIInstrument):
+        @scpi_command("[SOURce1]:FREQuency[:CW]")
+        def set_frequency(self, source, value):
+            ...
+
+        @scpi_command("[SOURce1]:FREQuency[:CW]?")
+        def frequency(self, source):
+            return self.frequency
+
+A pattern ending in ``?`` registers the query handler, otherwise the write handler. Keywords are
+written with the short form in upper case and the rest of the long form in lower case. Nodes in
+square brackets are optional, and a trailing number (or ``<name>``) marks a node which accepts a
+numeric suffix, the number being the default. The suffix values are passed to the handler in
+pattern order, followed by the parameters of the command.
+
+All patterns of an instrument class are compiled into a keyword trie the first time the class
+receives a command. Resolved headers are cached in a bounded LRU, so the cost of dispatching a
+command does not depend on the number of registered commands.
+
+Queries which only read settings can be marked cacheable with ``scpi_command(..., cache=True)``,
+their responses are then kept in the instrument's :class:`ResponseCache` (if enabled) until a
+command writes to the same subtree of the command tree.
+
+Long running commands return a :class:`concurrent.futures.Future` instead of blocking the handler
+thread, they are tracked as pending operations for ``*OPC``, ``*OPC?`` and ``*WAI``. A query
+returning a Future is answered when it is done.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import inspect
+import itertools
+import logging
+import re
+import threading
+import time
+
+from concurrent.futures import Future
+
+from hislip_server.hislip_server import FileResponse
+from hislip_server.hislip_server import HislipServer
+from hislip_server.hislip_server import byte_view
+from hislip_server.hislip_server import is_future
+from hislip_server.hislip_server import then
+
+logger = logging.getLogger(__name__)
+
+# Standard event status register bits, IEEE 488.2 chapter 11.5.1
+ESR_OPC = 0x01  # Operation complete
+ESR_QYE = 0x04  # Query error
+ESR_DDE = 0x08  # Device dependent error
+ESR_EXE = 0x10  # Execution error
+ESR_CME = 0x20  # Command error
+
+# Status byte bits, IEEE 488.2 chapter 11.2 and SCPI-99 chapter 9
+STB_EAV = 0x04  # Error queue not empty
+STB_MAV = 0x10  # Message available, maintained per session by the HiSLIP server
+STB_ESB = 0x20  # Event status bit, ESR & ESE
+STB_RQS = 0x40  # Request service
+
+_ERROR_EVENTS = ((-100, ESR_CME), (-200, ESR_EXE), (-300, ESR_DDE), (-400, ESR_QYE))
+
+
+class SCPIError(Exception):
+    """
+    An error to be reported in the SCPI error queue, see SCPI-99 chapter 21.8.
+    """
+    def __init__(self, code, message):
+        super(SCPIError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return '%i,"%s"' % (self.code, self.message)
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping with a bounded number of entries, evicting the least recently used.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value  # Move to the most recently used end
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SCPICommand(object):
+    """
+    The query and write handlers of one SCPI header pattern. Handlers are called with the
+    instrument as the first argument, followed by the suffix values and the parameters.
+    """
+    cache = None  # Cache policy of the query, see scpi_command()
+    coalesce = True  # The query may share its execution with concurrent identical queries
+
+    def __init__(self, cmd_str, query_fn=None, write_fn=None):
+        self.cmd_str = cmd_str
+        self._path = None
+        if query_fn is not None:
+            self.query = query_fn
+        if write_fn is not None:
+            self.write = write_fn
+
+    def __repr__(self):
+        return "SCPICommand(%r)" % self.cmd_str
+
+    @property
+    def path(self):
+        """
+        The long form keywords of the pattern, in upper case, e.g. ``(b"SENSE", b"FREQUENCY", b"CW")``
+        """
+        if self._path is None:
+            self._path = tuple(node.long for node in parse_pattern(self.cmd_str))
+        return self._path
+
+    def query(self, *args):
+        raise SCPIError(-113, "Undefined header; %s is not a query" % self.cmd_str)
+
+    def write(self, *args):
+        raise SCPIError(-113, "Undefined header; %s is query only" % self.cmd_str)
+
+
+def scpi_command(*patterns, **options):
+    """
+    Decorator registering an :class:`SCPIInstrument` method as handler for SCPI header `patterns`.
+
+    :param str patterns: header patterns, e.g. ``"CALCulate1:MARKer1:X?"``
+    :param cache: for queries; True to cache the responses until a write to the same subtree,
+        or the maximum age of a cached response in seconds. See :class:`ResponseCache`.
+    :param bool coalesce: for queries; False if the query has side effects, so it must not share its
+        execution with the same query of other sessions. See :meth:`SCPIServer.coalesce_key`.
+    """
+    cache = options.pop("cache", None)
+    coalesce = options.pop("coalesce", True)
+    if options:
+        raise TypeError("Unexpected keyword arguments %s" % ", ".join(sorted(options)))
+
+    def x(func):
+        func.scpi_patterns = getattr(func, "scpi_patterns", ()) + patterns
+        if cache is not None:
+            func.scpi_cache = cache
+        if not coalesce:
+            func.scpi_coalesce = False
+        return func
+    return x
+
+
+_MISSING = object()
+
+
+class ResponseCache(object):
+    """
+    Cache of the responses of queries, bounded in size with LRU eviction.
+
+    Entries are keyed by the resolved command, the suffix values and the parameters, so the
+    different spellings of a header share an entry. Only queries registered with a cache policy
+    are cached. An entry is valid until a command writes to the subtree of the query, i.e. the
+    path of the query without its last keyword, but at least its first two keywords: ``SENSe:FREQuency:STARt``
+    invalidates ``SENSe:FREQuency:CENTer?`` but not ``SENSe:BANDwidth?``. Common commands (``*RST``, ``*RCL``...)
+    invalidate all entries. A numeric cache policy additionally limits the age of the entries.
+
+    Thread safe, but the instrument lock serializes the execution anyway.
+    """
+    def __init__(self, maxsize=256, clock=getattr(time, "monotonic", time.time)):
+        self._entries = LRUCache(maxsize)
+        self._generations = collections.defaultdict(int)  # Path prefix => number of writes below it
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _subtree(cmd):
+        path = cmd.path
+        return path[:max(len(path) - 1, 2)]  # Not the top-level node shared by all subtrees
+
+    def get(self, cmd, args):
+        """
+        :param SCPICommand cmd: the query
+        :param tuple args: suffix values and parameters
+        :return: the cached value, or :data:`_MISSING`
+        """
+        try:
+            entry = self._entries.get((cmd, args))
+        except TypeError:  # Unhashable parameters, e.g. blocks
+            entry = None
+        if entry is not None:
+            value, subtree, generation, expires = entry
+            if self._generations[subtree] == generation and (expires is None or self._clock() < expires):
+                self.hits += 1
+                return value
+        self.misses += 1
+        return _MISSING
+
+    def put(self, cmd, args, value):
+        if not cmd.cache:
+            return
+        expires = None if cmd.cache is True else self._clock() + cmd.cache
+        subtree = self._subtree(cmd)
+        try:
+            self._entries.put((cmd, args), (value, subtree, self._generations[subtree], expires))
+        except TypeError:
+            pass
+
+    def invalidate(self, cmd):
+        """
+        Invalidate the entries in the subtrees of the write command `cmd`.
+        """
+        path = cmd.path
+        if path[0].startswith(b"*"):
+            self.clear()
+            return
+        for i in range(1, len(path) + 1):
+            self._generations[path[:i]] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+_PatternNode = collections.namedtuple("_PatternNode", ["short", "long", "default", "optional"])
+
+_pattern_node_re = re.compile(r":?(?P<open>\[:?)?(?P<short>[*@]?[A-Z]+)(?P<tail>[a-z]*)(?P<suffix>\d+|<\w+>)?(?P<close>\])?")
+_keyword_suffix_re = re.compile(br"^(.*?[^0-9])([0-9]+)$")
+
+
+def parse_pattern(pattern):
+    """
+    Split a header pattern into its nodes.
+
+    :param str pattern: e.g. ``"[SENSe1]:CORRection:EDELay1"`` (without ``?``)
+    :rtype: list of _PatternNode
+    """
+    nodes = []
+    pos = 0
+    while pos < len(pattern):
+        match = _pattern_node_re.match(pattern, pos)
+        if (match is None or bool(match.group("open")) != bool(match.group("close")) or
+                pos and pattern[pos] not in ":["):
+            raise ValueError("Invalid SCPI header pattern %r" % pattern)
+        short = match.group("short")
+        suffix = match.group("suffix")
+        if suffix is not None:
+            suffix = 1 if suffix.startswith("<") else int(suffix)
+        nodes.append(_PatternNode(short.encode("ascii"), (short + match.group("tail").upper()).encode("ascii"),
+                                  suffix, bool(match.group("open"))))
+        pos = match.end()
+    if not nodes or all(node.optional for node in nodes):
+        raise ValueError("Invalid SCPI header pattern %r" % pattern)
+    return nodes
+
+
+class _TreeNode(object):
+    __slots__ = ("name", "children", "leaf")
+
+    def __init__(self, name):
+        self.name = name
+        self.children = {}  # short and long form => _TreeNode
+        self.leaf = None  # (SCPICommand, suffix slots, depths accepting a suffix)
+
+
+class SCPICommandTree(object):
+    """
+    Keyword trie resolving program headers to SCPI commands.
+
+    Optional nodes are compiled by inserting every combination of present and omitted nodes, so
+    resolving a header is one dict lookup per keyword. The tree is compiled lazily, on the first
+    call to :meth:`resolve` after a command was registered.
+    """
+    def __init__(self, cache_size=1024):
+        self.commands = []
+        self.cache = LRUCache(cache_size)
+        self._root = None
+        self._lock = threading.Lock()
+
+    def register(self, cmd):
+        """
+        :param SCPICommand cmd:
+        """
+        parse_pattern(cmd.cmd_str)  # Fail early on invalid patterns
+        with self._lock:
+            self.commands.append(cmd)
+            self._root = None
+        self.cache.clear()
+
+    def compile(self):
+        root = _TreeNode(b"")
+        for cmd in self.commands:
+            nodes = parse_pattern(cmd.cmd_str)
+            optional = [i for i, node in enumerate(nodes) if node.optional]
+            for omitted in itertools.product((False, True), repeat=len(optional)):
+                omitted = set(i for i, o in zip(optional, omitted) if o)
+                self._insert(root, cmd, [(i, node) for i, node in enumerate(nodes) if i not in omitted])
+        return root
+
+    @staticmethod
+    def _insert(root, cmd, path):
+        node = root
+        depths = {}
+        for depth, (i, keyword) in enumerate(path):
+            child = node.children.get(keyword.long) or node.children.get(keyword.short)
+            if child is None:
+                child = _TreeNode(keyword.long)
+            elif child.name != keyword.long:
+                raise ValueError("%s is ambiguous with %s" % (cmd.cmd_str, child.name.decode("ascii")))
+            node.children[keyword.short] = node.children[keyword.long] = child
+            node = child
+            depths[i] = depth
+        if not path:
+            return
+        if node.leaf is not None and node.leaf[0] is not cmd:
+            raise ValueError("%s is already registered as %s" % (cmd.cmd_str, node.leaf[0].cmd_str))
+        nodes = parse_pattern(cmd.cmd_str)
+        slots = tuple((depths.get(i), node_.default) for i, node_ in enumerate(nodes) if node_.default is not None)
+        node.leaf = (cmd, slots, frozenset(depth for depth, _ in slots if depth is not None))
+
+    def resolve(self, header):
+        """
+        Find the command for a program header.
+
+        :param bytes header: the header without the trailing ``?``, e.g. ``b":SENS2:FREQ:STAR"``
+        :return: (SCPICommand, tuple of suffix values)
+        :raises SCPIError: for undefined headers
+        """
+        hit = self.cache.get(header)
+        if hit is not None:
+            return hit
+        root = self._root
+        if root is None:
+            with self._lock:
+                if self._root is None:
+                    self._root = self.compile()
+                root = self._root
+
+        node = root
+        suffixes = []
+        for keyword in header.lstrip(b":").upper().split(b":"):
+            child = node.children.get(keyword)
+            value = None
+            if child is None:
+                match = _keyword_suffix_re.match(keyword)
+                if match is not None:
+                    child = node.children.get(match.group(1))
+                    value = int(match.group(2))
+                if child is None:
+                    raise SCPIError(-113, "Undefined header; %s" % header.decode("latin-1"))
+            suffixes.append(value)
+            node = child
+        if node.leaf is None:
+            raise SCPIError(-113, "Undefined header; %s" % header.decode("latin-1"))
+
+        cmd, slots, accepts_suffix = node.leaf
+        for depth, value in enumerate(suffixes):
+            if value is not None and depth not in accepts_suffix:
+                raise SCPIError(-114, "Header suffix out of range; %s" % header.decode("latin-1"))
+        indices = tuple(default if depth is None or suffixes[depth] is None else suffixes[depth]
+                        for depth, default in slots)
+        self.cache.put(header, (cmd, indices))
+        return cmd, indices
+
+
+_header_re = re.compile(br"[ \t\r\n]*([:*]?[A-Za-z][A-Za-z0-9_:]*\??)[ \t\r]*")
+_param_re = re.compile(br"""[ \t\r\n]*((?:"(?:[^"]|"")*"|'(?:[^']|'')*'|\([^)]*\)|[^,;"'()#\n]|#[^0-9])*)""")
+_block_re = re.compile(br"[ \t\r\n]*#([0-9])")
+_separator_re = re.compile(br"[ \t\r\n]*([,;]|\Z)")
+_space_re = re.compile(br"[ \t\r\n]*\Z")
+_numeric_list_re = re.compile(br"([-+0-9.eE]+(?:,[-+0-9.eE]+)+)(?=[ \t\r\n]*(?:;|\Z))")
+
+
+def tokenize(data):
+    """
+    Split a program message into program message units, in a single pass over `data`.
+
+    String and expression parameters are returned with their quotes and parentheses, see
+    :func:`unquote`. Definite and indefinite length blocks (``#<n><length><data>``) are
+    returned as memoryviews into `data`, so they may contain any byte including ``;``.
+
+    :param bytes data: the program message
+    :return: iterator of (header, list of parameters)
+    :raises SCPIError: on syntax errors, after the units before the error have been returned
+    """
+    view = memoryview(data)
+    end = len(data)
+    pos = 0
+    while True:
+        match = _header_re.match(data, pos)
+        if match is None:
+            if _space_re.match(data, pos) is not None:
+                return  # End of message, or an empty unit after a trailing ;
+            raise SCPIError(-102, "Syntax error; invalid program header at %i" % pos)
+        header = match.group(1)
+        pos = match.end()
+        params = []
+        separator = _separator_re.match(data, pos)
+        numbers = _numeric_list_re.match(data, pos) if separator is None else None
+        if numbers is not None:  # Long lists of numbers are split in one go
+            params = numbers.group(1).split(b",")
+            separator = _separator_re.match(data, numbers.end())
+            pos = separator.end()
+        elif separator is None:  # Parameters follow
+            while True:
+                block = _block_re.match(data, pos)
+                if block is not None:
+                    pos = block.end()
+                    digits = int(block.group(1))
+                    if digits == 0:  # Indefinite length, up to the terminator
+                        stop = end - 1 if data[end - 1:] == b"\n" else end
+                        params.append(view[pos:stop])
+                        pos = stop
+                    else:
+                        length = data[pos:pos + digits]
+                        if len(length) != digits or not length.isdigit() or pos + digits + int(length) > end:
+                            raise SCPIError(-161, "Invalid block data")
+                        pos += digits
+                        params.append(view[pos:pos + int(length)])
+                        pos += int(length)
+                else:
+                    match = _param_re.match(data, pos)
+                    param = match.group(1).rstrip()
+                    if not param:
+                        raise SCPIError(-102, "Syntax error; missing parameter at %i" % pos)
+                    params.append(param)
+                    pos = match.end()
+                separator = _separator_re.match(data, pos)
+                if separator is None:
+                    raise SCPIError(-102, "Syntax error; invalid parameter at %i" % pos)
+                pos = separator.end()
+                if separator.group(1) != b",":
+                    break
+        elif separator.group(1) == b",":
+            raise SCPIError(-102, "Syntax error; unexpected , at %i" % pos)
+        else:
+            pos = separator.end()
+        yield header, params
+        if separator.group(1) != b";":
+            return
+
+
+def unquote(param):
+    """
+    :param bytes param: a string parameter, e.g. ``b'"it""s"'``
+    :return: the string data, e.g. ``b'it"s'``
+    """
+    quote = param[:1]
+    if quote not in (b'"', b"'") or param[-1:] != quote or len(param) < 2:
+        raise SCPIError(-151, "Invalid string data")
+    return param[1:-1].replace(quote + quote, quote)
+
+
+# FORMat[:DATA] => NumPy type code, the byte order is added from FORMat:BORDer
+BLOCK_FORMATS = {
+    "REAL,32": "f4",
+    "REAL,64": "f8",
+    "INT,16": "i2",
+    "INT,32": "i4",
+}
+BYTE_ORDERS = {"NORM": ">", "NORMAL": ">", "SWAP": "<", "SWAPPED": "<"}
+
+
+def block_dtype(data_format="REAL,32", byte_order="NORMal"):
+    """
+    :param str data_format: e.g. ``"REAL,32"``
+    :param str byte_order: ``"NORMal"`` (big endian, the IEEE 488.2 default) or ``"SWAPped"``
+    :return: NumPy dtype string, e.g. ``">f4"``
+    """
+    try:
+        return BYTE_ORDERS[byte_order.upper()] + BLOCK_FORMATS[data_format.upper()]
+    except KeyError:
+        raise SCPIError(-224, "Illegal parameter value; %s %s" % (data_format, byte_order))
+
+
+class Block(object):
+    """
+    A definite length arbitrary block response (``#<n><length><data>``, IEEE 488.2 8.7.9).
+
+    The data is sent from the buffer of `data` without copying it, or from a file with a
+    :class:`~hislip_server.hislip_server.FileResponse`. Blocks of 1 GB (10^9 bytes)
+    or more don't fit in a definite length header and are sent as indefinite length blocks
+    (``#0<data>``), which must be the last response of the message.
+    """
+    def __init__(self, data):
+        """
+        :param data: bytes, NumPy array or any object supporting the buffer protocol, or a FileResponse
+        """
+        self.data = data if isinstance(data, FileResponse) else byte_view(data)
+
+    def header(self):
+        length = str(len(self.data))
+        if len(length) > 9:
+            return b"#0"
+        return ("#%i%s" % (len(length), length)).encode("ascii")
+
+    def parts(self):
+        return [self.header(), self.data]
+
+
+def encode_block(values, data_format="REAL,32", byte_order="NORMal"):
+    """
+    Encode numeric values as a binary block.
+
+    The array data is not copied if `values` already is a C contiguous array of the wire type,
+    e.g. ``numpy.dtype(">f4")`` for REAL,32 in NORMal byte order.
+
+    :param values: NumPy array or sequence of numbers
+    :rtype: Block
+    """
+    import numpy
+
+    return Block(numpy.ascontiguousarray(values, dtype=block_dtype(data_format, byte_order)))
+
+
+def parse_block(data):
+    """
+    Find the data of a block at the start of `data`, e.g. a response read by a client.
+
+    :param data: buffer starting with ``#``
+    :return: memoryview of the block data
+    """
+    view = byte_view(data)
+    header = view[:11].tobytes()
+    if header[:1] != b"#" or not header[1:2].isdigit():
+        raise SCPIError(-161, "Invalid block data")
+    digits = int(header[1:2])
+    if digits == 0:
+        end = len(view) - 1 if view[-1:].tobytes() == b"\n" else len(view)
+        return view[2:end]
+    length = header[2:2 + digits]
+    if len(length) != digits or not length.isdigit() or 2 + digits + int(length) > len(view):
+        raise SCPIError(-161, "Invalid block data")
+    return view[2 + digits:2 + digits + int(length)]
+
+
+def decode_block(data, data_format="REAL,32", byte_order="NORMal"):
+    """
+    Interpret block data as a NumPy array, without copying it.
+
+    :param data: block data (e.g. a block parameter as returned by :func:`tokenize`), or a
+        complete block starting with ``#``
+    :return: read only NumPy array viewing `data`
+    """
+    import numpy
+
+    view = byte_view(data)
+    if view[:1].tobytes() == b"#":
+        view = parse_block(view)
+    dtype = numpy.dtype(block_dtype(data_format, byte_order))
+    if len(view) % dtype.itemsize:
+        raise SCPIError(-161, "Invalid block data; length is not a multiple of %i" % dtype.itemsize)
+    try:
+        return numpy.frombuffer(view, dtype)
+    except AttributeError:  # NumPy on Python 2 doesn't accept memoryviews
+        return numpy.frombuffer(view.tobytes(), dtype)
+
+
+# Non-finite values are sent as these numbers, SCPI-99 7.2.1.5 and 7.2.1.6
+NAN_VALUE = 9.91e37
+INF_VALUE = 9.9e37
+
+ASCII_FORMATS = ("NR1", "NR2", "NR3")
+
+
+def _digits(values, width):
+    """
+    ASCII digits of non-negative integers, one row per value, zero padded to `width` columns.
+    """
+    import numpy
+
+    powers = 10 ** numpy.arange(width - 1, -1, -1, dtype=numpy.int64)
+    return (values[:, None] // powers % 10 + ord("0")).astype(numpy.uint8)
+
+
+def _significant(digits, minimum=1):
+    """
+    Mask dropping the leading zeros of a digit matrix, keeping at least `minimum` digits.
+    """
+    import numpy
+
+    width = digits.shape[1]
+    nonzero = digits != ord("0")
+    first = numpy.where(nonzero.any(axis=1), nonzero.argmax(axis=1), width)
+    return numpy.arange(width) >= numpy.minimum(first, width - minimum)[:, None]
+
+
+def _width(values):
+    return len(str(int(values.max()))) if len(values) else 1
+
+
+def _column(n, char, mask=True):
+    import numpy
+
+    column = numpy.full((n, 1), ord(char), dtype=numpy.uint8)
+    return column, numpy.broadcast_to(numpy.reshape(mask, (-1, 1)), (n, 1))
+
+
+def _encode_chunk(values, number_format, precision):
+    """
+    Format a 1-d array as comma separated numbers, without a trailing comma.
+
+    Each number is laid out in a fixed width row of ASCII characters with a mask of the
+    characters to keep, so the whole chunk is formatted with a handful of array operations.
+    """
+    import numpy
+
+    n = len(values)
+    if not n:
+        return b""
+    columns = []
+    if number_format == "NR1":
+        if values.dtype.kind == "f" and numpy.abs(values).max() >= 2 ** 62:
+            return encode_ascii_naive(values, number_format, precision)
+        magnitude = numpy.abs(numpy.rint(values).astype(numpy.int64))
+        columns.append(_column(n, "-", numpy.signbit(values)))
+        digits = _digits(magnitude, _width(magnitude))
+        columns.append((digits, _significant(digits)))
+    elif number_format == "NR2":
+        scale = 10 ** precision
+        magnitude = numpy.abs(values)
+        if magnitude.max() * scale >= 2 ** 62:
+            return encode_ascii_naive(values, number_format, precision)
+        scaled = numpy.rint(magnitude * scale).astype(numpy.int64)
+        columns.append(_column(n, "-", numpy.signbit(values)))
+        integer = scaled // scale
+        digits = _digits(integer, _width(integer))
+        columns.append((digits, _significant(digits)))
+        if precision:
+            columns.append(_column(n, "."))
+            digits = _digits(scaled % scale, precision)
+            columns.append((digits, numpy.ones(digits.shape, dtype=bool)))
+    elif number_format == "NR3":
+        magnitude = numpy.abs(values).astype(numpy.float64)
+        exponent = numpy.zeros(n, dtype=numpy.int64)
+        nonzero = magnitude > 0
+        exponent[nonzero] = numpy.floor(numpy.log10(magnitude[nonzero]))
+        if exponent.min() < -300:  # 10.0 ** exponent underflows
+            return encode_ascii_naive(values, number_format, precision)
+        mantissa = numpy.rint(magnitude / 10.0 ** exponent * 10 ** precision).astype(numpy.int64)
+        # Rounding can carry into a new digit, and log10() can be off by one close to powers of ten
+        carry = mantissa >= 10 ** (precision + 1)
+        short = nonzero & (mantissa < 10 ** precision)
+        if carry.any() or short.any():
+            exponent += carry
+            exponent -= short
+            mantissa = numpy.rint(magnitude / 10.0 ** exponent * 10 ** precision).astype(numpy.int64)
+        columns.append(_column(n, "-", numpy.signbit(values)))
+        columns.append((_digits(mantissa // 10 ** precision, 1), numpy.ones((n, 1), dtype=bool)))
+        if precision:
+            columns.append(_column(n, "."))
+            digits = _digits(mantissa % 10 ** precision, precision)
+            columns.append((digits, numpy.ones(digits.shape, dtype=bool)))
+        columns.append(_column(n, "E"))
+        columns.append((numpy.where(exponent < 0, ord("-"), ord("+")).astype(numpy.uint8)[:, None],
+                        numpy.ones((n, 1), dtype=bool)))
+        digits = _digits(numpy.abs(exponent), max(_width(numpy.abs(exponent)), 2))
+        columns.append((digits, _significant(digits, 2)))
+    else:
+        raise SCPIError(-224, "Illegal parameter value; %s" % number_format)
+    separator = numpy.ones(n, dtype=bool)
+    separator[-1] = False
+    columns.append(_column(n, ",", separator))
+
+    chars = numpy.concatenate([c for c, _ in columns], axis=1)
+    mask = numpy.concatenate([m for _, m in columns], axis=1)
+    return chars[mask].tobytes()
+
+
+def _replace_non_finite(values):
+    import numpy
+
+    if values.dtype.kind != "f" or numpy.isfinite(values).all():
+        return values
+    values = values.copy()
+    values[numpy.isnan(values)] = NAN_VALUE
+    values[numpy.isposinf(values)] = INF_VALUE
+    values[numpy.isneginf(values)] = -INF_VALUE
+    return values
+
+
+def iter_encode_ascii(values, number_format="NR3", precision=6, chunk_size=1 << 16):
+    """
+    Format numbers as a comma separated list, `chunk_size` numbers at a time.
+
+    :param values: NumPy array or sequence of numbers
+    :param str number_format: NR1 (integer), NR2 (fixed point) or NR3 (exponential)
+    :param int precision: digits after the decimal point for NR2 and NR3. The numbers are scaled in
+        double precision, so with more than 12 or so significant digits the last digit can differ
+        from correctly rounded formatting.
+    :return: iterator of bytes, the chunks and the commas between them
+    """
+    import numpy
+
+    values = _replace_non_finite(numpy.asarray(values).ravel())
+    for start in range(0, len(values), chunk_size):
+        if start:
+            yield b","
+        yield _encode_chunk(values[start:start + chunk_size], number_format, precision)
+
+
+def encode_ascii(values, number_format="NR3", precision=6):
+    """
+    Format numbers as a comma separated list, see :func:`iter_encode_ascii`.
+
+    :rtype: bytes
+    """
+    return b"".join(iter_encode_ascii(values, number_format, precision))
+
+
+def encode_ascii_naive(values, number_format="NR3", precision=6):
+    """
+    Reference implementation of :func:`encode_ascii`, formatting one number at a time.
+    """
+    if number_format == "NR1":
+        numbers = ("%.0f" % _finite(float(v)) for v in values)
+    elif number_format == "NR2":
+        numbers = ("%.*f" % (precision, _finite(float(v))) for v in values)
+    else:
+        numbers = ("%.*E" % (precision, _finite(float(v))) for v in values)
+    return ",".join(numbers).encode("ascii")
+
+
+def _finite(value):
+    if value != value:
+        return NAN_VALUE
+    if value in (float("inf"), float("-inf")):
+        return INF_VALUE if value > 0 else -INF_VALUE
+    return value
+
+
+def decode_ascii(data, dtype="f8"):
+    """
+    Parse a comma separated list of numbers.
+
+    :param data: bytes or a buffer, or the numeric parameters of a command as returned by :func:`tokenize`
+    :param dtype: NumPy type of the result
+    :rtype: numpy.ndarray
+    """
+    import warnings
+
+    import numpy
+
+    if isinstance(data, (list, tuple)):
+        text = b",".join(p if isinstance(p, bytes) else byte_view(p).tobytes() for p in data)
+    else:
+        text = byte_view(data).tobytes()
+    text = text.strip()
+    if not text:
+        return numpy.zeros(0, dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)  # Older NumPy warns instead of raising
+        try:
+            values = numpy.fromstring(text, dtype=numpy.float64, sep=",")
+        except ValueError:
+            values = None
+    if values is None or len(values) != text.count(b",") + 1:
+        raise SCPIError(-104, "Data type error; invalid numeric list")
+    dtype = numpy.dtype(dtype)
+    if dtype.kind != "f":
+        if (values != numpy.rint(values)).any():
+            raise SCPIError(-104, "Data type error; expected integers")
+        return values.astype(dtype)
+    values[values == NAN_VALUE] = numpy.nan
+    values[values == INF_VALUE] = numpy.inf
+    values[values == -INF_VALUE] = -numpy.inf
+    return values.astype(dtype, copy=False)
+
+
+class AsciiList(object):
+    """
+    A response of comma separated numbers, formatted in chunks while it is sent.
+    """
+    def __init__(self, values, number_format="NR3", precision=6, chunk_size=1 << 16):
+        self.values = values
+        self.number_format = number_format
+        self.precision = precision
+        self.chunk_size = chunk_size
+
+    def parts(self):
+        return iter_encode_ascii(self.values, self.number_format, self.precision, self.chunk_size)
+
+
+def format_response(value):
+    """
+    Convert the return value of a query handler to response data.
+
+    :return: bytes, a list of buffers for :class:`Block` values or an iterator of bytes for :class:`AsciiList` values
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (Block, AsciiList)):
+        return value.parts()
+    if isinstance(value, FileResponse):
+        return [value]
+    if isinstance(value, bool):
+        return b"1" if value else b"0"
+    if isinstance(value, float):
+        return repr(float(value)).encode("ascii")
+    if isinstance(value, (list, tuple)):
+        return b",".join(format_response(v) for v in value)
+    try:
+        return value.encode("ascii")  # Text
+    except AttributeError:
+        return str(value).encode("ascii")
+
+
+class Barrier(object):
+    """
+    Returned by a command handler to delay the execution of the rest of the program message until
+    `future` is done, e.g. by ``*WAI``.
+    """
+    def __init__(self, future):
+        self.future = future
+
+
+class OperationTracker(object):
+    """
+    The pending overlapped operations of an instrument, see IEEE 488.2 chapter 12.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._waiters = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, future):
+        """
+        :param future: Future of the operation, pending until it is done
+        """
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if self._pending:
+                return
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.set_result(True)
+
+    def when_complete(self):
+        """
+        :return: a Future which is done when no operation is pending
+        """
+        future = Future()
+        with self._lock:
+            if self._pending:
+                self._waiters.append(future)
+                return future
+        future.set_result(True)
+        return future
+
+
+def _register_value(value):
+    try:
+        value = int(round(float(value)))
+    except ValueError:
+        raise SCPIError(-104, "Data type error; %s" % value.decode("latin-1"))
+    if not 0 <= value <= 255:
+        raise SCPIError(-222, "Data out of range; %i" % value)
+    return value
+
+
+class SCPIInstrument(object):
+    """
+    Base class for instruments. Commands are methods decorated with :func:`scpi_command`,
+    subclasses inherit and can override the commands of their base classes.
+
+    :param int response_cache: maximum number of cached query responses, 0 disables the cache
+    """
+    max_errors = 32  # Size of the error queue
+
+    def __init__(self, response_cache=0):
+        self.lock = threading.RLock()  # Serializes the execution of program messages
+        self.errors = collections.deque()
+        self.response_cache = ResponseCache(response_cache) if response_cache else None
+        self.operations = OperationTracker()
+        self.esr = 0  # Standard event status register
+        self.ese = 0  # Standard event status enable register
+        self.sre = 0  # Service request enable register
+        self.service_request_handlers = []  # Called with the status byte when the instrument requests service
+        self.data_format = "REAL,32"
+        self.byte_order = "NORMal"
+
+    @classmethod
+    def command_tree(cls):
+        """
+        :return: the command tree of this class, created on first use
+        :rtype: SCPICommandTree
+        """
+        tree = cls.__dict__.get("_command_tree")
+        if tree is None:
+            tree = SCPICommandTree()
+            handlers = {}
+            for klass in reversed(cls.__mro__):
+                handlers.update(vars(klass))
+            commands = collections.OrderedDict()
+            for name, func in sorted(handlers.items()):
+                for pattern in getattr(func, "scpi_patterns", ()):
+                    key = pattern.rstrip("?")
+                    cmd = commands.setdefault(key, SCPICommand(key))
+                    if pattern.endswith("?"):
+                        cmd.query = func
+                        cmd.cache = getattr(func, "scpi_cache", None)
+                        cmd.coalesce = getattr(func, "scpi_coalesce", True)
+                    else:
+                        cmd.write = func
+            for cmd in commands.values():
+                tree.register(cmd)
+            cls._command_tree = tree
+        return tree
+
+    def push_error(self, error):
+        """
+        :param SCPIError error:
+        """
+        logger.info("SCPI error %s", error)
+        with self.lock:
+            before = self.status_byte()
+            if len(self.errors) >= self.max_errors:
+                self.errors[-1] = SCPIError(-350, "Queue overflow")
+            else:
+                self.errors.append(error)
+            for code, bit in _ERROR_EVENTS:
+                if code - 100 < error.code <= code:
+                    self.esr |= bit
+            self._request_service(before)
+
+    def status_byte(self):
+        """
+        The status byte without MAV, which the server adds per session. Doesn't take the instrument
+        lock, so status queries are answered while a command is executing.
+        """
+        stb = (STB_EAV if self.errors else 0) | (STB_ESB if self.esr & self.ese else 0)
+        return stb | (STB_RQS if stb & self.sre else 0)
+
+    def set_event(self, bits):
+        """
+        Set bits of the standard event status register, requesting service if they are enabled.
+        """
+        with self.lock:
+            before = self.status_byte()
+            self.esr |= bits
+            self._request_service(before)
+
+    def _request_service(self, before):
+        stb = self.status_byte()
+        if stb & STB_RQS and not before & STB_RQS:
+            for handler in list(self.service_request_handlers):
+                handler(stb)
+
+    def add_operation(self, future):
+        """
+        Track an overlapped operation returned by a command handler. Errors of the operation are
+        added to the error queue.
+        """
+        future.add_done_callback(self._operation_done)
+        self.operations.add(future)
+
+    def _operation_done(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, SCPIError):
+            self.push_error(error)
+        elif error is not None:
+            logger.error("Operation failed: %r", error)
+            self.push_error(SCPIError(-200, "Execution error; %s" % error))
+
+    def format_array(self, values):
+        """
+        Encode an array returned by a query handler according to FORMat[:DATA] and FORMat:BORDer.
+        """
+        if not self.data_format.startswith("ASC"):
+            return encode_block(values, self.data_format, self.byte_order)
+        if values.dtype.kind in "iub":
+            return AsciiList(values, "NR1")
+        digits = int(self.data_format.split(",")[1]) or (9 if values.dtype.itemsize <= 4 else 15)
+        return AsciiList(values, "NR3", digits - 1)
+
+    def parse_array(self, *params):
+        """
+        Decode the data parameters of a command, a block according to FORMat[:DATA] and FORMat:BORDer
+        or a list of numbers.
+
+        :return: NumPy array, viewing the received data for blocks
+        """
+        if len(params) == 1 and not isinstance(params[0], bytes):
+            data_format = "REAL,32" if self.data_format.startswith("ASC") else self.data_format
+            return decode_block(params[0], data_format, self.byte_order)
+        return decode_ascii(params)
+
+    @scpi_command("*IDN?", cache=True)
+    def idn_query(self):
+        return "Vendor name,Instrument type,Instrument serial,FW rev."
+
+    @scpi_command("*CLS")
+    def clear_status(self):
+        with self.lock:
+            self.esr = 0
+            self.errors.clear()
+
+    @scpi_command("*ESE")
+    def set_event_enable(self, value):
+        with self.lock:
+            before = self.status_byte()
+            self.ese = _register_value(value)
+            self._request_service(before)
+
+    @scpi_command("*ESE?")
+    def event_enable_query(self):
+        return self.ese
+
+    @scpi_command("*ESR?", coalesce=False)
+    def event_status_query(self):
+        with self.lock:
+            esr, self.esr = self.esr, 0
+        return esr
+
+    @scpi_command("*SRE")
+    def set_service_request_enable(self, value):
+        with self.lock:
+            before = self.status_byte()
+            self.sre = _register_value(value) & ~STB_RQS
+            self._request_service(before)
+
+    @scpi_command("*SRE?")
+    def service_request_enable_query(self):
+        return self.sre
+
+    @scpi_command("*STB?")
+    def status_byte_query(self):
+        return self.status_byte()
+
+    @scpi_command("*OPC")
+    def operation_complete(self):
+        self.operations.when_complete().add_done_callback(lambda future: self.set_event(ESR_OPC))
+
+    @scpi_command("*OPC?")
+    def operation_complete_query(self):
+        return then(self.operations.when_complete(), lambda done: 1)
+
+    @scpi_command("*WAI")
+    def wait(self):
+        return Barrier(self.operations.when_complete())
+
+    @scpi_command("FORMat[:DATA]")
+    def set_data_format(self, name, length=None):
+        names = {b"REAL": ("REAL", 32), b"INT": ("INT", 16), b"INTEGER": ("INT", 16), b"ASC": ("ASC", 0),
+                 b"ASCII": ("ASC", 0)}
+        try:
+            name, default = names[name.upper()]
+        except KeyError:
+            raise SCPIError(-224, "Illegal parameter value; %s" % name.decode("latin-1"))
+        data_format = "%s,%i" % (name, int(length) if length is not None else default)
+        if name != "ASC":
+            block_dtype(data_format)
+        elif not 0 <= int(data_format[4:]) <= 17:
+            raise SCPIError(-224, "Illegal parameter value; %s" % data_format)
+        self.data_format = data_format
+
+    @scpi_command("FORMat[:DATA]?")
+    def data_format_query(self):
+        return self.data_format
+
+    @scpi_command("FORMat:BORDer")
+    def set_byte_order(self, order):
+        orders = {b"NORM": "NORMal", b"NORMAL": "NORMal", b"SWAP": "SWAPped", b"SWAPPED": "SWAPped"}
+        try:
+            self.byte_order = orders[order.upper()]
+        except KeyError:
+            raise SCPIError(-224, "Illegal parameter value; %s" % order.decode("latin-1"))
+
+    @scpi_command("FORMat:BORDer?")
+    def byte_order_query(self):
+        return self.byte_order[:4].upper()
+
+
+_getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec  # Python 2
+
+
+def _call_handler(func, instrument, args):
+    """
+    Call a command handler, reporting a parameter count not matching its signature as SCPI error.
+    """
+    try:
+        return func(instrument, *args)
+    except TypeError:
+        try:
+            inspect.getcallargs(func, instrument, *args)
+        except TypeError:
+            spec = _getargspec(func)
+            if spec.varargs is None and len(args) + 1 > len(spec.args):
+                raise SCPIError(-108, "Parameter not allowed")
+            raise SCPIError(-109, "Missing parameter")
+        raise  # Raised by the handler itself
+
+
+class SCPIParser(object):
+    """
+    Executes program messages on an instrument.
+    """
+    def __init__(self, instrument):
+        """
+        :param SCPIInstrument instrument:
+        """
+        self.instrument = instrument
+        self.tree = instrument.command_tree()
+
+    def register_command(self, cmd):
+        """
+        Add a command to the tree, which is shared by all instruments of the same class.
+
+        :param SCPICommand cmd:
+        """
+        self.tree.register(cmd)
+
+    def find_cmd(self, header):
+        """
+        :param bytes header: program header without ``?``
+        :return: (SCPICommand, suffix values)
+        """
+        return self.tree.resolve(header)
+
+    def execute(self, header, params):
+        """
+        Execute one program message unit.
+
+        :param bytes header: e.g. ``b"FREQ?"``
+        :param list params: parameters as bytes
+        :return: the response data of a query or a Future of it, a :class:`Barrier`, or None
+        """
+        if header.endswith(b"?"):
+            cmd, indices = self.find_cmd(header[:-1])
+            args = indices + tuple(params)
+            cache = self.instrument.response_cache
+            if cache is None or not cmd.cache:
+                value = _call_handler(cmd.query, self.instrument, args)
+            else:
+                value = cache.get(cmd, args)
+                if value is _MISSING:
+                    value = _call_handler(cmd.query, self.instrument, args)
+                    if not is_future(value):
+                        cache.put(cmd, args, value)
+            if is_future(value):
+                return then(value, self.format_value)
+            return self.format_value(value)
+        cmd, indices = self.find_cmd(header)
+        try:
+            result = _call_handler(cmd.write, self.instrument, indices + tuple(params))
+        finally:
+            # Also after a failed write, it may have changed some of the settings
+            if self.instrument.response_cache is not None:
+                self.instrument.response_cache.invalidate(cmd)
+        if isinstance(result, Barrier):
+            return result
+        if is_future(result):
+            self.instrument.add_operation(result)
+
+    def format_value(self, value):
+        """
+        :return: the response data for the return value of a query handler
+        """
+        if getattr(value, "ndim", 0) > 0:  # NumPy array
+            value = self.instrument.format_array(value)
+        elif hasattr(value, "dtype"):  # NumPy scalar, formatted like the Python number
+            value = value.item()
+        return format_response(value)
+
+    def program_units(self, data):
+        """
+        Tokenize a program message and expand the headers of compound commands to the full path,
+        see SCPI-99 chapter 6.2.4: a header without a leading ``:`` is relative to the path of the
+        previous header, and common commands (``*CLS``) don't change the path.
+
+        :return: iterator of (header, parameters)
+        """
+        path = b""
+        for header, params in tokenize(data):
+            if header.startswith(b"*"):
+                yield header, params
+                continue
+            if header.startswith(b":"):
+                header = header[1:]
+            elif path:
+                header = path + header
+            path = header[:header.rfind(b":") + 1]
+            yield header, params
+
+    def parse(self, data):
+        """
+        Execute a program message, e.g. ``b"FREQ 1e9;:POW -10;:MEAS?;:MEAS2?\\n"``.
+
+        The units are executed in order. An error is added to the error queue of the instrument and
+        execution continues with the next unit, except for syntax errors which end the message.
+
+        A query returning a Future, ``*OPC?`` or ``*WAI`` with pending operations suspend the execution,
+        the rest of the message is executed when they are done, by the thread completing them.
+
+        :param bytes data: the program message
+        :return: the response message with the results of all queries, or None if there were no queries.
+            Responses with blocks are returned as a list of buffers and responses with ASCII lists as an
+            iterator of buffers, see :meth:`HislipHandler.send_response`. A Future of the response
+            if the execution was suspended.
+        """
+        return self._run(self.program_units(data), [])
+
+    def _run(self, units, responses):
+        with self.instrument.lock:
+            while True:
+                try:
+                    header, params = next(units)
+                except StopIteration:
+                    break
+                except SCPIError as e:
+                    self.instrument.push_error(e)
+                    break
+                try:
+                    response = self.execute(header, params)
+                except SCPIError as e:
+                    self.instrument.push_error(e)
+                    continue
+                except Exception as e:
+                    logger.exception("Executing %s failed", header.decode("latin-1"))
+                    self.instrument.push_error(SCPIError(-200, "Execution error; %s" % e))
+                    continue
+                barrier = isinstance(response, Barrier)
+                if barrier:
+                    response = response.future
+                if is_future(response):
+                    if not response.done():
+                        return self._resume(response, barrier, units, responses)
+                    response = self._result(response, barrier)
+                if response is not None:
+                    responses.append(response)
+        return self._join(responses)
+
+    def _result(self, future, barrier):
+        try:
+            response = future.result()
+        except SCPIError as e:
+            self.instrument.push_error(e)
+            return None
+        except Exception as e:
+            logger.error("Query failed: %r", e)
+            self.instrument.push_error(SCPIError(-200, "Execution error; %s" % e))
+            return None
+        return None if barrier else response
+
+    def _resume(self, future, barrier, units, responses):
+        """
+        :return: a Future of the response, continuing the execution of `units` when `future` is done
+        """
+        result = Future()
+
+        def resume(f):
+            try:
+                response = self._result(f, barrier)
+                if response is not None:
+                    responses.append(response)
+                rest = self._run(units, responses)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            if is_future(rest):
+                rest.add_done_callback(lambda r: _copy_future(r, result))
+            else:
+                result.set_result(rest)
+        future.add_done_callback(resume)
+        return result
+
+    def _join(self, responses):
+        if not responses:
+            return None
+        if all(isinstance(response, bytes) for response in responses):
+            return b";".join(responses) + b"\n"
+        parts = []
+        for response in responses:
+            if parts:
+                parts.append(b";")
+            parts.extend(response if isinstance(response, list) else [response])
+        parts.append(b"\n")
+        if all(isinstance(part, (bytes, memoryview, FileResponse)) for part in parts):
+            return parts
+        return _chain_parts(parts)
+
+
+def _copy_future(source, target):
+    try:
+        target.set_result(source.result())
+    except Exception as e:
+        target.set_exception(e)
+
+
+def _chain_parts(parts):
+    for part in parts:
+        if isinstance(part, (bytes, memoryview)):
+            yield part
+        elif isinstance(part, FileResponse):
+            yield part.read()  # Together with an ASCII list in one message, which is sent as it is produced
+        else:
+            for chunk in part:
+                yield chunk
+
+
+class SCPIServer(HislipServer):
+    """
+    A HiSLIP server passing program messages to an :class:`SCPIInstrument`.
+    """
+    def __init__(self, *args, **kwargs):
+        instrument = kwargs.pop("instrument", None)
+        super(SCPIServer, self).__init__(*args, **kwargs)
+        self.instrument = instrument if instrument is not None else SCPIInstrument()
+        self.instrument.service_request_handlers.append(self.service_request)
+        self.scpi_parser = SCPIParser(self.instrument)
+
+    def read_stb(self):
+        return self.instrument.status_byte()
+
+    def coalesce_key(self, client, data):
+        """
+        Program messages consisting only of queries share the execution with identical messages of other
+        sessions, compared after resolving the headers so different spellings match. Messages with
+        commands, block parameters or queries registered with ``coalesce=False`` are executed separately.
+        """
+        key = [client.instr_sub_addr]
+        try:
+            for header, params in self.scpi_parser.program_units(data):
+                if not header.endswith(b"?") or not all(isinstance(p, bytes) for p in params):
+                    return None
+                cmd, indices = self.scpi_parser.find_cmd(header[:-1])
+                if not cmd.coalesce:
+                    return None
+                key.append((cmd, indices, tuple(params)))
+        except SCPIError:
+            return None  # Executed on its own, to report the error
+        return tuple(key)
+
+    def data_received(self, client, data):
+        return self.scpi_parser.parse(data)
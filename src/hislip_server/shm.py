@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory rings for bulk Data payloads between processes on the same host.
+
+The client creates a file (in ``/dev/shm`` where available) and offers it to the server with
+a vendor specific ``VendorSharedMemoryRequest`` message on the sync channel. If the server
+accepts, both map the file. Its layout is::
+
+    [0:64)          upload ring header   (client => server)
+    [64:128)        download ring header (server => client)
+    [128:128+n)     upload ring data
+    [128+n:128+2n)  download ring data
+
+Each ring header holds the total number of bytes written and released. The producer copies a
+payload into the ring and sends a ``VendorSharedMemoryData``/``VendorSharedMemoryDataEnd``
+message carrying only the (offset, length) of the segment. The consumer releases segments in
+the order they were received. A payload which does not fit in the free space of the ring is sent
+over the socket as usual, so a slow consumer never blocks the producer.
+
+Requires Python 3, Python 2 memoryviews can't be created from an mmap.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mmap
+import os
+import struct
+import tempfile
+
+from hislip_server.hislip_server import HislipError
+
+RING_HEADER = struct.Struct("=QQ")  # bytes written, bytes released
+HEADER_SIZE = 128
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedMemoryRing(object):
+    """
+    Single producer, single consumer byte ring in a shared buffer.
+    """
+    def __init__(self, buf, header_offset, data_offset, size):
+        """
+        :param memoryview buf: the complete shared region
+        """
+        self._buf = buf
+        self._hdr = header_offset
+        self.data_offset = data_offset
+        self.size = size
+        self.data = buf[data_offset:data_offset + size]
+
+    def _positions(self):
+        return RING_HEADER.unpack_from(self._buf, self._hdr)
+
+    @property
+    def used(self):
+        written, released = self._positions()
+        return written - released
+
+    def write(self, payload):
+        """
+        Copy `payload` into the ring.
+
+        :param payload: byte memoryview, or a list of them to be written one after the other
+        :return: list of (offset, length) segments, or None if the ring is too full
+        """
+        parts = payload if isinstance(payload, list) else [payload]
+        n = sum(len(part) for part in parts)
+        written, released = self._positions()
+        if n > self.size - (written - released):
+            return None
+        start = written % self.size
+        first = min(n, self.size - start)
+        pos = start
+        for part in parts:
+            head = min(len(part), self.size - pos) if pos < self.size else 0
+            self.data[pos:pos + head] = part[:head]
+            if head < len(part):
+                tail = max(pos - self.size, 0)
+                self.data[tail:tail + len(part) - head] = part[head:]
+            pos += len(part)
+        segments = [(start, first)]
+        if first < n:
+            segments.append((0, n - first))
+        # Publish after the data has been written
+        struct.pack_into("=Q", self._buf, self._hdr, written + n)
+        return segments
+
+    def read(self, offset, length):
+        """
+        :return: memoryview of a segment, valid until it is released
+        """
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise HislipError("Shared memory segment out of range")
+        return self.data[offset:offset + length]
+
+    def release(self, length):
+        written, released = self._positions()
+        if released + length > written:
+            raise HislipError("Released more shared memory than written")
+        struct.pack_into("=Q", self._buf, self._hdr + 8, released + length)
+
+    def close(self):
+        self.data.release()
+        self.data = None
+
+
+class SharedMemoryRegion(object):
+    """
+    A mapped shared memory file with an upload and a download ring.
+    """
+    def __init__(self, path, fd, size, owner):
+        self.path = path
+        self.size = size
+        self.owner = owner  # The creating side unlinks the file on close()
+        self._fd = fd
+        self._map = mmap.mmap(fd, HEADER_SIZE + 2 * size)
+        self._view = memoryview(self._map)
+        self.upload = SharedMemoryRing(self._view, 0, HEADER_SIZE, size)
+        self.download = SharedMemoryRing(self._view, 64, HEADER_SIZE + size, size)
+
+    @classmethod
+    def create(cls, size, directory=SHM_DIR):
+        """
+        Create a new region, used by the client. `size` is the capacity of each ring.
+        """
+        fd, path = tempfile.mkstemp(prefix="hislip-", suffix=".shm", dir=directory)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + 2 * size)
+            region = cls(path, fd, size, owner=True)
+        except Exception:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        # Allocate the pages up front, instead of page faulting on the first pass through the rings
+        zeros = bytearray(1 << 20)
+        for offset in range(0, len(region._view), len(zeros)):
+            chunk = region._view[offset:offset + len(zeros)]
+            chunk[:] = zeros[:len(chunk)]
+        return region
+
+    @classmethod
+    def attach(cls, path, size, directory=SHM_DIR):
+        """
+        Map a region created by the peer, used by the server.
+        """
+        path = os.path.realpath(path)
+        if os.path.dirname(path) != os.path.realpath(directory):
+            raise HislipError("Shared memory file outside of %s" % directory)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            if os.fstat(fd).st_size != HEADER_SIZE + 2 * size:
+                raise HislipError("Shared memory file size mismatch")
+            return cls(path, fd, size, owner=False)
+        except Exception:
+            os.close(fd)
+            raise
+
+    def close(self):
+        if self._map is None:
+            return
+        try:
+            self.upload.close()
+            self.download.close()
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # Views returned to the application are still alive, the mapping is closed when they are collected
+            pass
+        self._map = None
+        os.close(self._fd)
+        if self.owner:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+A simulated instrument, standing in for hardware in capacity tests and benchmarks::
+
+    python -m hislip_server.simulator --port 4880 --latency 0.002 --points 100001
+
+It implements the IEEE 488.2 common commands of :class:`~hislip_server.scpi.SCPIInstrument`
+(``*IDN?``, ``*RST``, ``*TST?``, ``*CLS``, ``*ESE``, ``*ESR?``, ``*SRE``, ``*STB?``, ``*OPC``, ``*OPC?``,
+``*WAI``) and
+
+* ``[SENSe1]:FREQuency:STARt``, ``[SENSe1]:FREQuency:STOP``: the sweep range
+* ``[SENSe1]:SWEep:POINts``: the size of the waveforms
+* ``[SENSe1]:SWEep:TIME``: how long ``INITiate`` takes, as an overlapped operation
+* ``TRACe<n>:DATA?``: a noisy sine as NumPy array, sent according to ``FORMat[:DATA]``
+* ``SYSTem:ERRor[:NEXT]?``, ``SYSTem:ERRor:COUNt?``
+* ``SYSTem:LATency``: the time :class:`SimulatorServer` waits before executing a program message
+  with queries, outside of the instrument lock like the network and processing delay of a real
+  instrument
+
+Waveforms are views of a table generated when the size changes, so queries of large waveforms cost
+little more than sending them. Requires NumPy.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import math
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import hislip_server
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.scpi import SCPIError
+from hislip_server.scpi import SCPIInstrument
+from hislip_server.scpi import SCPIServer
+from hislip_server.scpi import scpi_command
+
+logger = logging.getLogger(__name__)
+
+MAX_POINTS = 1 << 26
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise SCPIError(-104, "Data type error; %s" % value.decode("latin-1"))
+    if math.isinf(number) or math.isnan(number):
+        raise SCPIError(-222, "Data out of range; %s" % value.decode("latin-1"))
+    return number
+
+
+class SimulatedInstrument(SCPIInstrument):
+    """
+    :param float latency: seconds before a program message with queries is executed, see :class:`SimulatorServer`
+    :param int points: default waveform size
+    :param float sweep_time: duration of ``INITiate`` in seconds
+    """
+    def __init__(self, latency=0.0, points=1001, sweep_time=0.0, response_cache=0, seed=0):
+        super(SimulatedInstrument, self).__init__(response_cache=response_cache)
+        self.default_points = points
+        self.default_sweep_time = sweep_time
+        self.latency = latency
+        self.seed = seed
+        self._table = None  # Waveform table of the current number of points
+        self._counter = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = 1e6
+            self.stop = 1e9
+            self.points = self.default_points
+            self.sweep_time = self.default_sweep_time
+            self.data_format = "REAL,32"
+            self.byte_order = "NORMal"
+
+    def waveform(self, channel):
+        """
+        :return: a waveform of :attr:`points` big endian float32 values, a view which is not to be modified
+        """
+        with self.lock:  # Already held when called by the SCPIParser
+            n = self.points
+            if self._table is None or len(self._table) != 2 * n:
+                try:
+                    import numpy
+                except ImportError:
+                    raise SCPIError(-241, "Hardware missing; the simulated waveforms need NumPy")
+                self._table = None  # Free the table of the previous size first
+                rng = numpy.random.RandomState(self.seed)
+                x = numpy.arange(2 * n) * (8 * numpy.pi / max(n, 1))
+                self._table = (numpy.sin(x) + 0.05 * rng.standard_normal(2 * n)).astype(">f4")
+            self._counter += 1
+            offset = (self._counter * 7919 + channel * 104729) % (n or 1)
+            return self._table[offset:offset + n]
+
+    @scpi_command("*IDN?", cache=True)
+    def idn_query(self):
+        return "hislip-server,Simulated instrument,0,%s" % hislip_server.__version__
+
+    @scpi_command("*RST")
+    def reset_command(self):
+        self.reset()
+
+    @scpi_command("*TST?")
+    def self_test_query(self):
+        return 0
+
+    @scpi_command("[SENSe1]:FREQuency:STARt")
+    def set_start(self, sense, value):
+        self.start = _number(value)
+
+    @scpi_command("[SENSe1]:FREQuency:STARt?", cache=True)
+    def start_query(self, sense):
+        return self.start
+
+    @scpi_command("[SENSe1]:FREQuency:STOP")
+    def set_stop(self, sense, value):
+        self.stop = _number(value)
+
+    @scpi_command("[SENSe1]:FREQuency:STOP?", cache=True)
+    def stop_query(self, sense):
+        return self.stop
+
+    @scpi_command("[SENSe1]:SWEep:POINts")
+    def set_points(self, sense, value):
+        points = int(_number(value))
+        if not 1 <= points <= MAX_POINTS:
+            raise SCPIError(-222, "Data out of range; %i" % points)
+        self.points = points
+
+    @scpi_command("[SENSe1]:SWEep:POINts?", cache=True)
+    def points_query(self, sense):
+        return self.points
+
+    @scpi_command("[SENSe1]:SWEep:TIME")
+    def set_sweep_time(self, sense, value):
+        sweep_time = _number(value)
+        if not 0 <= sweep_time <= 3600:
+            raise SCPIError(-222, "Data out of range; %s" % value.decode("latin-1"))
+        self.sweep_time = sweep_time
+
+    @scpi_command("[SENSe1]:SWEep:TIME?", cache=True)
+    def sweep_time_query(self, sense):
+        return self.sweep_time
+
+    @scpi_command("INITiate[:IMMediate]")
+    def initiate(self):
+        future = Future()
+        if self.sweep_time <= 0:
+            future.set_result(None)
+            return future
+        timer = threading.Timer(self.sweep_time, future.set_result, (None,))
+        timer.daemon = True
+        timer.start()
+        return future
+
+    @scpi_command("TRACe<n>:DATA?")
+    def trace_query(self, channel):
+        return self.waveform(channel)
+
+    @scpi_command("SYSTem:ERRor[:NEXT]?", coalesce=False)
+    def error_query(self):
+        with self.lock:
+            return str(self.errors.popleft()) if self.errors else '0,"No error"'
+
+    @scpi_command("SYSTem:ERRor:COUNt?", coalesce=False)
+    def error_count_query(self):
+        return len(self.errors)
+
+    @scpi_command("SYSTem:LATency")
+    def set_latency(self, value):
+        latency = _number(value)
+        if not 0 <= latency <= 60:
+            raise SCPIError(-222, "Data out of range; %s" % value.decode("latin-1"))
+        self.latency = latency
+
+    @scpi_command("SYSTem:LATency?")
+    def latency_query(self):
+        return self.latency
+
+
+class SimulatorServer(SCPIServer):
+    """
+    SCPIServer for a :class:`SimulatedInstrument`, delaying program messages with queries by the
+    latency of the instrument.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("instrument", SimulatedInstrument())
+        super(SimulatorServer, self).__init__(*args, **kwargs)
+
+    def data_received(self, client, data):
+        latency = self.instrument.latency
+        if latency > 0 and b"?" in data:
+            time.sleep(latency)
+        return super(SimulatorServer, self).data_received(client, data)
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="", help="Listen address, default all")
+    parser.add_argument("--port", type=int, default=4880)
+    parser.add_argument("--latency", type=float, default=0.0, help="Response latency in seconds")
+    parser.add_argument("--points", type=int, default=1001, help="Waveform size")
+    parser.add_argument("--sweep-time", type=float, default=0.0, help="Duration of INITiate in seconds")
+    parser.add_argument("--cache", type=int, default=0, help="Size of the query response cache, 0 disables it")
+    parser.add_argument("--coalesce", action="store_true", help="Coalesce identical concurrent queries")
+
+
+def run(args):
+    instrument = SimulatedInstrument(args.latency, args.points, args.sweep_time, args.cache)
+    server = SimulatorServer((args.host, args.port), HislipHandler, instrument=instrument)
+    server.coalesce_queries = args.coalesce
+    logger.info("Simulated instrument listening on %s:%i", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a simulated instrument over HiSLIP.")
+    add_arguments(parser)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    run(parser.parse_args(args=args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+TLS for HiSLIP 2.0 secure connections.
+
+Both channels of a session are opened in plain text and upgraded after initialization: the client
+sends ``AsyncStartTLS`` on the async channel, the server answers ``AsyncStartTLSResponse`` and both
+perform the TLS handshake on the async channel. Then the client sends ``StartTLS`` on the sync
+channel, followed by the handshake there.
+
+:class:`TLSEngine` is the TLS state machine, an :class:`ssl.SSLObject` on memory BIOs. It does no
+I/O itself: the owner feeds it the bytes received from the peer and sends the bytes it produces,
+so the same engine serves blocking sockets, selectors and asyncio. :class:`TLSSocket` drives it
+over a blocking socket for the threaded server and :class:`~hislip_server.client.HislipClientConnection`.
+
+Clients keep the TLS sessions of a server in a :class:`TLSSessionCache`, reconnects resume them
+and skip the certificate exchange and key agreement.
+
+Requires Python 3.6 or later.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import ssl
+import subprocess
+import threading
+
+from hislip_server.hislip_server import HislipError
+
+# AsyncStartTLSResponse control codes
+START_TLS_FAILURE = 0
+START_TLS_SUCCESS = 1
+
+
+class TLSEngine(object):
+    """
+    :param ssl.SSLContext context:
+    :param bool server_side:
+    :param str server_hostname: host name to verify the server certificate against, clients only
+    :param ssl.SSLSession session: session to resume, clients only
+    """
+    def __init__(self, context, server_side, server_hostname=None, session=None):
+        if not hasattr(ssl, "MemoryBIO"):
+            raise HislipError("TLS requires Python 3.6 or later")
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.sslobj = context.wrap_bio(self.incoming, self.outgoing, server_side=server_side,
+                                       server_hostname=server_hostname, session=session)
+        self.handshake_done = False
+
+    def handshake(self):
+        """
+        Advance the handshake with the bytes fed so far.
+
+        :return: True when the handshake is complete, False if more input is needed
+        """
+        try:
+            self.sslobj.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        self.handshake_done = True
+        return True
+
+    def feed(self, data):
+        """
+        Pass bytes received from the peer to the engine, an empty string for end of file.
+        """
+        if data:
+            self.incoming.write(data)
+        else:
+            self.incoming.write_eof()
+
+    @property
+    def wants_write(self):
+        return self.outgoing.pending > 0
+
+    def data_to_send(self):
+        """
+        :return: the bytes to be sent to the peer, possibly empty
+        """
+        return self.outgoing.read()
+
+    def read(self, size, buffer=None):
+        """
+        Decrypt up to `size` bytes, into `buffer` if given.
+
+        :return: the data, or the number of bytes written into `buffer`; None if more input is needed,
+                 empty (0) at the end of the stream
+        """
+        try:
+            if buffer is None:
+                return self.sslobj.read(size)
+            return self.sslobj.read(size, buffer)
+        except ssl.SSLWantReadError:
+            return None
+        except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+            return b"" if buffer is None else 0
+
+    def write(self, data):
+        """
+        Encrypt `data`, the records are collected with :meth:`data_to_send`.
+        """
+        self.sslobj.write(data)
+
+    @property
+    def session(self):
+        return self.sslobj.session
+
+    @property
+    def session_reused(self):
+        return self.sslobj.session_reused
+
+    def version(self):
+        return self.sslobj.version()
+
+
+class TLSSocket(object):
+    """
+    Blocking, socket-like wrapper encrypting a connected socket with a :class:`TLSEngine`.
+
+    One thread may receive while others send: the engine is only used under a lock, and the
+    socket is read outside of it.
+
+    :param sock: connected socket
+    :param TLSEngine engine:
+    :param bytes received: bytes already read from `sock` which belong to the TLS stream
+
+    Event loop front-ends read the socket themselves and pass the data to :meth:`receive`.
+    """
+    recv_size = 256 * 1024
+    write_size = 256 * 1024  # Plain text encrypted per call, sixteen 16 KiB records
+
+    def __init__(self, sock, engine, received=b""):
+        self.sock = sock
+        self.engine = engine
+        self._lock = threading.Lock()  # Guards the engine
+        self._send_lock = threading.RLock()  # Keeps the records in order on the socket
+        if received:
+            engine.feed(received)
+
+    @classmethod
+    def server(cls, sock, context, received=b""):
+        """
+        :return: a TLSSocket after completing the server side handshake
+        """
+        tls = cls(sock, TLSEngine(context, True), received)
+        tls.do_handshake()
+        return tls
+
+    @classmethod
+    def client(cls, sock, context, server_hostname=None, session=None):
+        """
+        :return: a TLSSocket after completing the client side handshake
+        """
+        tls = cls(sock, TLSEngine(context, False, server_hostname, session))
+        tls.do_handshake()
+        return tls
+
+    def do_handshake(self):
+        while True:
+            with self._lock:
+                done = self.engine.handshake()
+            self._flush()
+            if done:
+                return
+            if not self._fill():
+                raise ssl.SSLEOFError("Connection closed during the TLS handshake")
+
+    def _flush(self):
+        with self._send_lock:
+            with self._lock:
+                data = self.engine.data_to_send()
+            if data:
+                self.sock.sendall(data)
+
+    def _fill(self):
+        data = self.sock.recv(self.recv_size)
+        with self._lock:
+            self.engine.feed(data)
+        return len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = nbytes or len(buffer)
+        while True:
+            with self._lock:
+                n = self.engine.read(nbytes, buffer)
+                flush = self.engine.wants_write  # E.g. a key update
+            if flush:
+                self._flush()
+            if n is not None:
+                return n
+            if not self._fill():
+                with self._lock:
+                    n = self.engine.read(nbytes, buffer)
+                return n or 0
+
+    def receive(self, data):
+        """
+        Decrypt `data` received by an event loop, for front-ends which don't read the socket through
+        this object. Advances the handshake if it isn't complete yet.
+
+        :return: the plain text available, empty if there is none yet
+        """
+        chunks = []
+        with self._lock:
+            self.engine.feed(data)
+            if self.engine.handshake_done or self.engine.handshake():
+                while True:
+                    chunk = self.engine.read(self.recv_size)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            flush = self.engine.wants_write
+        if flush:  # Only then, a worker may hold the send lock while writing a large response
+            self._flush()
+        return b"".join(chunks)
+
+    @property
+    def handshake_done(self):
+        return self.engine.handshake_done
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        n = self.recv_into(buf)
+        return bytes(buf[:n])
+
+    def sendall(self, data):
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast("B")
+        with self._send_lock:
+            for pos in range(0, len(view), self.write_size):
+                with self._lock:
+                    self.engine.write(view[pos:pos + self.write_size])
+                    out = self.engine.data_to_send()
+                self.sock.sendall(out)
+
+    def write(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def makefile(self, mode="rb", buffering=-1):
+        raw = _TLSIO(self)
+        if "r" in mode and buffering != 0:
+            return io.BufferedReader(raw, io.DEFAULT_BUFFER_SIZE if buffering < 0 else buffering)
+        return raw
+
+    def fileno(self):
+        # The kernel must not see the plain text, e.g. through os.sendfile()
+        raise io.UnsupportedOperation("fileno")
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    @property
+    def family(self):
+        return self.sock.family
+
+    @property
+    def session(self):
+        return self.engine.session
+
+    @property
+    def session_reused(self):
+        return self.engine.session_reused
+
+    def version(self):
+        return self.engine.version()
+
+
+class _TLSIO(io.RawIOBase):
+    """
+    File object of a TLSSocket, closing it leaves the socket open like socket.makefile().
+    """
+    def __init__(self, tls):
+        super(_TLSIO, self).__init__()
+        self._tls = tls
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        return self._tls.recv_into(b)
+
+    def write(self, b):
+        return self._tls.write(b)
+
+
+class TLSSessionCache(object):
+    """
+    TLS sessions by server address and client SSLContext, for resuming them on reconnect. A session can
+    only be resumed with the context which created it.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, address, context):
+        with self._lock:
+            return self._sessions.get((address, context))
+
+    def put(self, address, context, session):
+        if session is None:
+            return
+        key = (address, context)
+        with self._lock:
+            self._sessions.pop(key, None)
+            if len(self._sessions) >= self.maxsize:
+                del self._sessions[next(iter(self._sessions))]
+            self._sessions[key] = session
+
+    def discard(self, address, context):
+        with self._lock:
+            self._sessions.pop((address, context), None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+default_session_cache = TLSSessionCache()
+
+
+def server_context(certfile, keyfile=None):
+    """
+    :return: an SSLContext for :attr:`HislipServer.ssl_context <hislip_server.hislip_server.HislipServer.ssl_context>`
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def self_signed_certificate(directory, hostname="localhost"):
+    """
+    Create a self-signed certificate for `hostname` and 127.0.0.1 with the ``openssl`` tool, for tests
+    and benchmarks.
+
+    :return: (certfile, keyfile)
+    """
+    certfile = os.path.join(directory, "%s.crt" % hostname)
+    keyfile = os.path.join(directory, "%s.key" % hostname)
+    cmd = ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+           "-days", "2", "-subj", "/CN=%s" % hostname, "-addext", "subjectAltName=DNS:%s,IP:127.0.0.1" % hostname,
+           "-keyout", keyfile, "-out", certfile]
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise HislipError("Can't create a self-signed certificate with openssl: %s" % e)
+    return certfile, keyfile
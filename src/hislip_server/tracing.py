@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Timing spans for every phase of a message exchange, a watchdog for slow handlers and a sampling
+profiler hook.
+
+Serve with :class:`TracingHislipHandler` and attach a :class:`Tracer` to the server::
+
+    server = HislipServer(("localhost", 4880), TracingHislipHandler)
+    server.tracer = Tracer(budget=0.05, profiler=StackSampler())
+    ...
+    print(server.tracer.format_summary())
+    with open("trace.json", "w") as fd:
+        server.tracer.write_chrome_trace(fd)
+
+The handler records a :class:`Span` for each phase:
+
+* ``header``: reading the message header, from the arrival of its first byte
+* ``payload``: reading the payload
+* ``dispatch``: the ``msg_handler`` method of the message type, including the application call
+  and the response
+* ``application``: :meth:`HislipServer.program_message <hislip_server.hislip_server.HislipServer.program_message>`
+* ``send``: :meth:`HislipHandler.send_msg <hislip_server.hislip_server.HislipHandler.send_msg>`
+
+Spans carry the session id, the channel and the HiSLIP message id, which the async channel messages
+(e.g. AsyncStatusQuery) share with the sync channel message they refer to; :meth:`Tracer.message_spans`
+collects both channels of one program message. The Chrome trace event file shows the sessions as
+processes and the channels as threads, in ``chrome://tracing`` or https://ui.perfetto.dev.
+
+Handlers running longer than the `budget` of the tracer are reported once with their stack. The
+profiler hook is called with the frames of the threads running a handler, see :class:`StackSampler`.
+The plain :class:`~hislip_server.hislip_server.HislipHandler` records nothing and has no overhead.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import socket
+import sys
+import threading
+import traceback
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import Message
+from hislip_server.hislip_server import MessageData
+from hislip_server.replay import clock
+from hislip_server.replay import percentile
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("header", "payload", "dispatch", "application", "send")
+
+Span = namedtuple("Span", ["session_id", "channel", "phase", "message_type", "message_id", "start", "duration"])
+
+SlowHandler = namedtuple("SlowHandler", ["thread", "description", "elapsed", "stack"])
+
+
+# Responses with a message id of their own, other responses belong to the message being dispatched
+_DATA_MESSAGES = frozenset([Message.Type.Data, Message.Type.DataEnd, Message.Type.VendorSharedMemoryData,
+                            Message.Type.VendorSharedMemoryDataEnd])
+
+
+def _message_id(msg):
+    return msg.message_id if isinstance(msg, MessageData) else None
+
+
+class Tracer(object):
+    """
+    Collects the spans of TracingHislipHandler instances.
+
+    :param int maxlen: number of spans kept in :attr:`spans`, the oldest are dropped
+    :param float budget: seconds a handler may run before its stack is reported, None disables the watchdog
+    :param profiler: callable receiving {thread ident: frame} of the threads running a handler,
+                     every `profile_interval` seconds
+    :param float profile_interval:
+    """
+    def __init__(self, maxlen=100000, budget=None, profiler=None, profile_interval=0.005):
+        self.spans = deque(maxlen=maxlen)
+        self.sinks = []  # Callables receiving each Span
+        self.budget = budget
+        self.profiler = profiler
+        self.profile_interval = profile_interval
+        self.slow_handlers = deque(maxlen=100)  # SlowHandler reports of the watchdog
+
+        self._lock = threading.Lock()
+        self._active = {}  # thread ident => [start, description, reported]
+        self._local = threading.local()
+        self._monitor = None
+        self._stop = threading.Event()
+
+    def record(self, session_id, channel, phase, message_type, message_id, start, end):
+        span = Span(session_id, channel, phase, message_type, message_id, start, end - start)
+        self.spans.append(span)
+        for sink in self.sinks:
+            sink(span)
+
+    @property
+    def monitoring(self):
+        return self.budget is not None or self.profiler is not None
+
+    def enter(self, description, message_id=None):
+        """
+        Mark the current thread as running a handler, for the watchdog and the profiler. Nested calls
+        are attributed to the outermost one.
+        """
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        if depth == 0:
+            self._local.message_id = message_id
+        if depth == 0 and self.monitoring:
+            with self._lock:
+                self._active[threading.current_thread().ident] = [clock(), description, False]
+                if self._monitor is None:
+                    self._start_monitor()
+
+    def exit(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self._local.message_id = None
+        if self._local.depth == 0 and self.monitoring:
+            with self._lock:
+                self._active.pop(threading.current_thread().ident, None)
+
+    def current_message_id(self):
+        """
+        :return: the message id of the handler running in this thread, None outside of handlers
+        """
+        return getattr(self._local, "message_id", None)
+
+    def _start_monitor(self):
+        self._stop.clear()
+        self._monitor = threading.Thread(target=self._run_monitor, name="hislip-tracer")
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _run_monitor(self):
+        intervals = [self.profile_interval] if self.profiler is not None else []
+        if self.budget is not None:
+            intervals.append(max(self.budget / 4, 0.001))
+        interval = min(intervals)
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Tracer monitor failed")
+
+    def check(self):
+        """
+        Report handlers exceeding the budget and pass the active frames to the profiler.
+        Called periodically by the monitor thread.
+        """
+        now = clock()
+        with self._lock:
+            active = dict((ident, list(entry)) for ident, entry in self._active.items())
+        if not active:
+            return
+        frames = sys._current_frames()
+        if self.profiler is not None:
+            self.profiler(dict((ident, frames[ident]) for ident in active if ident in frames))
+        if self.budget is None:
+            return
+        for ident, (start, description, reported) in active.items():
+            if reported or now - start < self.budget or ident not in frames:
+                continue
+            with self._lock:
+                entry = self._active.get(ident)
+                if entry is None or entry[0] != start:
+                    continue  # Finished meanwhile
+                entry[2] = True
+            stack = "".join(traceback.format_stack(frames[ident]))
+            report = SlowHandler(ident, description, now - start, stack)
+            self.slow_handlers.append(report)
+            logger.warning("%s running for %.3f s, over the budget of %.3f s:\n%s",
+                           description, report.elapsed, self.budget, stack)
+
+    def close(self):
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+            self._monitor = None
+
+    def message_spans(self, session_id, message_id):
+        """
+        :return: the spans of one message id of a session, from both channels, ordered by start time
+        """
+        return sorted((s for s in list(self.spans) if s.session_id == session_id and s.message_id == message_id),
+                      key=lambda s: s.start)
+
+    def summary(self):
+        """
+        :return: {(phase, message type name): dict with count, mean, p50, p99 and max in seconds}
+        """
+        durations = defaultdict(list)
+        for span in list(self.spans):
+            durations[span.phase, span.message_type.name].append(span.duration)
+        result = {}
+        for key, values in durations.items():
+            values.sort()
+            result[key] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+        return result
+
+    def format_summary(self):
+        lines = ["%-12s %-32s %8s %12s %12s %12s" % ("phase", "message", "count", "p50 us", "p99 us", "max us")]
+        summary = self.summary()
+        for phase, name in sorted(summary, key=lambda k: (PHASES.index(k[0]), k[1])):
+            s = summary[phase, name]
+            lines.append("%-12s %-32s %8i %12.1f %12.1f %12.1f" %
+                         (phase, name, s["count"], s["p50"] * 1e6, s["p99"] * 1e6, s["max"] * 1e6))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """
+        :return: the spans as Chrome trace events, sessions as processes and channels as threads
+        """
+        events = []
+        for span in list(self.spans):
+            events.append({
+                "name": "%s %s" % (span.phase, span.message_type.name),
+                "cat": span.phase,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": span.session_id or 0,
+                "tid": span.channel,
+                "args": {} if span.message_id is None else {"message_id": "%#x" % span.message_id},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, fd):
+        json.dump(self.chrome_trace(), fd)
+
+
+class _PhaseReader(object):
+    """
+    File object recording the time each read() returns; Message.unpack reads the header, then the payload.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.times = []
+
+    def read(self, size):
+        data = self.fd.read(size)
+        self.times.append(clock())
+        return data
+
+
+class TracingHislipHandler(HislipHandler):
+    """
+    A HislipHandler recording timing spans into ``server.tracer``, see :class:`Tracer`.
+    """
+    def setup(self):
+        super(TracingHislipHandler, self).setup()
+        self.tracer = self.server.tracer
+
+    @property
+    def channel(self):
+        return "async" if self.sync_conn is False else "sync"
+
+    def _read_message(self):
+        if self.tracer is None:
+            return super(TracingHislipHandler, self)._read_message()
+        peek = getattr(self.rfile, "peek", None)
+        if peek is not None:
+            try:
+                peek(1)  # Waiting for the client is not part of the header span
+            except socket.error:
+                pass
+        reader = _PhaseReader(self.rfile)
+        start = clock()
+        msg = Message.parse(reader)
+        message_id = _message_id(msg)
+        self.tracer.record(self.session_id, self.channel, "header", msg.type, message_id, start, reader.times[0])
+        if msg.payload_len:
+            self.tracer.record(self.session_id, self.channel, "payload", msg.type, message_id, reader.times[0],
+                               reader.times[1])
+        return msg
+
+    def _dispatch(self, msg):
+        tracer = self.tracer
+        if tracer is None:
+            return super(TracingHislipHandler, self)._dispatch(msg)
+        message_id = _message_id(msg)
+        tracer.enter("%s channel of session %s: %s" % (self.channel, self.session_id, msg.type.name), message_id)
+        start = clock()
+        try:
+            super(TracingHislipHandler, self)._dispatch(msg)
+        finally:
+            tracer.exit()
+            tracer.record(self.session_id, self.channel, "dispatch", msg.type, message_id, start, clock())
+
+    def _call_application(self, data, message_id):
+        tracer = self.tracer
+        if tracer is None:
+            return super(TracingHislipHandler, self)._call_application(data, message_id)
+        tracer.enter("Application call of session %s: %r" % (self.session_id, bytes(bytearray(data[:40]))), message_id)
+        start = clock()
+        try:
+            return super(TracingHislipHandler, self)._call_application(data, message_id)
+        finally:
+            tracer.exit()
+            tracer.record(self.session_id, self.channel, "application", Message.Type.DataEnd, message_id, start,
+                          clock())
+
+    def send_msg(self, message):
+        tracer = getattr(self, "tracer", None)  # Initialization errors can be sent before setup()
+        if tracer is None:
+            return super(TracingHislipHandler, self).send_msg(message)
+        message_id = message.message_id if message.type in _DATA_MESSAGES else tracer.current_message_id()
+        start = clock()
+        try:
+            super(TracingHislipHandler, self).send_msg(message)
+        finally:
+            tracer.record(self.session_id, self.channel, "send", message.type, message_id, start, clock())
+
+
+class StackSampler(object):
+    """
+    Sampling profiler for the `profiler` hook of :class:`Tracer`, counting the stacks of the handler
+    threads. :meth:`collapsed` returns them in the folded format of flamegraph.pl and speedscope.
+    """
+    def __init__(self, max_depth=64):
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, frames):
+        stacks = []
+        for frame in frames.values():
+            names = []
+            while frame is not None and len(names) < self.max_depth:
+                code = frame.f_code
+                names.append("%s (%s:%i)" % (code.co_name, code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno))
+                frame = frame.f_back
+            stacks.append(";".join(reversed(names)))
+        with self._lock:
+            self.samples.update(stacks)
+
+    def collapsed(self):
+        """
+        :return: lines of "frame;frame;frame count", the root first
+        """
+        with self._lock:
+            return ["%s %i" % item for item in self.samples.most_common()]
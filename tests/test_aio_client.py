@@ -0,0 +1,110 @@
+import ssl
+import sys
+from array import array
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import EmbeddedServer
+from hislip_server.hislip_server import HislipError
+from hislip_server.tls import TLSSessionCache
+from hislip_server.tls import self_signed_certificate
+from hislip_server.tls import server_context
+
+if sys.version_info >= (3, 5):
+    import asyncio
+
+    from hislip_server.aio_client import AsyncHislipClientConnection
+    from hislip_server.aio_client import AsyncHislipClientPool
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5), reason="The asyncio client needs Python 3.5")
+
+
+@pytest.fixture
+def server():
+    with EmbeddedServer() as srv:
+        yield srv
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def connect(server, **kwargs):
+    host, port = server.address
+    return AsyncHislipClientConnection(host, port=port, timeout=10, **kwargs)
+
+
+def test_query(server, run):
+    conn = run(connect(server, max_message_size=64 * 1024).open())
+    try:
+        assert run(conn.query(b"*IDN?\n")).tobytes() == BenchmarkServer.idn
+        assert run(conn.status_query()) == 0
+        run(conn.write(b"x" * 200000, end=False))  # Sent in fragments of the server's maximum size
+        assert run(conn.query(b"UPL?\n")).tobytes() == b"200005"
+        run(conn.write(array("d", range(1000)), end=False))  # Counted in bytes, not elements
+        assert run(conn.query(b"UPL?\n")).tobytes() == b"8005"
+        assert run(conn.lock(timeout=100))
+        assert run(conn.unlock())
+    finally:
+        conn.close()
+
+
+def test_buffers(server, run):
+    conn = run(connect(server).open())
+    try:
+        first = run(conn.query(b"*IDN?\n"))
+        response = run(conn.query(b"DOWN? 3000000\n"))  # Grows the 4 kB buffer
+        assert len(response) == 3000000 and response.tobytes() == b"\x55" * 3000000
+        assert first.tobytes() == BenchmarkServer.idn  # Still valid, the grown buffer is a new one
+
+        into = bytearray(1000)
+        assert run(conn.query(b"DOWN? 1000\n", into=into)).obj is into
+        with pytest.raises(HislipError):
+            run(conn.query(b"DOWN? 1001\n", into=into))
+    finally:
+        conn.close()
+
+
+def test_pool(server, run):
+    host, port = server.address
+    pool = AsyncHislipClientPool(max_idle=1, timeout=10)
+    first = run(pool.acquire(host, port=port))
+    second = run(pool.acquire(host, port=port))
+    assert run(first.query(b"*IDN?\n")).tobytes() == BenchmarkServer.idn
+    pool.release(first)
+    pool.release(second)  # Closed, one idle session is kept
+    assert not second.is_open
+    assert run(pool.acquire(host, port=port)) is first
+    assert (pool.created, pool.reused) == (2, 1)
+
+    run(first.write(b"*IDN?\n"))
+    pool.release(first)  # Closed with a response pending
+    assert not first.is_open
+    pool.close()
+
+
+@pytest.mark.skipif(not hasattr(ssl, "MemoryBIO"), reason="TLS needs Python 3")
+def test_tls(server, run, tmpdir):
+    try:
+        certificate = self_signed_certificate(str(tmpdir))
+    except HislipError as e:
+        pytest.skip(str(e))
+    server.server.ssl_context = server_context(*certificate)
+    context = ssl.create_default_context(cafile=certificate[0])
+    sessions = TLSSessionCache()
+    for resumed in (False, True):
+        conn = run(connect(server, ssl_context=context, server_hostname="localhost", tls_sessions=sessions).open())
+        try:
+            assert conn.tls_session_reused == resumed
+            assert run(conn.query(b"*IDN?\n")).tobytes() == BenchmarkServer.idn
+            response = run(conn.query(b"DOWN? 2000000\n"))
+            assert len(response) == 2000000 and response.tobytes() == b"\x55" * 2000000
+            assert run(conn.status_query()) == 0
+        finally:
+            conn.close()
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hislip_server.bench import bench_startup
+from hislip_server.bench import compare
+from hislip_server.bench import run_suite
+
+
+def test_bench_suite():
+    results = run_suite(quick=True, max_size=1024, session_counts=[1, 4])
+    names = set(r["name"] for r in results["results"]) - {"ascii.encode", "ascii.decode"}  # Needs NumPy
+    names -= {"tls.upload", "tls.download", "tls.connect"}  # Needs Python 3 and openssl, see test_tls
+    assert names == {"codec.pack", "codec.parse", "scpi.resolve", "query.idn", "query.status",
+                     "bulk.upload", "bulk.download", "scaling.query", "coalesce.query", "startup.import",
+                     "startup.connect"}
+    for r in results["results"]:
+        assert r["samples"] > 0
+        assert r["p50"] > 0
+
+    lines = compare(results, results)
+    assert len(lines) == len(results["results"]) + 1
+    assert all(line.endswith("+0.0%") for line in lines[1:])
+
+    slow = dict(results, results=[dict(r, p50=1.0) for r in results["results"] if r["name"] == "startup.import"])
+    assert compare(results, slow)[1].endswith("over budget of %.6f" % slow["results"][0]["budget"])
+
+    local = run_suite(quick=True, only=["scpi"], transport="loopback")  # Runs no server, any transport
+    assert set(r["name"] for r in local["results"]) == {"scpi.resolve"}
+    with pytest.raises(ValueError):
+        run_suite(("127.0.0.1", 5025), only=["scpi"], transport="unix")
+
+
+@pytest.mark.skipif(not os.environ.get("HISLIP_CHECK_BUDGETS"),
+                    reason="Timing dependent, set HISLIP_CHECK_BUDGETS=1 on an idle machine")
+def test_startup_budget():
+    for r in bench_startup(quick=True):
+        assert r["p50"] < r["budget"], r["name"]
+
+
+def test_lazy_imports():
+    script = "import sys, hislip_server.cli; hislip_server.cli.create_parser(); print(' '.join(sys.modules))"
+    modules = subprocess.check_output([sys.executable, "-c", script]).decode("ascii").split()
+    for name in ("ssl", "pprint", "asyncio", "tempfile", "hislip_server.tls", "hislip_server.scpi"):
+        assert name not in modules
+    if sys.version_info >= (3, 4):
+        assert "aenum" not in modules
@@ -0,0 +1,58 @@
+import threading
+
+from hislip_server import cli
+from hislip_server.bench import BenchmarkServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.replay import RecordingHislipHandler
+from hislip_server.replay import SessionRecorder
+
+
+def test_main(capsys):
+    assert cli.main([]) == 2
+    assert "capture" in capsys.readouterr().out
+
+
+def start(argv, handler_cls=None):
+    args = cli.create_parser().parse_args(argv)
+    front_end = cli.create_front_end(args, handler_cls)
+    thread = threading.Thread(target=front_end.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return front_end
+
+
+def stop(front_end):
+    front_end.shutdown()
+    front_end.server_close()
+
+
+def test_serve():
+    front_end = start(["serve", "-l", "127.0.0.1:0", "--app", "hislip_server.bench:BenchmarkServer",
+                       "--max-message-size", "4096", "--slow-budget", "1"])
+    try:
+        host, port = front_end.addresses[0]
+        with HislipClientConnection(host, port=port, timeout=10) as conn:
+            assert conn.server_max_message_size == 4096
+            assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+    finally:
+        stop(front_end)
+    assert front_end.server.tracer.spans
+
+
+def test_capture(tmpdir, capsys):
+    path = str(tmpdir.join("capture.hsr"))
+    front_end = start(["capture", path, "-l", "127.0.0.1:0"], RecordingHislipHandler)
+    front_end.server.recorder = SessionRecorder()
+    try:
+        host, port = front_end.addresses[0]
+        with HislipClientConnection(host, port=port, timeout=10) as conn:
+            assert conn.query(b"*IDN?\n").tobytes().startswith(b"hislip-server,Simulated instrument")
+    finally:
+        stop(front_end)
+    with open(path, "wb") as fd:
+        front_end.server.recorder.save(fd)
+
+    assert cli.main(["capture", "--decode", path]) == 0
+    out = capsys.readouterr().out
+    assert "Session 0" in out
+    assert "-> DataEnd" in out
@@ -0,0 +1,56 @@
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import HislipClientPool
+
+
+@pytest.fixture
+def server():
+    with EmbeddedServer() as srv:
+        yield srv
+
+
+def test_query(server):
+    host, port = server.address
+    with HislipClientConnection(host, port=port) as conn:
+        assert conn.session_id == 1
+        assert conn.server_max_message_size == int(server.server.max_message_size)
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert conn.status_query() == 0  # RMT was delivered, MAV is cleared
+
+
+def test_fragmented_transfers(server):
+    host, port = server.address
+    with HislipClientConnection(host, port=port, max_message_size=1040, max_write_size=1040) as conn:
+        assert len(conn.query(b"DOWN? 100000\n")) == 100000
+        buf = bytearray(4096)
+        assert len(conn.query(b"DOWN? 4096\n", into=buf)) == 4096
+        conn.write(b"x" * 10000, end=False)
+        assert conn.query(b"UPL?\n").tobytes() == b"10005"
+
+
+def test_control_messages(server):
+    host, port = server.address
+    with HislipClientConnection(host, port=port) as conn:
+        assert conn.lock(timeout=1000)
+        assert conn.unlock()
+        conn.trigger()
+        conn.device_clear()
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+
+def test_pool_reuses_sessions(server):
+    host, port = server.address
+    pool = HislipClientPool()
+    for _ in range(3):
+        with pool.session(host, b"hislip0", port) as conn:
+            conn.query(b"*IDN?\n")
+    assert (pool.created, pool.reused) == (1, 2)
+
+    conn = pool.acquire(host, b"hislip0", port)
+    conn.write(b"*IDN?\n")
+    pool.release(conn)  # Unread response, must not be reused
+    assert not conn.is_open
+    pool.close()
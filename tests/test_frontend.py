@@ -0,0 +1,94 @@
+import socket
+import ssl
+import threading
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import unix_connect
+from hislip_server.frontend import FRONT_ENDS
+from hislip_server.frontend import create_front_end
+from hislip_server.frontend import parse_listen_address
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.tls import self_signed_certificate
+from hislip_server.tls import server_context
+
+
+@pytest.fixture(params=FRONT_ENDS)
+def front_end(request, tmpdir):
+    server = BenchmarkServer(("127.0.0.1", 0), HislipHandler, bind_and_activate=False)
+    addresses = [("127.0.0.1", 0)]
+    if hasattr(socket, "AF_UNIX"):
+        addresses.append(str(tmpdir.join("hislip.sock")))
+    try:
+        fe = create_front_end(request.param, server, addresses, workers=4)
+    except HislipError as e:
+        server.server_close()
+        pytest.skip(str(e))
+    thread = threading.Thread(target=fe.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield fe
+    fe.shutdown()
+    fe.server_close()
+    thread.join()
+
+
+def connect(front_end, **kwargs):
+    host, port = front_end.addresses[0][:2]
+    return HislipClientConnection(host, port=port, timeout=10, **kwargs)
+
+
+def test_parse_listen_address():
+    assert parse_listen_address(":4880") == ("", 4880)
+    assert parse_listen_address("[::1]:4881") == ("::1", 4881)
+    assert parse_listen_address("unix:hislip.sock") == "hislip.sock"
+    assert parse_listen_address("/run/hislip.sock") == "/run/hislip.sock"
+    with pytest.raises(ValueError):
+        parse_listen_address("localhost")
+
+
+def test_sessions(front_end):
+    def session(results):
+        with connect(front_end) as conn:
+            for _ in range(20):
+                results.append(conn.query(b"*IDN?\n").tobytes())
+            assert conn.status_query() == 0
+
+    results = []
+    threads = [threading.Thread(target=session, args=(results,)) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [BenchmarkServer.idn] * 120
+
+    with connect(front_end) as conn:
+        assert len(conn.query(b"DOWN? 3000000\n")) == 3000000
+        conn.write(b"x" * 2000000, end=False)
+        assert conn.query(b"UPL?\n").tobytes() == b"2000005"
+        conn.device_clear()
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets not available")
+def test_unix_socket(front_end):
+    with HislipClientConnection(front_end.addresses[1], connect=unix_connect, timeout=10) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert conn.session_id in front_end.server.clients
+
+
+@pytest.mark.skipif(not hasattr(ssl, "MemoryBIO"), reason="TLS needs Python 3")
+def test_tls(front_end, tmpdir):
+    try:
+        certificate = self_signed_certificate(str(tmpdir))
+    except HislipError as e:
+        pytest.skip(str(e))
+    front_end.server.ssl_context = server_context(*certificate)
+    context = ssl.create_default_context(cafile=certificate[0])
+    with connect(front_end, ssl_context=context, server_hostname="localhost") as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert len(conn.query(b"DOWN? 1000000\n")) == 1000000
+        assert conn.status_query() == 0
@@ -0,0 +1,101 @@
+import socket
+import sys
+import threading
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import unix_connect
+from hislip_server.frontend import create_front_end
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.proxy import BackendPool
+from hislip_server.proxy import ProxyHandler
+from hislip_server.proxy import ProxyServer
+
+pytestmark = pytest.mark.skipif(sys.version_info[0] < 3 or not hasattr(socket, "SCM_RIGHTS"),
+                                reason="Handing over sockets needs Python 3 and SCM_RIGHTS")
+
+
+def start(front_end):
+    thread = threading.Thread(target=front_end.serve_forever)
+    thread.daemon = True
+    thread.start()
+    front_end.running.wait(5)
+    return front_end
+
+
+def stop(front_end):
+    front_end.shutdown()
+    front_end.server_close()
+
+
+@pytest.fixture
+def paths(tmpdir):
+    return str(tmpdir.join("handoff.sock")), str(tmpdir.join("hislip.sock"))
+
+
+@pytest.mark.parametrize("old_front_end", ["selector", "asyncio", "threaded"])
+def test_handover(paths, old_front_end):
+    from hislip_server.handoff import HandoffServer
+    from hislip_server.handoff import Takeover
+
+    control, local = paths
+    old = start(create_front_end(old_front_end, BenchmarkServer(("", 0), HislipHandler, bind_and_activate=False),
+                                 [("127.0.0.1", 0), local], workers=4))
+    handoff = HandoffServer(old, control, drain_timeout=10)
+    handoff.start()
+    host, port = old.addresses[0]
+
+    conn = HislipClientConnection(host, port=port, timeout=10).open()
+    local_conn = HislipClientConnection(local, connect=unix_connect, timeout=10).open()
+    assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+    new = None
+    try:
+        takeover = Takeover(control)
+        server = BenchmarkServer(("", 0), HislipHandler, bind_and_activate=False)
+        new = start(create_front_end("selector", server, takeover.listeners(server), workers=4))
+        takeover.start(new)
+
+        with HislipClientConnection(host, port=port, timeout=10) as fresh:  # Accepted by the new process
+            assert fresh.session_id > local_conn.session_id
+            assert fresh.session_id in server.clients
+
+        if old_front_end == "threaded":  # Drained, the sessions stay with the old process until they close
+            assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+            conn.close()
+            local_conn.close()
+            assert handoff.done.wait(10)
+            assert takeover.done.wait(10)
+            assert takeover.sessions == 0
+            return
+
+        assert handoff.done.wait(10)
+        assert takeover.done.wait(10)
+        assert takeover.sessions == handoff.sessions_handed_over == 2
+        assert not old.server.clients
+        for c in (conn, local_conn):
+            assert c.session_id in server.clients
+            assert c.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+            assert c.status_query() == 0
+            assert len(c.query(b"DOWN? 1000000\n")) == 1000000
+        conn.close()
+        local_conn.close()
+    finally:
+        stop(old)
+        if new is not None:
+            stop(new)
+
+
+def test_proxy_refuses_handover(paths):
+    from hislip_server.handoff import HandoffServer
+
+    server = ProxyServer(("127.0.0.1", 0), ProxyHandler, bind_and_activate=False, backends=BackendPool("localhost"))
+    front_end = create_front_end("selector", server, [("127.0.0.1", 0)], workers=1)
+    try:
+        with pytest.raises(HislipError):  # The locks are held by the backend sessions of this process
+            HandoffServer(front_end, paths[0])
+    finally:
+        front_end.server_close()
@@ -1,9 +1,17 @@
+import os
+import threading
+import time
 
-from hislip_server.hislip_server import HislipServer
+import pytest
 
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import FileResponse
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import HislipServer
+from hislip_server.hislip_server import SingleFlight
+from hislip_server.loopback import LoopbackTransport
 
-def test_main():
-    main([])
 
 class MyHiSlipServer(HislipServer):
     def new_connection():
@@ -23,3 +31,106 @@ class MyHiSlipServer(HislipServer):
 
     def send_srq(self):
         pass
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def slow():
+        started.set()
+        release.wait()
+        return "result"
+
+    def call():
+        results.append(flight.do("key", slow))
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+        t.start()
+    while flight.shared < 4:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == ["result"] * 5
+    assert (flight.calls, flight.shared) == (1, 4)
+    assert flight.do("key", lambda: "again") == "again"  # Nothing in flight anymore
+
+
+def test_coalesced_queries():
+    with EmbeddedServer() as embedded:
+        server = embedded.server
+        server.coalesce_queries = True
+        server.measurement_time = 0.2
+        sessions = [HislipClientConnection(embedded.address[0], port=embedded.address[1]).open() for _ in range(8)]
+        responses = []
+
+        def query(session):
+            responses.append(session.query(b"MEAS?\n").tobytes())
+
+        threads = [threading.Thread(target=query, args=(s,)) for s in sessions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(responses) == 8 and len(set(responses)) == server.measurements < 8
+        assert server.single_flight.shared == 8 - server.measurements
+        # Every session still gets the responses to its own messages
+        assert sessions[0].query(b"*IDN?\n").tobytes() == server.idn
+        for s in sessions:
+            s.close()
+
+
+class FileServer(HislipServer):
+    daemon_threads = True
+    path = None
+    fd = None
+
+    def data_received(self, client, data):
+        offset, length = (int(x) for x in data.split()[1:])
+        if data.startswith(b"PATH?"):
+            return FileResponse(self.path, offset, length)
+        response = FileResponse(self.fd, offset, length)
+        return [b"#", response[:10], response[10:]]
+
+
+@pytest.fixture
+def data_file(tmpdir):
+    data = bytes(bytearray(range(256))) * (3 * 4096 + 7)
+    path = tmpdir.join("data.bin")
+    path.write_binary(data)
+    return str(path), data
+
+
+@pytest.mark.parametrize("transport", ["tcp", "loopback"])
+def test_file_responses(data_file, transport):
+    path, data = data_file
+    server = FileServer(("127.0.0.1" if transport == "tcp" else "loopback", 0), HislipHandler,
+                        bind_and_activate=transport == "tcp")
+    server.path = path
+    server.fd = os.open(path, os.O_RDONLY)
+    if transport == "tcp":
+        embedded = EmbeddedServer(server=server).__enter__()
+        kwargs = {"port": embedded.address[1]}
+    else:
+        kwargs = {"connect": LoopbackTransport(server).connect}
+    try:
+        with HislipClientConnection("127.0.0.1", max_message_size=65536 + 16, timeout=10, **kwargs) as conn:
+            assert conn.query(b"PATH? 0 %i\n" % len(data)).tobytes() == data  # 49 fragments
+            assert conn.query(b"PATH? 1000 70000\n").tobytes() == data[1000:71000]
+            assert conn.query(b"PATH? 5 0\n").tobytes() == b""
+            assert conn.query(b"FD? 100 200000\n").tobytes() == b"#" + data[100:200100]
+    finally:
+        if transport == "tcp":
+            embedded.__exit__()
+        else:
+            server.server_close()
+        os.close(server.fd)
+    with pytest.raises(ValueError):
+        FileResponse(path, 10, len(data))
+    assert FileResponse(path, 10, 100)[90:200].read() == data[100:110]
@@ -0,0 +1,42 @@
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import run_suite
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.loopback import LoopbackTransport
+from hislip_server.loopback import socketpair
+
+
+def test_socketpair():
+    a, b = socketpair(capacity=8)
+    a.sendall(b"0123456789abcdef"[:8])
+    assert b.recv(5) == b"01234"
+    buf = bytearray(8)
+    assert b.recv_into(buf) == 3
+    a.shutdown(2)
+    assert b.recv(1) == b""
+
+
+def test_socketpair_timeout():
+    import socket
+    a, b = socketpair()
+    b.settimeout(0.01)
+    with pytest.raises(socket.timeout):
+        b.recv(1)
+
+
+def test_session_over_loopback():
+    server = BenchmarkServer(("loopback", 0), HislipHandler, bind_and_activate=False)
+    transport = LoopbackTransport(server)
+    with HislipClientConnection("loopback", connect=transport.connect, max_message_size=4096) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert len(conn.query(b"DOWN? 100000\n")) == 100000
+        assert conn.status_query() == 0
+    server.server_close()
+
+
+def test_bench_over_loopback():
+    results = run_suite(quick=True, only=["query", "bulk"], max_size=1024, transport="loopback")
+    assert results["meta"]["transport"] == "loopback"
+    assert [r["name"] for r in results["results"]] == ["query.idn", "bulk.upload", "bulk.download"]
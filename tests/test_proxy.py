@@ -0,0 +1,167 @@
+import threading
+import time
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.proxy import BackendPool
+from hislip_server.proxy import ProxyHandler
+from hislip_server.proxy import ProxyServer
+
+
+class Instrument(BenchmarkServer):
+    measurement_time = 0
+
+    def __init__(self, *args, **kwargs):
+        super(Instrument, self).__init__(*args, **kwargs)
+        self.sessions = 0
+        self.stb_reads = 0
+
+    def connection_request(self, client):
+        self.sessions += 1
+        return super(Instrument, self).connection_request(client)
+
+    def read_stb(self):
+        self.stb_reads += 1
+        return 0x04
+
+    def data_received(self, client, data):
+        if data == b"NOISE\n":
+            return b"unexpected\n"  # A command answering, the proxy expects no response
+        return super(Instrument, self).data_received(client, data)
+
+
+@pytest.fixture
+def proxy():
+    with EmbeddedServer(Instrument) as instrument:
+        host, port = instrument.address
+        backends = BackendPool(host, port=port, size=2, stb_max_age=60, timeout=10)
+        with EmbeddedServer(server=ProxyServer(("127.0.0.1", 0), ProxyHandler, backends=backends)) as srv:
+            yield instrument.server, srv
+
+
+def connect(srv):
+    host, port = srv.address
+    return HislipClientConnection(host, port=port, timeout=10)
+
+
+def test_multiplexing(proxy):
+    instrument, srv = proxy
+    results = []
+
+    def session():
+        with connect(srv) as conn:
+            for _ in range(20):
+                results.append(conn.query(b"MEAS?\n").tobytes())
+            assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+    threads = [threading.Thread(target=session) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(int(r) for r in results) == list(range(1, 161))
+    assert instrument.sessions <= 2
+
+    with connect(srv) as conn:
+        conn.write(b"x" * 3000000, end=False)
+        assert conn.query(b"UPL?\n").tobytes() == b"3000005"
+        conn.write(b"NOISE\n")
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+    assert instrument.sessions <= 2
+
+
+def test_expects_response(proxy):
+    instrument, srv = proxy
+    server = srv.server
+    assert server.expects_response(b"FREQ 1;:FREQ?\n")
+    assert server.expects_response(b"*IDN?\n")
+    assert not server.expects_response(b":TRAC:DATA #13a?b\n")
+    assert not server.expects_response(b'DISP:TEXT "why?"\n')
+    assert not server.expects_response(b"FREQ 1;?\n")  # Syntax error
+    with connect(srv) as conn:
+        start = time.time()
+        conn.write(b":TRAC:DATA #13a?b\n")
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert time.time() - start < 5  # Not waiting for a response to the block
+
+
+def test_status_query(proxy):
+    instrument, srv = proxy
+    with connect(srv) as first, connect(srv) as second:
+        assert first.status_query() == 0x04
+        assert second.status_query() == 0x04
+        first.write(b"MEAS?\n")
+        while not first.status_query() & 0x10:  # MAV of the front session
+            pass
+        assert second.status_query() == 0x04
+        assert first.read().tobytes() == b"1\n"
+    assert instrument.stb_reads == 1
+
+
+def test_locks(proxy):
+    instrument, srv = proxy
+    backends = srv.server.backends
+    with connect(srv) as first, connect(srv) as second, connect(srv) as third:
+        assert first.lock(timeout=1000)
+        assert second.lock(timeout=1000, shared_name=b"shared")
+        assert backends.lock_info() == (True, 2)
+        assert not third.lock(timeout=50)  # Both backend sessions are locked
+
+        done = threading.Event()
+
+        def query():
+            third.query(b"*IDN?\n")
+            done.set()
+
+        waiting = threading.Thread(target=query)
+        waiting.start()
+        assert not done.wait(0.2)  # No backend session for the unlocked session
+        assert first.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert first.unlock()
+        assert done.wait(10)
+        waiting.join()
+        assert backends.lock_info() == (False, 1)
+    deadline = time.time() + 10
+    while backends.lock_info() != (False, 0) and time.time() < deadline:  # Released when the session closes
+        time.sleep(0.01)
+    assert backends.lock_info() == (False, 0)
+
+
+def test_reset(proxy):
+    instrument, srv = proxy
+    backends = srv.server.backends
+    with connect(srv) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+    backend = next(b for b in backends.backends if b.connection is not None)
+    stale = backend.connection
+    backend.reset(HislipClientConnection("localhost"))  # Failed on an already replaced session
+    assert backend.connection is stale and stale.is_open
+    backend.reset(stale)
+    assert backend.connection is None and not stale.is_open
+    with connect(srv) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn  # Opens a new backend session
+
+
+def test_lock_timeout(proxy, monkeypatch):
+    instrument, srv = proxy
+    backends = srv.server.backends
+    timeouts = []
+    lock = HislipClientConnection.lock
+
+    def recording_lock(self, timeout=0, shared_name=b""):
+        timeouts.append(timeout)
+        return lock(self, timeout, shared_name)
+    monkeypatch.setattr(HislipClientConnection, "lock", recording_lock)
+
+    assert backends.lock(1, 10) and backends.lock(2, 10)
+    unlock = threading.Timer(0.3, backends.unlock, (1,))
+    unlock.start()
+    assert backends.lock(3, 2.0)  # Waits for the backend of session 1
+    unlock.join()
+    assert all(9000 < t <= 10000 for t in timeouts[:2])
+    assert 1000 < timeouts[2] <= 1700  # The rest of the 2 s
+    backends.unlock(2)
+    backends.unlock(3)
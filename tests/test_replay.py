@@ -0,0 +1,89 @@
+import io
+import time
+
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import FileResponse
+from hislip_server.hislip_server import HislipServer
+from hislip_server.hislip_server import Message
+from hislip_server.replay import CH_ASYNC
+from hislip_server.replay import CH_SYNC
+from hislip_server.replay import TO_CLIENT
+from hislip_server.replay import LoadGenerator
+from hislip_server.replay import RecordingHislipHandler
+from hislip_server.replay import SessionRecorder
+from hislip_server.replay import SessionRecording
+from hislip_server.simulator import SimulatorServer
+
+
+def test_record_and_replay():
+    server = SimulatorServer(("127.0.0.1", 0), RecordingHislipHandler)
+    server.recorder = SessionRecorder()
+    with EmbeddedServer(server=server) as srv:
+        host, port = srv.address
+        for _ in range(2):
+            with HislipClientConnection(host, port=port, timeout=10) as conn:
+                assert conn.query(b"*IDN?\n").tobytes().startswith(b"hislip-server,")
+                conn.write(b"*CLS;*ESE 1;*SRE 32;*OPC\n")
+                assert conn.wait_service_request() & 0x40
+                conn.status_query()
+                assert conn.query(b"SWE:POIN?\n").tobytes() == b"1001\n"
+        deadline = time.time() + 10
+        while len(server.recorder.sessions) < 2 and time.time() < deadline:  # Added when the handlers finish
+            time.sleep(0.01)
+        fd = io.BytesIO()
+        server.recorder.save(fd)
+
+        fd.seek(0)
+        recordings = SessionRecording.load_all(fd)
+        assert len(recordings) == 2
+        types = [ev.message.type for ev in recordings[0].events]
+        assert Message.Type.AsyncServiceRequest in types
+        sync = [(ev.message.type, n) for ev, n in recordings[0].channel_requests(CH_SYNC)]
+        assert sync == [(Message.Type.DataEnd, 1), (Message.Type.DataEnd, 0), (Message.Type.DataEnd, 1)]
+        for ev, n in recordings[0].channel_requests(CH_ASYNC):
+            assert n == 1  # The service request isn't an answer
+
+        init = recordings[0].events[0].message
+        assert init.type == Message.Type.Initialize and init.payload == b"hislip0"
+        stats = LoadGenerator((host, port), recordings, clients=2, iterations=2, speed=0, timeout=5,
+                              sub_address=b"hislip1").run()
+        assert init.payload == b"hislip0"  # Not changed in the shared recording
+    report = stats.report()
+    assert report["errors"] == 0
+    assert report["types"]["DataEnd"]["count"] == 4 * 3
+    assert report["types"]["AsyncStatusQuery"]["count"] == 4
+    assert report["bytes_received"] > 0
+
+
+class FileServer(HislipServer):
+    daemon_threads = True
+    path = None
+
+    def data_received(self, client, data):
+        return [b"#", FileResponse(self.path, 0, int(data.split()[1]))]
+
+
+def test_record_file_responses(tmpdir):
+    data = bytes(bytearray(range(256))) * 1000
+    path = tmpdir.join("data.bin")
+    path.write_binary(data)
+    server = FileServer(("127.0.0.1", 0), RecordingHislipHandler)
+    server.path = str(path)
+    server.recorder = SessionRecorder()
+    with EmbeddedServer(server=server) as srv:
+        host, port = srv.address
+        with HislipClientConnection(host, port=port, max_message_size=65536 + 16, timeout=10) as conn:
+            assert conn.query(b"FILE? 100000\n").tobytes() == b"#" + data[:100000]  # 2 fragments
+        deadline = time.time() + 10
+        while not server.recorder.sessions and time.time() < deadline:
+            time.sleep(0.01)
+    path.write_binary(b"")  # Recorded when sent
+    fd = io.BytesIO()
+    server.recorder.save(fd)
+
+    fd.seek(0)
+    recording, = SessionRecording.load_all(fd)
+    payloads = [ev.message.payload for ev in recording.events
+                if ev.message.type in (Message.Type.Data, Message.Type.DataEnd) and ev.direction == TO_CLIENT]
+    assert b"".join(payloads) == b"#" + data[:100000]
@@ -0,0 +1,435 @@
+import sys
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.scpi import Block
+from hislip_server.scpi import LRUCache
+from hislip_server.scpi import SCPICommand
+from hislip_server.scpi import SCPICommandTree
+from hislip_server.scpi import SCPIError
+from hislip_server.scpi import SCPIInstrument
+from hislip_server.scpi import SCPIParser
+from hislip_server.scpi import SCPIServer
+from hislip_server.scpi import decode_ascii
+from hislip_server.scpi import decode_block
+from hislip_server.scpi import encode_ascii
+from hislip_server.scpi import encode_ascii_naive
+from hislip_server.scpi import encode_block
+from hislip_server.scpi import iter_encode_ascii
+from hislip_server.scpi import parse_block
+from hislip_server.scpi import scpi_command
+from hislip_server.scpi import tokenize
+from hislip_server.scpi import unquote
+
+
+class Instrument(SCPIInstrument):
+    def __init__(self):
+        super(Instrument, self).__init__()
+        self.frequency = 1e9
+        self.trace = None
+        self.sweeps = []
+
+    @scpi_command("[SENSe1]:FREQuency[:CW]")
+    def set_frequency(self, sense, value):
+        self.frequency = float(value)
+
+    @scpi_command("[SENSe1]:FREQuency[:CW]?")
+    def frequency_query(self, sense):
+        return self.frequency
+
+    @scpi_command("CALCulate1:MARKer<m>:X?")
+    def marker_x(self, calc, marker):
+        return "%i,%i" % (calc, marker)
+
+    @scpi_command("[SENSe1]:FREQuency:STARt", "[SENSe1]:FREQuency:STOP")
+    def set_span(self, sense, value):
+        self.frequency = float(value)
+
+    @scpi_command("DISPlay:TEXT")
+    def set_text(self, text):
+        self.text = unquote(text)
+
+    @scpi_command("TRACe:DATA")
+    def set_trace(self, *data):
+        self.trace = self.parse_array(*data)
+
+    @scpi_command("TRACe:DATA?")
+    def trace_query(self):
+        return self.trace
+
+    @scpi_command("INITiate")
+    def start_sweep(self):
+        self.sweeps.append(Future())
+        return self.sweeps[-1]
+
+    @scpi_command("FETCh?")
+    def fetch(self):
+        self.sweeps.append(Future())
+        return self.sweeps[-1]
+
+    @scpi_command("TEST:FAIL")
+    def fail(self):
+        return len(None)  # A TypeError of the handler itself
+
+    @scpi_command("SYSTem:ERRor[:NEXT]?", coalesce=False)
+    def error_query(self):
+        return str(self.errors.popleft()) if self.errors else '0,"No error"'
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def join(parts):
+    return b"".join(p if isinstance(p, bytes) else p.tobytes() for p in parts)
+
+
+@pytest.fixture
+def parser():
+    return SCPIParser(Instrument())
+
+
+@pytest.mark.parametrize("header", [b"FREQ", b"freq:cw", b":SENSe:FREQuency:CW", b"SENS1:Freq", b"sens2:FREQ"])
+def test_resolve_forms(parser, header):
+    cmd, indices = parser.find_cmd(header)
+    assert cmd.cmd_str == "[SENSe1]:FREQuency[:CW]"
+    assert indices == ((2,) if header.startswith(b"sens2") else (1,))
+
+
+def test_suffixes(parser):
+    assert parser.parse(b"CALC2:MARK3:X?\n") == b"2,3\n"
+    assert parser.parse(b"CALC:MARK:X?\n") == b"1,1\n"
+    with pytest.raises(SCPIError) as e:
+        parser.find_cmd(b"SYST2:ERR")
+    assert e.value.code == -114
+
+
+def test_undefined_headers(parser):
+    for header in (b"FREQU", b"FREQ:CW:FOO", b"CALC:MARK", b"FOO"):
+        with pytest.raises(SCPIError) as e:
+            parser.find_cmd(header)
+        assert e.value.code == -113
+    assert parser.parse(b"FREQ:FOO 1\n") is None
+    assert parser.parse(b"*IDN\n") is None  # Query only
+    assert parser.parse(b"SYST:ERR?\n").startswith(b"-113,")
+    assert parser.parse(b"SYST:ERR:NEXT?\n").startswith(b"-113,")
+    assert parser.parse(b"SYST:ERR?\n") == b'0,"No error"\n'
+
+
+def test_write_and_query(parser):
+    assert parser.parse(b"SENS:FREQ 2.5e9\n") is None
+    assert parser.parse(b"FREQ?\n") == b"2500000000.0\n"
+    assert parser.parse(b"*IDN?\n").count(b",") == 3
+
+
+def test_parameter_count(parser):
+    assert parser.parse(b"*IDN? 5;:FREQ 1e9,2;:FREQ:STAR;:FREQ?\n") == b"1000000000.0\n"
+    assert parser.parse(b"SYST:ERR?;ERR?;ERR?\n") == b'-108,"Parameter not allowed";-108,"Parameter not allowed";' \
+                                                     b'-109,"Missing parameter"\n'
+    assert parser.parse(b"TEST:FAIL;:FREQ 2e9\n") is None
+    assert parser.parse(b"SYST:ERR?\n").startswith(b"-200,")
+    assert parser.instrument.frequency == 2e9
+
+
+def test_tokenize():
+    data = b"FREQ 1e9;:POW -10 DBM, 'a;b', (@1,2);*CLS;MEAS?;DATA #15a;b,c,#0x;y\n"
+    units = [(header, [bytes(p) if isinstance(p, bytes) else p.tobytes() for p in params])
+             for header, params in tokenize(data)]
+    assert units == [(b"FREQ", [b"1e9"]),
+                     (b":POW", [b"-10 DBM", b"'a;b'", b"(@1,2)"]),
+                     (b"*CLS", []),
+                     (b"MEAS?", []),
+                     (b"DATA", [b"a;b,c", b"x;y"])]
+    assert list(tokenize(b"  \n")) == []
+    assert unquote(b'"it""s"') == b'it"s'
+
+    for data in (b"FREQ ,1", b"FREQ 1,", b"DATA #19abc", b'TEXT "abc', b"FREQ 1;;POW 2"):
+        with pytest.raises(SCPIError):
+            list(tokenize(data))
+
+
+def test_compound_messages(parser):
+    assert parser.parse(b"SENS:FREQ:STAR 1e6;STOP 2e6;:FREQ?;*IDN?;:FREQ:STOP 3e6;:SENS:FREQ:CW?\n") == \
+        b"2000000.0;" + parser.parse(b"*IDN?").rstrip() + b";3000000.0\n"
+    # After FREQ? the path is the root
+    assert parser.parse(b"FREQ:STAR 1e6;:FREQ?;STOP 3e6\n") == b"1000000.0\n"
+    assert parser.parse(b"SENS:FREQ:STAR 1e6;CW?\n") == b"1000000.0\n"
+    assert parser.parse(b"SENS:FREQ:STAR 1e6;FREQ?\n") is None  # SENS:FREQ:FREQ?
+    assert parser.parse(b"FREQ:STAR 1;FOO 2;STOP 5;:FREQ?\n") == b"5.0\n"
+    assert parser.parse(b'DISP:TEXT "a;""b"""\n') is None
+    assert parser.instrument.text == b'a;"b"'
+    assert [e.code for e in parser.instrument.errors] == [-113, -113, -113]
+
+
+def test_blocks():
+    np = pytest.importorskip("numpy")
+    assert Block(b"abc").header() == b"#13abc"[:3]
+    assert Block(b"x" * 12345).header() == b"#512345"
+
+    values = np.arange(1000, dtype=">f4")
+    block = encode_block(values)
+    assert block.header() == b"#44000"
+    if sys.version_info[0] > 2:  # Python 2 memoryviews can't be cast to bytes without a copy
+        assert np.shares_memory(values, decode_block(block.data))
+    assert len(encode_block(values, "INT,16", "SWAPped").data) == 2000
+
+    data = join(block.parts()) + b"\n"
+    assert parse_block(data).tobytes() == values.tobytes()
+    assert (decode_block(data) == values).all()
+    assert (decode_block(encode_block([1, -2], "INT,16", "SWAPped").data, "INT,16", "SWAPped") == [1, -2]).all()
+    with pytest.raises(SCPIError):
+        parse_block(b"#15abc")
+    with pytest.raises(SCPIError):
+        encode_block(values, "REAL,16")
+
+
+def test_block_parameters(parser):
+    np = pytest.importorskip("numpy")
+    values = np.linspace(0, 1, 100)
+    parser.parse(b"FORM REAL,64;FORM:BORD SWAP")
+    assert parser.parse(b"FORM:DATA?;BORD?") == b"REAL,64;SWAP\n"
+    parser.parse(b"TRAC:DATA " + join(encode_block(values, "REAL,64", "SWAP").parts()) + b"\n")
+    assert (parser.instrument.trace == values).all()
+
+    response = parser.parse(b"*IDN?;TRAC:DATA?;*IDN?\n")
+    assert isinstance(response, list)
+    response = join(response)
+    idn = parser.parse(b"*IDN?").rstrip()
+    assert response.startswith(idn + b";#3800")
+    assert response.endswith(b";" + idn + b"\n")
+    assert (decode_block(response[len(idn) + 1:], "REAL,64", "SWAP") == values).all()
+
+
+def test_numpy_scalars(parser):
+    np = pytest.importorskip("numpy")
+    values = np.linspace(0, 1, 5)
+    assert parser.format_value(values.mean()) == b"0.5"
+    assert parser.format_value(np.int64(7)) == b"7"
+    assert parser.format_value(values[0] < 1) == b"1"
+    assert parser.format_value(np.array(2.5)) == b"2.5"  # 0-d array
+    assert join(parser.format_value(values)).startswith(b"#")
+
+
+@pytest.mark.parametrize("number_format,precision", [("NR1", 0), ("NR2", 0), ("NR2", 3), ("NR3", 0), ("NR3", 6)])
+def test_ascii_lists(number_format, precision):
+    np = pytest.importorskip("numpy")
+    values = np.random.RandomState(0).standard_normal(5000) * 10.0 ** np.arange(-25, 25).repeat(100)
+    if number_format != "NR3":
+        values = values.clip(-1e9, 1e9)
+    values = np.concatenate([values, [0, -0.0, 0.5, 1.5, -2.5, 9.9999999, 1e-300, 1e300]])
+    assert encode_ascii(values, number_format, precision) == encode_ascii_naive(values, number_format, precision)
+
+    chunks = list(iter_encode_ascii(values, number_format, precision, chunk_size=1000))
+    assert len(chunks) == 2 * 6 - 1
+    assert b"".join(chunks) == encode_ascii(values, number_format, precision)
+
+
+def test_ascii_special_values():
+    np = pytest.importorskip("numpy")
+    values = np.array([np.nan, np.inf, -np.inf, 1])
+    assert encode_ascii(values, "NR3", 2) == b"9.91E+37,9.90E+37,-9.90E+37,1.00E+00"
+    assert encode_ascii(np.arange(-3, 3, dtype="i2"), "NR1") == b"-3,-2,-1,0,1,2"
+    assert encode_ascii([], "NR3") == b""
+    decoded = decode_ascii(b" 9.91E+37, 9.9e37,-9.9E37,1,2.5e-3\n")
+    assert np.isnan(decoded[0])
+    assert list(decoded[1:]) == [np.inf, -np.inf, 1, 2.5e-3]
+    assert list(decode_ascii([b"1", b"2", memoryview(b"3")], "i4")) == [1, 2, 3]
+    for data in (b"1,,2", b"1,2,", b"1,x", b"1.5"):
+        with pytest.raises(SCPIError):
+            decode_ascii(data, "i4" if data == b"1.5" else "f8")
+
+
+def test_ascii_parameters(parser):
+    np = pytest.importorskip("numpy")
+    values = np.linspace(-1, 1, 10001)
+    parser.parse(b"TRAC:DATA " + encode_ascii(values, "NR3", 16) + b";:FORM ASC")
+    assert np.allclose(parser.instrument.trace, values, rtol=1e-15, atol=0)
+    response = parser.parse(b"FORM?;:TRAC:DATA?;:FORM ASC,4;:TRAC:DATA?\n")
+    response = join(response).rstrip().split(b";")
+    assert response[0] == b"ASC,0"
+    assert np.allclose(decode_ascii(response[1]), values, rtol=1e-14, atol=0)
+    assert response[2] == encode_ascii(values, "NR3", 3)
+
+
+def test_invalid_registrations():
+    tree = SCPICommandTree()
+    with pytest.raises(ValueError):
+        tree.register(SCPICommand("[FOO"))
+    with pytest.raises(ValueError):
+        tree.register(SCPICommand("FOOBarBAZ"))
+    tree.register(SCPICommand("STATus:PRESet"))
+    tree.register(SCPICommand("STATe"))
+    with pytest.raises(ValueError):
+        tree.resolve(b"STAT")
+
+
+def test_resolution_cache():
+    tree = SCPICommandTree(cache_size=2)
+    for i in range(1000):
+        tree.register(SCPICommand("SRC%s:LEVel<n>" % "".join("ABCDEFGHIJ"[int(d)] for d in str(i))))
+    assert tree.resolve(b"SRCJJJ:LEV4")[1] == (4,)
+    assert tree.resolve(b"SRCJJJ:LEV4")[1] == (4,)
+    assert tree.cache.hits == 1
+    tree.resolve(b"SRCB:LEV")
+    tree.resolve(b"SRCC:LEV")
+    assert len(tree.cache) == 2
+
+    cache = LRUCache(2)
+    cache.put(1, 1)
+    cache.put(2, 2)
+    cache.get(1)
+    cache.put(3, 3)
+    assert cache.get(2) is None
+    assert cache.get(1) == 1
+
+
+class CachedInstrument(SCPIInstrument):
+    def __init__(self, clock):
+        super(CachedInstrument, self).__init__(response_cache=2)
+        self.response_cache._clock = clock
+        self.settings = {}
+        self.queries = 0
+
+    @scpi_command("[SENSe1]:FREQuency:CENTer", "[SENSe1]:FREQuency:SPAN", "[SENSe1]:BANDwidth")
+    def set_setting(self, sense, value):
+        self.settings[sense] = value
+
+    @scpi_command("[SENSe1]:FREQuency:CENTer?", cache=True)
+    def center_query(self, sense):
+        self.queries += 1
+        return self.settings.get(sense, b"0")
+
+    @scpi_command("[SENSe1]:BANDwidth?", cache=0.5)
+    def bandwidth_query(self, sense):
+        self.queries += 1
+        return self.settings.get(sense, b"0")
+
+    @scpi_command("*RST")
+    def reset(self):
+        self.settings.clear()
+
+
+def test_response_cache():
+    now = [0.0]
+    instrument = CachedInstrument(lambda: now[0])
+    parser = SCPIParser(instrument)
+    cache = instrument.response_cache
+    assert parser.parse(b"FREQ:CENT?;:SENS1:FREQuency:CENTER?;:sens:freq:cent?\n") == b"0;0;0\n"
+    assert instrument.queries == 1 and (cache.hits, cache.misses) == (2, 1)
+    assert parser.parse(b"SENS2:FREQ:CENT?\n") == b"0\n"  # Other suffix
+    assert instrument.queries == 2
+
+    parser.parse(b"BAND 5\n")  # Other subtree
+    assert parser.parse(b"FREQ:CENT?\n") == b"0\n" and instrument.queries == 2
+    parser.parse(b"FREQ:SPAN 7\n")  # Same subtree
+    assert parser.parse(b"FREQ:CENT?\n") == b"7\n" and instrument.queries == 3
+
+    assert parser.parse(b"BAND?\n") == b"7\n" and instrument.queries == 4
+    now[0] = 0.4
+    assert parser.parse(b"BAND?\n") == b"7\n" and instrument.queries == 4
+    now[0] = 0.6  # Expired
+    assert parser.parse(b"BAND?\n") == b"7\n" and instrument.queries == 5
+    parser.parse(b"SENS:FREQ:CENT 3\n")  # Sibling subtree below the same top-level node
+    assert parser.parse(b"BAND?\n") == b"7\n" and instrument.queries == 5
+    assert len(cache) == 2
+
+    parser.parse(b"*RST\n")
+    assert len(cache) == 0
+    assert parser.parse(b"BAND?;:FREQ:CENT?\n") == b"0;0\n" and instrument.queries == 7
+
+    assert SCPIParser(Instrument()).instrument.response_cache is None
+    with pytest.raises(TypeError):
+        scpi_command("FOO?", ttl=1)
+
+
+def test_coalesce_key():
+    server = SCPIServer(("127.0.0.1", 0), HislipHandler, instrument=Instrument(), bind_and_activate=False)
+    client = server.new_client()
+    client.instr_sub_addr = b"hislip0"
+    key = server.coalesce_key(client, b"FREQ?;:CALC:MARK2:X?\n")
+    assert key is not None and key == server.coalesce_key(client, b":sens1:frequency:cw?;:CALC1:MARKER2:X?")
+    for data in (b"FREQ 1;FREQ?\n", b"SYST:ERR?\n", b"FOO?\n", b"TRAC:DATA? #13abc\n"):
+        assert server.coalesce_key(client, data) is None
+    client.instr_sub_addr = b"hislip1"
+    assert server.coalesce_key(client, b"FREQ?;:CALC:MARK2:X?\n") != key
+    server.server_close()
+
+
+def test_operation_complete(parser):
+    instrument = parser.instrument
+    response = parser.parse(b"INIT;*OPC?\n")
+    assert not response.done()
+    assert parser.parse(b"*STB?;*OPC?\n").done() is False  # Not blocked by the pending operation
+    instrument.sweeps[0].set_result(None)
+    assert response.result() == b"1\n"
+    assert parser.parse(b"*OPC?\n") == b"1\n"  # Nothing pending, answered right away
+
+    response = parser.parse(b"INIT;*WAI;FREQ 5;FREQ?\n")
+    assert instrument.frequency == 1e9
+    instrument.sweeps[1].set_exception(SCPIError(-231, "Data questionable"))
+    assert response.result() == b"5.0\n"
+    assert parser.parse(b"SYST:ERR?;*ESR?\n") == b'-231,"Data questionable";16\n'
+
+    response = parser.parse(b"FETC?;FREQ?\n")
+    instrument.sweeps[2].set_result(2.5)
+    assert response.result() == b"2.5;5.0\n"
+
+
+def test_service_request(parser):
+    instrument = parser.instrument
+    requests = []
+    instrument.service_request_handlers.append(requests.append)
+    assert parser.parse(b"*ESE 1;*SRE 32;INIT;*OPC;*ESE?;*SRE?\n") == b"1;32\n"
+    assert requests == [] and instrument.status_byte() == 0
+    instrument.sweeps[0].set_result(None)
+    assert requests == [0x60]
+    assert parser.parse(b"*STB?;*ESR?;*STB?\n") == b"96;1;0\n"
+    parser.parse(b"*SRE 4;FOO\n")  # Error queue not empty
+    assert requests == [0x60, 0x44]
+    parser.parse(b"*CLS\n")
+    assert instrument.status_byte() == 0
+    parser.parse(b"*ESE 256\n")
+    assert instrument.errors[0].code == -222
+
+
+def test_scpi_server():
+    np = pytest.importorskip("numpy")
+    instrument = Instrument()
+    instrument.trace = np.arange(300000, dtype=">f4")
+    server = SCPIServer(("127.0.0.1", 0), HislipHandler, instrument=instrument)
+    server.daemon_threads = True
+    with EmbeddedServer(server=server) as srv:
+        with HislipClientConnection(srv.address[0], port=srv.address[1], timeout=5) as conn:
+            conn.write(b"FREQ 3e9\n")
+            assert conn.query(b"FREQ?\n").tobytes() == b"3000000000.0\n"
+            response = conn.query(b"TRAC:DATA?;:FREQ?\n")
+            assert (decode_block(response) == instrument.trace).all()
+            assert response[-14:].tobytes() == b";3000000000.0\n"
+            conn.write(b"FORM ASC,9\n")
+            response = conn.query(b"TRAC:DATA?\n")  # Formatted in chunks while sending
+            assert (decode_ascii(response) == instrument.trace).all()
+
+            conn.write(b"*ESE 1;*SRE 32;INIT;*OPC;INIT;*OPC?\n")
+            wait_for(lambda: len(instrument.sweeps) == 2)
+            assert conn.status_query() & 0x60 == 0  # Answered while the operations are pending
+            for sweep in instrument.sweeps:
+                sweep.set_result(None)
+            assert conn.read().tobytes() == b"1\n"
+            assert conn.wait_service_request() & 0x60 == 0x60
+            assert conn.status_query() & 0x60 == 0x60
+
+            conn.write(b"INIT;*OPC?\n")
+            conn.write(b"FREQ?\n")  # Executed after the pending response has been sent
+            wait_for(lambda: len(instrument.sweeps) == 3)
+            instrument.sweeps[-1].set_result(None)
+            assert conn.read().tobytes() == b"1\n"
+            assert conn.read().tobytes() == b"3000000000.0\n"
+    assert instrument.frequency == 3e9
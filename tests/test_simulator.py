@@ -0,0 +1,60 @@
+import pytest
+
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.replay import clock
+from hislip_server.scpi import decode_ascii
+from hislip_server.scpi import decode_block
+from hislip_server.simulator import SimulatedInstrument
+from hislip_server.simulator import SimulatorServer
+
+
+@pytest.fixture
+def simulator():
+    instrument = SimulatedInstrument(points=101, response_cache=16)
+    with EmbeddedServer(server=SimulatorServer(("127.0.0.1", 0), HislipHandler, instrument=instrument)) as srv:
+        with HislipClientConnection(srv.address[0], port=srv.address[1], timeout=10) as conn:
+            yield instrument, conn
+
+
+def query(conn, data):
+    return conn.query(data).tobytes()
+
+
+def test_settings(simulator):
+    instrument, conn = simulator
+    assert query(conn, b"*IDN?\n").startswith(b"hislip-server,Simulated instrument,0,")
+    conn.write(b"FREQ:STAR 2e6;STOP 3e9;:SWE:POIN 11\n")
+    assert query(conn, b"FREQ:STAR?;STOP?;:SWE:POIN?;*TST?\n") == b"2000000.0;3000000000.0;11;0\n"
+    conn.write(b"SWE:POIN 0\n")
+    assert query(conn, b"SYST:ERR:COUN?;:SYST:ERR?;:SYST:ERR?\n") == b'1;-222,"Data out of range; 0";0,"No error"\n'
+    conn.write(b"SWE:POIN NAN;:FREQ:STAR INF\n")
+    assert query(conn, b"SYST:ERR?;ERR?;:SWE:POIN?\n") == \
+        b'-222,"Data out of range; NAN";-222,"Data out of range; INF";11\n'
+    conn.write(b"*RST\n")
+    assert query(conn, b"SWE:POIN?;POIN?\n") == b"101;101\n"
+    assert instrument.response_cache.hits > 0
+
+
+def test_waveforms(simulator):
+    pytest.importorskip("numpy")
+    instrument, conn = simulator
+    first = decode_block(conn.query(b"TRAC1:DATA?\n")).copy()
+    second = decode_block(conn.query(b"TRAC2:DATA?\n"))
+    assert len(first) == len(second) == 101
+    assert abs(first).max() < 2 and (first != second).any()
+    conn.write(b"FORM ASC;:SWE:POIN 100000\n")
+    assert len(decode_ascii(conn.query(b"TRAC1:DATA?\n"))) == 100000
+    assert len(instrument._table) == 200000  # Only the table of the current size is kept
+
+
+def test_latency_and_operations(simulator):
+    instrument, conn = simulator
+    conn.write(b"SYST:LAT 0.05;:SWE:TIME 0.1\n")
+    t0 = clock()
+    assert query(conn, b"SYST:LAT?\n") == b"0.05\n"
+    assert clock() - t0 >= 0.05
+    t0 = clock()
+    assert query(conn, b"INIT;*OPC?\n") == b"1\n"
+    assert clock() - t0 >= 0.1
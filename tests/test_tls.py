@@ -0,0 +1,103 @@
+import ssl
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.hislip_server import HislipError
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import MessageInitializeResponse
+from hislip_server.loopback import LoopbackTransport
+from hislip_server.tls import TLSSessionCache
+from hislip_server.tls import self_signed_certificate
+from hislip_server.tls import server_context
+
+pytestmark = pytest.mark.skipif(not hasattr(ssl, "MemoryBIO"), reason="TLS needs Python 3")
+
+
+@pytest.fixture(scope="module")
+def certificate(tmpdir_factory):
+    try:
+        return self_signed_certificate(str(tmpdir_factory.mktemp("tls")))
+    except HislipError as e:
+        pytest.skip(str(e))
+
+
+@pytest.fixture(scope="module")
+def client_context(certificate):
+    return ssl.create_default_context(cafile=certificate[0])
+
+
+@pytest.fixture
+def server(certificate):
+    with EmbeddedServer() as srv:
+        srv.server.ssl_context = server_context(*certificate)
+        yield srv
+
+
+def connect(server, context, **kwargs):
+    host, port = server.address
+    kwargs.setdefault("ssl_context", context)
+    return HislipClientConnection(host, port=port, server_hostname="localhost", timeout=10, **kwargs)
+
+
+def test_initialize_response_flags():
+    msg = MessageInitializeResponse()
+    msg.overlap_mode = True
+    msg.encryption_mandatory = True
+    msg.overlap_mode = False
+    assert (msg.ctrl_code, msg.encryption_mandatory, msg.initial_encryption) == (2, True, False)
+
+
+def test_encrypted_session(server, client_context):
+    sessions = TLSSessionCache()
+    with connect(server, client_context, tls_sessions=sessions) as conn:
+        assert conn.server_protocol_version == b"\x02\x00"
+        assert not conn.tls_session_reused
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert len(conn.query(b"DOWN? 3000000\n")) == 3000000
+        conn.write(b"x" * 2000000, end=False)
+        assert conn.query(b"UPL?\n").tobytes() == b"2000005"
+        assert conn.status_query() == 0
+    assert len(sessions) == 1
+
+    with connect(server, client_context, tls_sessions=sessions) as conn:
+        assert conn.tls_session_reused
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+
+def test_plain_text(server, client_context):
+    with connect(server, client_context, ssl_context=None) as conn:
+        assert conn.server_protocol_version == b"\x01\x00"
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+    server.server.ssl_context = None
+    with pytest.raises(HislipError):
+        connect(server, client_context).open()
+
+
+def test_encryption_mandatory(server, client_context):
+    server.server.require_tls = True
+    with pytest.raises(HislipError):
+        connect(server, client_context, ssl_context=None).open()
+    with connect(server, client_context) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+
+
+def test_certificate_verification(server, client_context):
+    with pytest.raises(ssl.SSLError):
+        connect(server, client_context, ssl_context=ssl.create_default_context()).open()
+
+
+def test_loopback(certificate, client_context):
+    server = BenchmarkServer(("loopback", 0), HislipHandler, bind_and_activate=False)
+    server.ssl_context = server_context(*certificate)
+    try:
+        with HislipClientConnection("loopback", connect=LoopbackTransport(server).connect, ssl_context=client_context,
+                                    server_hostname="localhost", timeout=10) as conn:
+            assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+            assert len(conn.query(b"DOWN? 1000000\n")) == 1000000
+            assert conn.status_query() == 0
+    finally:
+        server.server_close()
@@ -0,0 +1,59 @@
+import json
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.bench import EmbeddedServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.tracing import StackSampler
+from hislip_server.tracing import Tracer
+from hislip_server.tracing import TracingHislipHandler
+
+
+def test_message_spans(tmpdir):
+    with EmbeddedServer(handler_cls=TracingHislipHandler) as srv:
+        tracer = srv.server.tracer = Tracer()
+        with HislipClientConnection(srv.address[0], port=srv.address[1]) as conn:
+            conn.query(b"*IDN?\n")
+            conn.status_query()
+            message_id = conn.last_message_id
+            session_id = conn.session_id
+
+    spans = tracer.message_spans(session_id, message_id)
+    assert set((s.channel, s.phase) for s in spans) == {
+        ("sync", "header"), ("sync", "payload"), ("sync", "dispatch"), ("sync", "application"), ("sync", "send"),
+        ("async", "header"), ("async", "dispatch"), ("async", "send")}
+    assert all(s.duration >= 0 for s in spans)
+    dispatch = [s for s in spans if s.phase == "dispatch" and s.channel == "sync"][0]
+    application = [s for s in spans if s.phase == "application"][0]
+    assert dispatch.start <= application.start and application.duration <= dispatch.duration
+
+    assert ("application", "DataEnd") in tracer.summary()
+    assert "application" in tracer.format_summary()
+    path = str(tmpdir.join("trace.json"))
+    with open(path, "w") as fd:
+        tracer.write_chrome_trace(fd)
+    with open(path) as fd:
+        assert len(json.load(fd)["traceEvents"]) == len(tracer.spans)
+
+
+def test_slow_handler_watchdog():
+    with EmbeddedServer(handler_cls=TracingHislipHandler) as srv:
+        srv.server.measurement_time = 0.3
+        sampler = StackSampler()
+        tracer = srv.server.tracer = Tracer(budget=0.05, profiler=sampler, profile_interval=0.01)
+        with HislipClientConnection(srv.address[0], port=srv.address[1]) as conn:
+            conn.query(b"MEAS?\n")
+            conn.query(b"*IDN?\n")
+        tracer.close()
+
+    assert len(tracer.slow_handlers) == 1
+    report = tracer.slow_handlers[0]
+    assert report.elapsed >= 0.05 and "DataEnd" in report.description
+    assert "in measure" in report.stack
+    assert any("measure (bench.py" in line for line in sampler.collapsed())
+
+
+def test_tracer_optional():
+    assert BenchmarkServer(("127.0.0.1", 0), TracingHislipHandler, bind_and_activate=False).tracer is None
+    with EmbeddedServer(handler_cls=TracingHislipHandler) as srv:
+        with HislipClientConnection(srv.address[0], port=srv.address[1]) as conn:
+            assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
@@ -0,0 +1,67 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+from hislip_server.bench import BenchmarkServer
+from hislip_server.client import HislipClientConnection
+from hislip_server.client import unix_connect
+from hislip_server.hislip_server import HislipHandler
+from hislip_server.hislip_server import HislipUnixServer
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets not available")
+
+
+@pytest.fixture
+def unix_server(tmpdir):
+    tcp = BenchmarkServer(("127.0.0.1", 0), HislipHandler)
+    path = str(tmpdir.join("hislip.sock"))
+    local = HislipUnixServer(path, HislipHandler, tcp)
+    local.daemon_threads = True
+    threads = [threading.Thread(target=s.serve_forever) for s in (tcp, local)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    yield tcp, local
+    for s in (tcp, local):
+        s.shutdown()
+        s.server_close()
+
+
+def test_unix_sessions_are_shared(unix_server):
+    tcp, local = unix_server
+    with HislipClientConnection(local.server_address, connect=unix_connect) as conn:
+        assert conn.query(b"*IDN?\n").tobytes() == BenchmarkServer.idn
+        assert conn.session_id in tcp.clients
+
+
+needs_py3 = pytest.mark.skipif(sys.version_info[0] < 3, reason="Shared memory needs Python 3")
+
+
+@needs_py3
+def test_shared_memory_transfers(unix_server):
+    tcp, local = unix_server
+    with HislipClientConnection(local.server_address, connect=unix_connect) as conn:
+        assert conn.enable_shared_memory(1 << 20)
+        path = conn.shared_memory.path
+        view = conn.query(b"DOWN? 300000\n")
+        assert len(view) == 300000 and view[0:1].tobytes() == b"\x55"
+        del view
+        # The ring is still held by the previous response when the server sends, falls back to the socket
+        assert len(conn.query(b"DOWN? 900000\n")) == 900000
+        assert len(conn.query(b"DOWN? 900000\n")) == 900000  # Wraps around the end of the ring
+        conn.write(b"x" * 200000, end=False)
+        assert conn.query(b"UPL?\n").tobytes() == b"200005"
+        assert conn.shared_memory.upload.used == 0
+    assert not os.path.exists(path)
+
+
+@needs_py3
+def test_shared_memory_refused_over_tcp(unix_server):
+    tcp, local = unix_server
+    host, port = tcp.server_address
+    with HislipClientConnection(host, port=port) as conn:
+        assert not conn.enable_shared_memory(1 << 16)
+        assert conn.shared_memory is None